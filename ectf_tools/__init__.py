@@ -10,6 +10,14 @@
 
 __all__ = ["CmdFailedError", "get_logger", "HandlerTy", "HandlerRet", "subparsers"]
 
+import sys
+
+# The package is imported before the command line is parsed, so start timing
+# imports here to cover everything the CLI loads
+if "--profile-startup" in sys.argv[1:]:
+    from ectf_tools.import_profile import start_profiling
+
+    start_profiling()
 
 from ectf_tools.utils import (
     CmdFailedError,
@@ -11,18 +11,41 @@
 import importlib
 import asyncio
 import logging
+import sys
+from pathlib import Path
+from typing import Dict, List, Optional, Type
 
 from tap import Tap
 
-from ectf_tools import subparsers, get_logger, CmdFailedError, HandlerTy
+from ectf_tools import import_profile, subparsers, get_logger, CmdFailedError, HandlerTy
+from ectf_tools.trace import span, tracing
+
+
+def requested_subparsers(argv: List[str]) -> Dict[str, Type[Tap]]:
+    """
+    Get the subparsers needed to parse a command line
+
+    Building a subparser is slow, so only the requested command's is built
+    unless the command is missing or help is requested for every command
+    """
+    for arg in argv:
+        if arg in subparsers:
+            return {arg: subparsers[arg]}
+        if not arg.startswith("-") or arg in ("-h", "--help"):
+            break
+    return subparsers
 
 
 class Args(Tap):
     debug: bool = False  # whether to enable debug logging
+    profile_startup: bool = False  # report how long each module took to import
+    daemon: bool = False  # run the command in a daemon started with daemon.serve
+    daemon_socket: Optional[Path] = None  # socket of the daemon to use
+    trace: Optional[Path] = None  # append timing spans to this JSON-lines file
 
     def configure(self):
         self.add_subparsers(dest="cmd", required=True)
-        for flag, subparser in subparsers.items():
+        for flag, subparser in requested_subparsers(sys.argv[1:]).items():
             self.add_subparser(flag, subparser, help=subparser.__doc__)  # noqa
 
 
@@ -36,18 +59,43 @@ async def async_main():
     )
     logger = get_logger()
 
+    # Let a running daemon handle the command
+    if args.daemon or args.daemon_socket is not None:
+        from ectf_tools import daemon
+
+        argv = sys.argv[1:]
+        try:
+            await daemon.call(
+                args.cmd,
+                argv[argv.index(args.cmd) + 1 :],  # noqa
+                args.daemon_socket,
+                args.debug,
+                args.trace,
+                logger,
+            )
+        except CmdFailedError as e:
+            exit(f"Error: {e.args[0]}")
+        return
+
     # get command handler
 
     package, func = args.cmd.split(".")  # noqa
     handler: HandlerTy = getattr(importlib.import_module(f"ectf_tools.{package}"), func)
 
+    if import_profile.profiler is not None:
+        import_profile.profiler.uninstall()
+        for line in import_profile.profiler.report():
+            logger.info(line)
+
     # call command handler
     kwargs = args.as_dict()
     del kwargs["cmd"]
-    if "debug" in kwargs:
-        del kwargs["debug"]
+    for flag in ("debug", "profile_startup", "daemon", "daemon_socket", "trace"):
+        if flag in kwargs:
+            del kwargs[flag]
     try:
-        await handler(**kwargs, logger=logger)
+        with tracing(args.trace), span(args.cmd):
+            await handler(**kwargs, logger=logger)
     except CmdFailedError as e:
         exit(f"Error: {e.args[0]}")
 
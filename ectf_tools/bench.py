@@ -0,0 +1,186 @@
+# 2023 eCTF
+# Kyle Scaplen
+#
+# (c) 2023 The MITRE Corporation
+#
+# This source file is part of an example system for MITRE's 2023 Embedded
+# CTF (eCTF). This code is being provided only for educational purposes for the
+# 2023 MITRE eCTF competition, and may not meet MITRE standards for quality.
+# Use this code at your own risk!
+
+import asyncio
+import contextlib
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from ectf_tools import run as run_tools
+from ectf_tools.containers import container_timings
+from ectf_tools.device import Bridge, Port, Sock, load_bridge_map
+from ectf_tools.utils import (
+    CmdFailedError,
+    get_logger,
+    HandlerRet,
+    percentile,
+    SOCKET_BASE,
+)
+from ectf_tools.subparsers import SubparserBench
+
+BENCH_FLOWS = ("unlock", "pair", "package", "enable")
+BENCH_PERCENTILES = (50, 95, 99)
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    summary = {f"p{pct}": percentile(values, pct) for pct in BENCH_PERCENTILES}
+    summary["mean"] = sum(values) / len(values) if values else 0.0
+    summary["max"] = max(values, default=0.0)
+    return {key: round(value, 6) for key, value in summary.items()}
+
+
+def bridge_totals(dev_bridges: List[Bridge]) -> Tuple[int, float]:
+    # Bytes forwarded and time spent forwarding them, across all bridges
+    total_bytes = 0
+    total_latency = 0.0
+    for dev_bridge in dev_bridges:
+        for stats in (
+            dev_bridge.host_to_serial_stats,
+            dev_bridge.serial_to_host_stats,
+        ):
+            total_bytes += stats.bytes
+            total_latency += stats.total_latency
+    return total_bytes, total_latency
+
+
+async def run_iteration(
+    flow: str, name: str, image: str, flow_args: dict, dev_bridges: List[Bridge]
+) -> Dict[str, float]:
+    handler = getattr(run_tools, flow)
+    timings = []
+    token = container_timings.set(timings)
+    bytes_before, latency_before = bridge_totals(dev_bridges)
+
+    # Keep tool logs and output from flooding the benchmark report
+    quiet_logger = logging.getLogger("eCTFBenchLogger")
+    quiet_logger.setLevel(logging.WARNING)
+
+    start = time.perf_counter()
+    try:
+        await handler(name=name, image=image, logger=quiet_logger, **flow_args)
+    finally:
+        total = time.perf_counter() - start
+        container_timings.reset(token)
+
+    bytes_after, latency_after = bridge_totals(dev_bridges)
+    return {
+        "total": total,
+        "container_start": sum(t["create"] + t["start"] for t in timings),
+        "tool_runtime": sum(t["run"] for t in timings),
+        "container_remove": sum(t["remove"] for t in timings),
+        "bridge_transfer": latency_after - latency_before,
+        "bridge_bytes": bytes_after - bytes_before,
+    }
+
+
+async def run(
+    name: str,
+    flow: str,
+    flow_args: str = SubparserBench.flow_args,
+    iterations: int = SubparserBench.iterations,
+    warmup: int = SubparserBench.warmup,
+    bridge_map: Optional[Path] = SubparserBench.bridge_map,
+    output: Optional[Path] = SubparserBench.output,
+    image: str = SubparserBench.image,
+    logger: logging.Logger = None,
+) -> HandlerRet:
+    logger = logger or get_logger()
+
+    if flow not in BENCH_FLOWS:
+        raise CmdFailedError(f"Unknown flow {flow!r}. Expected one of {BENCH_FLOWS}")
+    try:
+        flow_kwargs = json.loads(flow_args)
+    except ValueError as e:
+        raise CmdFailedError(f"Invalid flow arguments {flow_args!r}: {e}")
+    if not isinstance(flow_kwargs, dict):
+        raise CmdFailedError("Flow arguments must be a JSON object")
+    for key in ("package_out", "package_in"):
+        if key in flow_kwargs:
+            flow_kwargs[key] = Path(flow_kwargs[key])
+
+    # Host the bridges in-process so their transfer time can be measured,
+    # otherwise the flow runs against externally started bridges
+    results = []
+    errors = []
+    with contextlib.ExitStack() as host_socks:
+        dev_bridges = []
+        if bridge_map is not None:
+            for bridge_id, dev_serial in load_bridge_map(bridge_map).items():
+                host_sock = Sock(bridge_id + SOCKET_BASE)
+                host_socks.callback(host_sock.shutdown)
+                dev_bridges.append(Bridge(host_sock, Port(dev_serial)))
+        bridge_tasks = [asyncio.ensure_future(b.run()) for b in dev_bridges]
+
+        try:
+            for i in range(warmup + iterations):
+                measured = i >= warmup
+                try:
+                    result = await run_iteration(
+                        flow, name, image, flow_kwargs, dev_bridges
+                    )
+                except CmdFailedError as e:
+                    logger.warning(f"Iteration {i + 1} failed: {e.args[0]}")
+                    if measured:
+                        errors.append(e.args[0])
+                    continue
+
+                if measured:
+                    results.append(result)
+                    logger.info(
+                        f"Iteration {len(results)}/{iterations}:"
+                        f" {result['total'] * 1000:.1f} ms"
+                    )
+        finally:
+            for task in bridge_tasks:
+                task.cancel()
+            await asyncio.gather(*bridge_tasks, return_exceptions=True)
+
+    total_time = sum(result["total"] for result in results)
+    report = {
+        "flow": flow,
+        "image": f"{image}:{name}",
+        "iterations": iterations,
+        "succeeded": len(results),
+        "failed": len(errors),
+        "errors": errors,
+        "throughput_per_s": len(results) / total_time if total_time else 0.0,
+        "latency_s": {
+            phase: summarize([result[phase] for result in results])
+            for phase in (
+                "total",
+                "container_start",
+                "tool_runtime",
+                "container_remove",
+                "bridge_transfer",
+            )
+        },
+        "bridge_bytes": sum(result["bridge_bytes"] for result in results),
+    }
+
+    total_latency = report["latency_s"]["total"]
+    logger.info(
+        f"{flow}: {len(results)}/{iterations} succeeded,"
+        f" p50 {total_latency['p50'] * 1000:.1f} ms,"
+        f" p95 {total_latency['p95'] * 1000:.1f} ms,"
+        f" p99 {total_latency['p99'] * 1000:.1f} ms,"
+        f" {report['throughput_per_s']:.2f} runs/s"
+    )
+
+    report_json = json.dumps(report, indent=2)
+    if output is not None:
+        output.write_text(report_json)
+        logger.info(f"Wrote benchmark report to {output}")
+    else:
+        print(report_json)
+
+    return report_json.encode(), b""
@@ -8,21 +8,40 @@
 # 2023 MITRE eCTF competition, and may not meet MITRE standards for quality.
 # Use this code at your own risk!
 
+import asyncio
+import json
 import logging
+import os
+from typing import Any, Dict, List, Optional
 
-import docker
 import docker.errors
-from docker.utils import tar
 from pathlib import Path
 
-from ectf_tools.utils import run_shell, get_logger, zip_step_returns, HandlerRet
-from ectf_tools.device import FW_FLASH_SIZE, FW_EEPROM_SIZE
+from ectf_tools.utils import (
+    get_logger,
+    zip_step_returns,
+    CmdFailedError,
+    HandlerRet,
+)
+from ectf_tools.build_cache import BuildCache
+from ectf_tools.build_context import (
+    BuildContext,
+    CONTEXT_LABEL,
+    follow_build,
+    image_context_digest,
+)
+from ectf_tools.build_container import WarmBuildContainer
+from ectf_tools.containers import docker_client, in_executor, run_container, volume
+from ectf_tools.image import PackageJob, SECRET_SLOTS, package_many
+from ectf_tools.trace import span
 from ectf_tools.subparsers import (
     SubparserBuildEnv,
     SubparserBuildTools,
     SubparserBuildDepl,
     SubparserBuildCarFobPair,
     SubparserBuildFob,
+    SubparserBuildFleet,
+    SubparserBuildStopWarm,
 )
 
 
@@ -32,25 +51,43 @@ async def env(
     image: str = SubparserBuildEnv.image,
     docker_dir: Path = SubparserBuildEnv.docker_dir,
     dockerfile: str = SubparserBuildEnv.dockerfile,
+    rebuild: bool = SubparserBuildEnv.rebuild,
     logger: logging.Logger = None,
 ) -> HandlerRet:
     tag = f"{image}:{name}"
     logger = logger or get_logger()
-    logger.info(f"Building image {tag}")
 
     # Add build directory to context
     build_dir = design.resolve() / docker_dir
     dockerfile_name = build_dir / dockerfile
     with open(dockerfile_name, "r") as df:
-        dockerfile = ("Dockerfile", df.read())
-    dockerfile = tar(build_dir, dockerfile=dockerfile)
+        context = BuildContext(build_dir, df.read())
+
+    # Skip the build if the image was built from the same context
+    client = docker_client()
+    with span("build_context.hash"):
+        context_digest = await in_executor(context.digest)
+    if not rebuild:
+        built_digest = await in_executor(image_context_digest, client, tag)
+        if built_digest == context_digest:
+            logger.info(f"Image {tag} is up to date with {build_dir}")
+            return b"", b""
+
+    def build_image():
+        logs_raw = client.api.build(
+            fileobj=context.stream(),
+            custom_context=True,
+            tag=tag,
+            labels={CONTEXT_LABEL: context_digest},
+            decode=True,
+        )
+        return follow_build(tag, logs_raw, logger)
 
-    # run docker build
-    client = docker.from_env()
+    # run docker build, streaming the context in and the log out
+    logger.info(f"Building image {tag}")
     try:
-        _, logs_raw = client.images.build(
-            tag=tag, fileobj=dockerfile, custom_context=True,
-        )
+        with span("docker.build", image=tag):
+            logs, steps = await in_executor(build_image)
     except docker.errors.BuildError as e:
         logger.error(f"Docker build error: {e}")
         for log in e.build_log:
@@ -59,8 +96,9 @@ async def env(
         raise
     logger.info(f"Built image {tag}")
 
-    logs = "".join([d["stream"] for d in list(logs_raw) if "stream" in d])
-    logging.debug(logs)
+    if steps:
+        instruction, seconds = max(steps, key=lambda step: step[1])
+        logger.info(f"{tag}: Slowest step took {seconds:.2f}s: {instruction}")
     return logs.encode(), b""
 
 
@@ -75,12 +113,16 @@ async def tools(
     logger = logger or get_logger()
     logger.info(f"{tag}: Building tools")
     tool_dir = str(design.resolve() / tools_in)
-    output = await run_shell(
-        "docker run"
-        f' -v "{tool_dir}":/tools_in:ro'
-        f" -v {image}.{name}.tools.vol:/tools_out"
-        " --workdir=/tools_in"
-        f" {tag} make TOOLS_OUT_DIR=/tools_out"
+    output = await run_container(
+        tag,
+        ["make", "TOOLS_OUT_DIR=/tools_out"],
+        volumes={
+            **volume(tool_dir, "/tools_in", read_only=True),
+            **volume(f"{image}.{name}.tools.vol", "/tools_out"),
+        },
+        workdir="/tools_in",
+        logger=logger,
+        stream=True,
     )
     logger.info(f"{tag}: Built tools")
     return output
@@ -98,12 +140,16 @@ async def depl(
     logger = logger or get_logger()
     logger.info(f"{tag}: Building deployment {deployment}")
     depl_dir = str(design.resolve() / depl_in)
-    output = await run_shell(
-        "docker run"
-        f' -v "{depl_dir}":/depl_in:ro'
-        f" -v {image}.{name}.{deployment}.secrets.vol:/secrets"
-        " --workdir=/depl_in"
-        f" {tag} make SECRETS_DIR=/secrets"
+    output = await run_container(
+        tag,
+        ["make", "SECRETS_DIR=/secrets"],
+        volumes={
+            **volume(depl_dir, "/depl_in", read_only=True),
+            **volume(f"{image}.{name}.{deployment}.secrets.vol", "/secrets"),
+        },
+        workdir="/depl_in",
+        logger=logger,
+        stream=True,
     )
     logger.info(f"{tag}: Built deployment {deployment}")
     return output
@@ -126,7 +172,15 @@ async def car_fob_pair(
     car_feature2_secret: str = SubparserBuildCarFobPair.car_feature2_secret,
     car_feature3_secret: str = SubparserBuildCarFobPair.car_feature3_secret,
     image: str = SubparserBuildCarFobPair.image,
+    build_cache: bool = SubparserBuildCarFobPair.build_cache,
+    cache_size: int = SubparserBuildCarFobPair.cache_size,
+    warm: bool = SubparserBuildCarFobPair.warm,
+    share_objects: bool = SubparserBuildCarFobPair.share_objects,
     logger: logging.Logger = None,
+    shared_cache: Optional[BuildCache] = None,
+    build_slots: Optional[asyncio.Semaphore] = None,
+    warm_container: Optional[WarmBuildContainer] = None,
+    package: bool = True,
 ) -> HandlerRet:
     """
     Build car and paired fob pair
@@ -136,47 +190,63 @@ async def car_fob_pair(
     tag = f"{image}:{name}"
     logger = logger or get_logger()
     logger.info(f"{tag}:{deployment}: Building car {car_name}")
+    car_secrets = car_secret_overlay(
+        car_unlock_secret, car_feature1_secret, car_feature2_secret, car_feature3_secret
+    )
+    cache = shared_cache
+    if cache is None and build_cache:
+        cache = BuildCache(max_size=cache_size, logger=logger)
+    if warm_container is None and warm:
+        warm_container = WarmBuildContainer(image, name, deployment, design, logger)
 
     # Car defines
     car_defines = f" CAR_ID={car_id}"
 
-    # Build car
-    car_output = await make_dev(
-        image=image,
-        name=name,
-        design=design,
-        deployment=deployment,
-        dev_name=car_name,
-        dev_in=car_in,
-        dev_out=car_out,
-        defines=car_defines,
-        make_target="car",
-        logger=logger,
-        replace_secrets=True,
-        unlock_secret=car_unlock_secret,
-        feature1_secret=car_feature1_secret,
-        feature2_secret=car_feature2_secret,
-        feature3_secret=car_feature3_secret,
-    )
-
     # Fob defines
     fob_defines = f" CAR_ID={car_id}" f" PAIR_PIN={pair_pin}"
 
-    # Build fob
-    fob_output = await make_dev(
-        image=image,
-        name=name,
-        design=design,
-        deployment=deployment,
-        dev_name=fob_name,
-        dev_in=fob_in,
-        dev_out=fob_out,
-        defines=fob_defines,
-        make_target="paired_fob",
-        logger=logger,
-        replace_secrets=False,
+    # Build car and fob together
+    car_output, fob_output = await asyncio.gather(
+        make_dev(
+            image=image,
+            name=name,
+            design=design,
+            deployment=deployment,
+            dev_name=car_name,
+            dev_in=car_in,
+            dev_out=car_out,
+            defines=car_defines,
+            make_target="car",
+            logger=logger,
+            secrets=car_secrets,
+            build_cache=cache,
+            build_slots=build_slots,
+            warm_container=warm_container,
+            share_objects=share_objects,
+            package=package,
+        ),
+        make_dev(
+            image=image,
+            name=name,
+            design=design,
+            deployment=deployment,
+            dev_name=fob_name,
+            dev_in=fob_in,
+            dev_out=fob_out,
+            defines=fob_defines,
+            make_target="paired_fob",
+            logger=logger,
+            build_cache=cache,
+            build_slots=build_slots,
+            warm_container=warm_container,
+            share_objects=share_objects,
+            package=package,
+        ),
     )
 
+    if cache is not None and shared_cache is None:
+        logger.info(f"{tag}:{deployment}: Build cache stats {cache.stats()}")
+
     return zip_step_returns([car_output, fob_output])
 
 
@@ -188,7 +258,15 @@ async def fob(
     fob_out: Path,
     image: str = SubparserBuildFob.image,
     fob_in: Path = SubparserBuildFob.fob_in,
+    build_cache: bool = SubparserBuildFob.build_cache,
+    cache_size: int = SubparserBuildFob.cache_size,
+    warm: bool = SubparserBuildFob.warm,
+    share_objects: bool = SubparserBuildFob.share_objects,
     logger: logging.Logger = None,
+    shared_cache: Optional[BuildCache] = None,
+    build_slots: Optional[asyncio.Semaphore] = None,
+    warm_container: Optional[WarmBuildContainer] = None,
+    package: bool = True,
 ) -> HandlerRet:
     """
     Build unpaired fob firmware
@@ -198,6 +276,11 @@ async def fob(
     tag = f"{image}:{name}"
     logger = logger or get_logger()
     logger.info(f"{tag}:{deployment}: Building unpaired fob {fob_name}")
+    cache = shared_cache
+    if cache is None and build_cache:
+        cache = BuildCache(max_size=cache_size, logger=logger)
+    if warm_container is None and warm:
+        warm_container = WarmBuildContainer(image, name, deployment, design, logger)
 
     # Unpaired fob defines
     fob_defines = ""
@@ -214,12 +297,244 @@ async def fob(
         defines=fob_defines,
         make_target="unpaired_fob",
         logger=logger,
-        replace_secrets=False,
+        build_cache=cache,
+        build_slots=build_slots,
+        warm_container=warm_container,
+        share_objects=share_objects,
+        package=package,
     )
 
+    if cache is not None and shared_cache is None:
+        logger.info(f"{tag}:{deployment}: Build cache stats {cache.stats()}")
+
     return output
 
 
+FLEET_CAR_KEYS = {
+    "car_name": str,
+    "fob_name": str,
+    "car_out": Path,
+    "fob_out": Path,
+    "car_id": int,
+    "pair_pin": str,
+    "car_in": Path,
+    "fob_in": Path,
+    "car_unlock_secret": str,
+    "car_feature1_secret": str,
+    "car_feature2_secret": str,
+    "car_feature3_secret": str,
+}
+FLEET_CAR_REQUIRED = (
+    "car_name",
+    "fob_name",
+    "car_out",
+    "fob_out",
+    "car_id",
+    "pair_pin",
+)
+FLEET_CAR_SECRETS = (
+    "car_unlock_secret",
+    "car_feature1_secret",
+    "car_feature2_secret",
+    "car_feature3_secret",
+)
+FLEET_FOB_KEYS = {"fob_name": str, "fob_out": Path, "fob_in": Path}
+FLEET_FOB_REQUIRED = ("fob_name", "fob_out")
+FLEET_OUTPUT_KEYS = ("car_out", "fob_out")
+
+
+def load_fleet_manifest(manifest: Path) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Load a fleet manifest
+
+    The manifest is a JSON object with a "cars" list of car_fob_pair arguments
+    and an "unpaired_fobs" list of fob arguments. Relative output directories
+    are resolved against the manifest's directory
+    """
+    try:
+        raw_manifest = json.loads(manifest.read_text())
+    except (OSError, ValueError) as e:
+        raise CmdFailedError(f"Could not read fleet manifest {manifest}: {e}")
+
+    if not isinstance(raw_manifest, dict):
+        raise CmdFailedError(f"Fleet manifest {manifest} must be an object")
+
+    fleet_manifest = {}
+    for section, keys, required in (
+        ("cars", FLEET_CAR_KEYS, FLEET_CAR_REQUIRED),
+        ("unpaired_fobs", FLEET_FOB_KEYS, FLEET_FOB_REQUIRED),
+    ):
+        entries = []
+        for i, raw_entry in enumerate(raw_manifest.get(section, [])):
+            where = f"{manifest} {section}[{i}]"
+            if not isinstance(raw_entry, dict):
+                raise CmdFailedError(f"{where} must be an object")
+
+            unknown = sorted(set(raw_entry) - set(keys))
+            missing = [key for key in required if key not in raw_entry]
+            if unknown or missing:
+                raise CmdFailedError(
+                    f"{where} has unknown keys {unknown} and missing keys {missing}"
+                )
+            try:
+                entry = {k: keys[k](v) for k, v in raw_entry.items()}
+            except (TypeError, ValueError) as e:
+                raise CmdFailedError(f"{where} is invalid: {e}")
+            # Output directories are relative to the manifest, like board maps
+            for key in FLEET_OUTPUT_KEYS:
+                if key in entry:
+                    entry[key] = manifest.parent / entry[key]
+            entries.append(entry)
+        fleet_manifest[section] = entries
+
+    # Builds writing the same output file would clobber each other
+    outputs = [(car["car_out"], car["car_name"]) for car in fleet_manifest["cars"]]
+    outputs += [(car["fob_out"], car["fob_name"]) for car in fleet_manifest["cars"]]
+    outputs += [
+        (fob["fob_out"], fob["fob_name"]) for fob in fleet_manifest["unpaired_fobs"]
+    ]
+    outputs = [str(out.resolve() / dev_name) for out, dev_name in outputs]
+    duplicates = sorted({out for out in outputs if outputs.count(out) > 1})
+    if duplicates:
+        raise CmdFailedError(f"Devices built more than once: {duplicates}")
+
+    # Check every car's secrets before building anything. The overlays are
+    # cached, so packaging reuses them
+    invalid = []
+    for car in fleet_manifest["cars"]:
+        try:
+            fleet_car_secrets(car)
+        except CmdFailedError as e:
+            invalid.append(f"car {car['car_name']}: {e}")
+    if invalid:
+        raise CmdFailedError("\n".join(invalid))
+
+    return fleet_manifest
+
+
+def fleet_car_secrets(car: Dict[str, Any]) -> bytes:
+    """
+    Get the secret overlay of a fleet manifest car, with car_fob_pair defaults
+    """
+    return car_secret_overlay(
+        *(
+            car.get(key, getattr(SubparserBuildCarFobPair, key))
+            for key in FLEET_CAR_SECRETS
+        )
+    )
+
+
+async def fleet(
+    design: Path,
+    name: str,
+    deployment: str,
+    manifest: Path,
+    jobs: int = SubparserBuildFleet.jobs,
+    image: str = SubparserBuildFleet.image,
+    build_cache: bool = SubparserBuildFleet.build_cache,
+    cache_size: int = SubparserBuildFleet.cache_size,
+    warm: bool = SubparserBuildFleet.warm,
+    share_objects: bool = SubparserBuildFleet.share_objects,
+    logger: logging.Logger = None,
+) -> HandlerRet:
+    """
+    Build every car, paired fob and unpaired fob of a deployment
+    """
+
+    # Image information
+    tag = f"{image}:{name}"
+    logger = logger or get_logger()
+    fleet_manifest = load_fleet_manifest(manifest)
+    cars = fleet_manifest["cars"]
+    unpaired_fobs = fleet_manifest["unpaired_fobs"]
+
+    jobs = jobs if jobs > 0 else os.cpu_count() or 1
+    logger.info(
+        f"{tag}:{deployment}: Building {len(cars)} cars with paired fobs and"
+        f" {len(unpaired_fobs)} unpaired fobs, {jobs} at a time"
+    )
+
+    cache = BuildCache(max_size=cache_size, logger=logger) if build_cache else None
+    build_slots = asyncio.Semaphore(jobs)
+    container = None
+    if warm:
+        container = WarmBuildContainer(image, name, deployment, design, logger)
+    common = dict(
+        design=design,
+        name=name,
+        deployment=deployment,
+        image=image,
+        share_objects=share_objects,
+        logger=logger,
+        shared_cache=cache,
+        build_slots=build_slots,
+        warm_container=container,
+        package=False,
+    )
+
+    builds = [car_fob_pair(**common, **car) for car in cars]
+    builds += [fob(**common, **unpaired_fob) for unpaired_fob in unpaired_fobs]
+    labels = [f"car {car['car_name']}" for car in cars]
+    labels += [f"unpaired fob {f['fob_name']}" for f in unpaired_fobs]
+    packages = [
+        [
+            device_package_job(car["car_out"], car["car_name"], fleet_car_secrets(car)),
+            device_package_job(car["fob_out"], car["fob_name"]),
+        ]
+        for car in cars
+    ]
+    packages += [
+        [device_package_job(f["fob_out"], f["fob_name"])] for f in unpaired_fobs
+    ]
+
+    # Let every build finish before reporting failures
+    results = await asyncio.gather(*builds, return_exceptions=True)
+
+    if cache is not None:
+        logger.info(f"{tag}:{deployment}: Build cache stats {cache.stats()}")
+
+    failed = []
+    outputs = []
+    built = []
+    for label, result, package in zip(labels, results, packages):
+        if isinstance(result, BaseException):
+            logger.error(f"{tag}:{deployment}: Failed to build {label}: {result}")
+            failed.append(label)
+        else:
+            outputs.append(result)
+            built += package
+
+    # Package every built device with one image buffer
+    logger.info(f"{tag}:{deployment}: Packaging images for {len(built)} devices")
+    with span("package_devices", devices=len(built)):
+        package_many(built)
+    logger.info(f"{tag}:{deployment}: Packaged {len(built)} device images")
+
+    if failed:
+        raise CmdFailedError(f"Fleet build failed for {', '.join(failed)}")
+
+    logger.info(f"{tag}:{deployment}: Built fleet of {len(builds)} builds")
+
+    # Each build returns a list of stream tuples, one per device
+    return [streams for output in outputs for streams in output] or [(b"", b"")]
+
+
+async def stop_warm(
+    design: Path,
+    name: str,
+    deployment: str,
+    image: str = SubparserBuildStopWarm.image,
+    logger: logging.Logger = None,
+) -> HandlerRet:
+    """
+    Remove the long-lived build container started by --warm builds
+    """
+    logger = logger or get_logger()
+    container = WarmBuildContainer(image, name, deployment, design, logger)
+    await container.stop()
+    return b"", b""
+
+
 async def make_dev(
     image: str,
     name: str,
@@ -231,16 +546,20 @@ async def make_dev(
     defines: str,
     make_target: str,
     logger: logging.Logger,
-    replace_secrets: bool,
-    unlock_secret: str = "Car Unlocked",
-    feature1_secret: str = "Feature 1 Enabled: Heated Seats",
-    feature2_secret: str = "Feature 2 Enabled: Extended Range",
-    feature3_secret: str = "Feature 3 Enabled: Valet Mode",
+    secrets: Optional[bytes] = None,
+    build_cache: Optional[BuildCache] = None,
+    build_slots: Optional[asyncio.Semaphore] = None,
+    warm_container: Optional[WarmBuildContainer] = None,
+    share_objects: bool = False,
+    package: bool = True,
 ) -> HandlerRet:
     """
     Build device firmware
+
+    Unless package is unset, the image is packaged from the build outputs
     """
     tag = f"{image}:{name}"
+    secrets_vol = f"{image}.{name}.{deployment}.secrets.vol"
 
     # Setup full container paths
     bin_path = f"/dev_out/{dev_name}.bin"
@@ -252,51 +571,108 @@ async def make_dev(
     # Create output directory
     if not dev_out.exists():
         logger.info(f"{tag}:{deployment}: Making output directory {dev_out}")
-        dev_out.mkdir()
-
-    # Compile
-    output = await run_shell(
-        "docker run"
-        f' -v "{str(dev_in)}":/dev_in:ro'
-        f' -v "{str(dev_out)}":/dev_out'
-        f" -v {image}.{name}.{deployment}.secrets.vol:/secrets"
-        " --workdir=/root"
-        f" {tag} /bin/bash -c"
-        ' "'
-        " cp -r /dev_in/. /root/ &&"
-        f" make {make_target}"
-        f" {defines}"
-        f" SECRETS_DIR=/secrets"
-        f" BIN_PATH={bin_path}"
-        f" ELF_PATH={elf_path}"
-        f" EEPROM_PATH={eeprom_path}"
-        '"'
-    )
-
-    logger.info(f"{tag}:{deployment}: Built device {dev_name}")
+        dev_out.mkdir(exist_ok=True)
+
+    # Wait for a free build slot when building many devices at once. Without
+    # a shared semaphore, a private one never blocks
+    async with build_slots or asyncio.Semaphore():
+        # Reuse outputs of an identical earlier build if possible
+        cache_key = None
+        if build_cache is not None:
+            with span("build_cache.key", device=dev_name):
+                cache_key = await build_cache.make_key(
+                    tag, secrets_vol, dev_in, make_target, defines
+                )
+
+        if cache_key and build_cache.restore(cache_key, dev_out, dev_name):
+            logger.info(f"{tag}:{deployment}: Restored device {dev_name} from cache")
+            output = [(b"", b"")]
+        else:
+            if warm_container is not None and warm_container.can_build(dev_in):
+                # Compile in the long-lived build container
+                make = warm_container.make(
+                    dev_in, dev_out, dev_name, make_target, defines, share_objects
+                )
+            else:
+                # Compile
+                make = run_container(
+                    tag,
+                    [
+                        "/bin/bash",
+                        "-c",
+                        "cp -r /dev_in/. /root/ &&"
+                        f" make {make_target}"
+                        f" {defines}"
+                        f" SECRETS_DIR=/secrets"
+                        f" BIN_PATH={bin_path}"
+                        f" ELF_PATH={elf_path}"
+                        f" EEPROM_PATH={eeprom_path}",
+                    ],
+                    volumes={
+                        **volume(dev_in, "/dev_in", read_only=True),
+                        **volume(dev_out, "/dev_out"),
+                        **volume(secrets_vol, "/secrets"),
+                    },
+                    workdir="/root",
+                    logger=logger,
+                    stream=True,
+                )
+            with span("make", device=dev_name, target=make_target):
+                output = await make
+
+            logger.info(f"{tag}:{deployment}: Built device {dev_name}")
+
+            if cache_key:
+                build_cache.store(cache_key, dev_out, dev_name)
+
+    if not package:
+        return output
 
     # Package image, eeprom, and secret
     logger.info(f"{tag}:{deployment}: Packaging image for device {dev_name}")
-    bin_path = dev_out / f"{dev_name}.bin"
-    eeprom_path = dev_out / f"{dev_name}.eeprom"
-    image_path = dev_out / f"{dev_name}.img"
-
-    package_device(
-        bin_path,
-        eeprom_path,
-        image_path,
-        replace_secrets,
-        unlock_secret,
-        feature1_secret,
-        feature2_secret,
-        feature3_secret,
-    )
+
+    with span("package_device", device=dev_name):
+        package_many([device_package_job(dev_out, dev_name, secrets)])
 
     logger.info(f"{tag}:{deployment}: Packaged device {dev_name} image")
 
     return output
 
 
+def device_package_job(
+    dev_out: Path, dev_name: str, secrets: Optional[bytes] = None
+) -> PackageJob:
+    """
+    Describe packaging the build outputs of a device into its image
+    """
+    dev_out = dev_out.resolve()
+    return PackageJob(
+        dev_out / f"{dev_name}.bin",
+        dev_out / f"{dev_name}.eeprom",
+        dev_out / f"{dev_name}.img",
+        secrets,
+    )
+
+
+def car_secret_overlay(
+    unlock_secret: str,
+    feature1_secret: str,
+    feature2_secret: str,
+    feature3_secret: str,
+) -> bytes:
+    """
+    Compile the secrets of a car into its EEPROM secret region
+    """
+    return SECRET_SLOTS.overlay(
+        {
+            "unlock": unlock_secret,
+            "feature1": feature1_secret,
+            "feature2": feature2_secret,
+            "feature3": feature3_secret,
+        }
+    )
+
+
 def package_device(
     bin_path: Path,
     eeprom_path: Path,
@@ -310,58 +686,14 @@ def package_device(
     """
     Package a device image for use with the bootstrapper
 
-    Accepts up to 64 bytes (encoded in hex) to insert as a secret in EEPROM
+    Accepts up to 64 bytes (encoded in hex) to insert as a secret in EEPROM.
+    Use image.package_many to package many devices with one image buffer
     """
-    # Read input bin file
-    bin_data = bin_path.read_bytes()
-
-    # Pad bin data to max size
-    image_bin_data = bin_data.ljust(FW_FLASH_SIZE, b"\xff")
-
-    # Read EEPROM data
-    eeprom_data = eeprom_path.read_bytes()
-
-    # Pad EEPROM to max size
-    image_eeprom_data = eeprom_data.ljust(FW_EEPROM_SIZE, b"\xff")
-
-    # Put secrets in EEPROM if used
+    secrets = None
     if replace_secrets:
-        # Convert secrets to bytes
-        unlock_secret = unlock_secret.encode()
-        feature1_secret = feature1_secret.encode()
-        feature2_secret = feature2_secret.encode()
-        feature3_secret = feature3_secret.encode()
-
-        # Check secret lengths
-        if len(unlock_secret) > 64:
-            raise Exception(f"Unlock secret too long ({len(unlock_secret)} > 64)")
-
-        if len(feature1_secret) > 64:
-            raise Exception(f"Feature 1 secret too long ({len(feature1_secret)} > 64)")
-
-        if len(feature2_secret) > 64:
-            raise Exception(f"Feature 2 secret too long ({len(feature2_secret)} > 64)")
-
-        if len(feature3_secret) > 64:
-            raise Exception(f"Feature 3 secret too long ({len(feature3_secret)} > 64)")
-
-        # Pad secrets to 64 bytes
-        unlock_secret = unlock_secret.ljust(64, b".")
-        feature1_secret = feature1_secret.ljust(64, b".")
-        feature2_secret = feature2_secret.ljust(64, b".")
-        feature3_secret = feature3_secret.ljust(64, b".")
-
-        # Replace end of EEPROM data with secret values
-        image_eeprom_data = (
-            image_eeprom_data[: FW_EEPROM_SIZE - 256]
-            + feature3_secret
-            + feature2_secret
-            + feature1_secret
-            + unlock_secret
+        secrets = car_secret_overlay(
+            unlock_secret, feature1_secret, feature2_secret, feature3_secret
         )
-
-    # Create phys_image.bin
-    image_data = image_bin_data + image_eeprom_data
-
-    # Write output binary
-    image_path.write_bytes(image_data)
+    package_many(
+        [PackageJob(Path(bin_path), Path(eeprom_path), Path(image_path), secrets)]
+    )
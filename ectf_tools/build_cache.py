@@ -0,0 +1,224 @@
+# 2023 eCTF
+# Kyle Scaplen
+#
+# (c) 2023 The MITRE Corporation
+#
+# This source file is part of an example system for MITRE's 2023 Embedded
+# CTF (eCTF). This code is being provided only for educational purposes for the
+# 2023 MITRE eCTF competition, and may not meet MITRE standards for quality.
+# Use this code at your own risk!
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import docker.errors
+
+from ectf_tools.containers import docker_client, in_executor, run_container, volume
+from ectf_tools.utils import get_cache_dir, get_logger, CmdFailedError
+
+
+BUILD_OUTPUTS = (".bin", ".elf", ".eeprom")
+DEFAULT_CACHE_SIZE = 1024  # MiB
+
+
+def hash_tree(root: Path) -> str:
+    """Hash the relative paths and contents of every file under a directory"""
+    tree_hash = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = Path(dirpath) / filename
+            tree_hash.update(path.relative_to(root).as_posix().encode() + b"\0")
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    tree_hash.update(chunk)
+            tree_hash.update(b"\0")
+    return tree_hash.hexdigest()
+
+
+class BuildCache:
+    """Content-addressed cache of device build outputs
+
+    Entries are keyed by everything a device build can observe: the device
+    source tree, the make target and defines, the build image, and the
+    contents of the deployment secrets volume. Entries are evicted least
+    recently used first once the cache grows past its size limit.
+    """
+
+    def __init__(
+        self,
+        root: Path = None,
+        max_size: int = DEFAULT_CACHE_SIZE,
+        logger: logging.Logger = None,
+    ):
+        self.root = root or get_cache_dir() / "builds"
+        self.max_size = max_size * 1024 * 1024
+        self.logger = logger or get_logger()
+        self.hits = 0
+        self.misses = 0
+        self._saved_hits = 0
+        self._saved_misses = 0
+        self._secrets_digests: Dict[Tuple[str, str], asyncio.Future] = {}
+
+    async def secrets_digest(self, tag: str, secrets_vol: str) -> Optional[bytes]:
+        """Hash the contents of a secrets volume, once per cache instance
+
+        Concurrent builds of one deployment share a single hashing container,
+        so cache hits start no containers after the first build
+        """
+        key = (tag, secrets_vol)
+        digest_future = self._secrets_digests.get(key)
+        if digest_future is None:
+            digest_future = asyncio.ensure_future(self._hash_secrets(tag, secrets_vol))
+            self._secrets_digests[key] = digest_future
+        digest = await digest_future
+        if digest is None and self._secrets_digests.get(key) is digest_future:
+            # Let a later build try again
+            del self._secrets_digests[key]
+        return digest
+
+    async def _hash_secrets(self, tag: str, secrets_vol: str) -> Optional[bytes]:
+        # Hash the secrets from inside a container since the volume may not
+        # be reachable from the host
+        try:
+            ret = await run_container(
+                tag,
+                [
+                    "/bin/bash",
+                    "-c",
+                    "find . -type f -print0 | sort -z | xargs -0 -r sha256sum",
+                ],
+                volumes=volume(secrets_vol, "/secrets", read_only=True),
+                workdir="/secrets",
+                logger=self.logger,
+            )
+        except CmdFailedError:
+            self.logger.warning(f"{tag}: Not caching build, could not hash secrets")
+            return None
+        secrets_digest, _ = ret[0]
+        return secrets_digest
+
+    async def make_key(
+        self,
+        tag: str,
+        secrets_vol: str,
+        dev_in: Path,
+        make_target: str,
+        defines: str,
+    ) -> Optional[str]:
+        """Get the cache key for a build, or None if it cannot be cached"""
+        try:
+            image_id = (await in_executor(docker_client().images.get, tag)).id
+        except docker.errors.DockerException as e:
+            self.logger.warning(f"{tag}: Not caching build, image lookup failed: {e}")
+            return None
+
+        secrets_digest = await self.secrets_digest(tag, secrets_vol)
+        if secrets_digest is None:
+            return None
+        tree_digest = await in_executor(hash_tree, dev_in)
+
+        key = hashlib.sha256()
+        for part in (
+            image_id.encode(),
+            secrets_digest,
+            tree_digest.encode(),
+            make_target.encode(),
+            " ".join(defines.split()).encode(),
+        ):
+            key.update(part + b"\0")
+        return key.hexdigest()
+
+    def restore(self, key: str, dev_out: Path, dev_name: str) -> bool:
+        """Copy cached outputs for a build into the output directory"""
+        entry = self.root / key
+        if not all((entry / f"dev{suffix}").exists() for suffix in BUILD_OUTPUTS):
+            self.misses += 1
+            self._save_stats()
+            return False
+
+        for suffix in BUILD_OUTPUTS:
+            shutil.copyfile(entry / f"dev{suffix}", dev_out / f"{dev_name}{suffix}")
+
+        # Mark the entry as recently used
+        os.utime(entry)
+        self.hits += 1
+        self._save_stats()
+        return True
+
+    def store(self, key: str, dev_out: Path, dev_name: str):
+        """Add the outputs of a finished build to the cache"""
+        entry = self.root / key
+        if entry.exists():
+            return
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp_entry = Path(tempfile.mkdtemp(dir=self.root, prefix=".tmp-"))
+        try:
+            for suffix in BUILD_OUTPUTS:
+                shutil.copyfile(
+                    dev_out / f"{dev_name}{suffix}", tmp_entry / f"dev{suffix}"
+                )
+            tmp_entry.rename(entry)
+        except OSError as e:
+            self.logger.warning(f"Could not store build in cache: {e}")
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            return
+
+        self.evict()
+
+    def evict(self):
+        entries = [
+            entry
+            for entry in self.root.iterdir()
+            if entry.is_dir() and not entry.name.startswith(".")
+        ]
+        sizes = {
+            entry: sum(f.stat().st_size for f in entry.iterdir()) for entry in entries
+        }
+        total_size = sum(sizes.values())
+
+        for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+            if total_size <= self.max_size:
+                break
+            self.logger.debug(f"Evicting build cache entry {entry.name}")
+            shutil.rmtree(entry, ignore_errors=True)
+            total_size -= sizes[entry]
+
+    def stats(self) -> Dict[str, int]:
+        """Get hit and miss counts for this session and across all sessions"""
+        totals = self._load_stats()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "total_hits": totals["hits"],
+            "total_misses": totals["misses"],
+        }
+
+    def _load_stats(self) -> Dict[str, int]:
+        try:
+            return json.loads((self.root / "stats.json").read_text())
+        except (OSError, ValueError):
+            return {"hits": 0, "misses": 0}
+
+    def _save_stats(self):
+        # Accumulate the counts of this session into the persistent totals
+        totals = self._load_stats()
+        totals["hits"] += self.hits - self._saved_hits
+        totals["misses"] += self.misses - self._saved_misses
+        self._saved_hits, self._saved_misses = self.hits, self.misses
+
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.root / ".stats.json.tmp"
+            tmp_path.write_text(json.dumps(totals))
+            tmp_path.replace(self.root / "stats.json")
+        except OSError as e:
+            self.logger.warning(f"Could not save build cache stats: {e}")
@@ -0,0 +1,214 @@
+# 2023 eCTF
+# Kyle Scaplen
+#
+# (c) 2023 The MITRE Corporation
+#
+# This source file is part of an example system for MITRE's 2023 Embedded
+# CTF (eCTF). This code is being provided only for educational purposes for the
+# 2023 MITRE eCTF competition, and may not meet MITRE standards for quality.
+# Use this code at your own risk!
+
+import asyncio
+import hashlib
+import logging
+import shlex
+import shutil
+import uuid
+from pathlib import Path
+from typing import Dict, Optional
+
+import docker.errors
+
+from ectf_tools.containers import (
+    docker_client,
+    exec_in_container,
+    in_executor,
+    volume,
+)
+from ectf_tools.utils import get_cache_dir, get_logger, CmdFailedError, HandlerRet
+
+
+DESIGN_LABEL = "ectf.design"
+# Sources last synced into a work directory, to remove deleted ones
+SOURCE_LIST = ".ectf-sources"
+
+
+class WarmBuildContainer:
+    """Long-lived build container that device builds are exec'd into
+
+    The container is named after the image, system name and deployment so
+    later invocations of the tools find and reuse it. The design repo is
+    mounted read-only and each device source directory is synced into a
+    persistent work directory, so make only rebuilds what changed. Outputs
+    are written to a host staging directory and moved to the requested
+    output directory afterwards.
+    """
+
+    def __init__(
+        self,
+        image: str,
+        name: str,
+        deployment: str,
+        design: Path,
+        logger: logging.Logger = None,
+    ):
+        self.tag = f"{image}:{name}"
+        self.container_name = f"{image}.{name}.{deployment}.build"
+        self.secrets_vol = f"{image}.{name}.{deployment}.secrets.vol"
+        self.design = design.resolve()
+        self.stage_dir = get_cache_dir() / "warm" / self.container_name
+        self.logger = logger or get_logger()
+        self._started = False
+        self._start_lock: Optional[asyncio.Lock] = None
+        self._work_locks: Dict[str, asyncio.Lock] = {}
+
+    def can_build(self, dev_in: Path) -> bool:
+        # Only sources inside the mounted design repo are visible
+        try:
+            dev_in.resolve().relative_to(self.design)
+            return True
+        except ValueError:
+            return False
+
+    async def ensure_started(self):
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+
+        async with self._start_lock:
+            if self._started:
+                return
+
+            client = docker_client()
+            try:
+                container = await in_executor(
+                    client.containers.get, self.container_name
+                )
+            except docker.errors.NotFound:
+                container = None
+            except docker.errors.DockerException as e:
+                raise CmdFailedError(f"Could not inspect build container: {e}")
+
+            try:
+                image_id = (await in_executor(client.images.get, self.tag)).id
+            except docker.errors.DockerException as e:
+                raise CmdFailedError(f"Could not inspect build image {self.tag}: {e}")
+
+            # Reuse a running container if it was started for this design from
+            # the current build image, e.g. not one from before the last
+            # build.env
+            if (
+                container is not None
+                and container.status == "running"
+                and container.labels.get(DESIGN_LABEL) == str(self.design)
+            ):
+                if container.attrs.get("Image") == image_id:
+                    self.logger.info(f"{self.tag}: Reusing build container")
+                    self._started = True
+                    return
+                self.logger.info(
+                    f"{self.tag}: Build image changed, recreating build container"
+                )
+
+            if container is not None:
+                await self.stop()
+
+            self.logger.info(f"{self.tag}: Starting build container")
+            self.stage_dir.mkdir(parents=True, exist_ok=True)
+            try:
+                await in_executor(
+                    client.containers.run,
+                    self.tag,
+                    ["sleep", "infinity"],
+                    detach=True,
+                    name=self.container_name,
+                    labels={DESIGN_LABEL: str(self.design)},
+                    volumes={
+                        **volume(self.design, "/design", read_only=True),
+                        **volume(self.stage_dir, "/stage"),
+                        **volume(self.secrets_vol, "/secrets"),
+                    },
+                    working_dir="/root",
+                )
+            except docker.errors.DockerException as e:
+                raise CmdFailedError(f"Could not start build container: {e}")
+            self._started = True
+
+    async def stop(self):
+        self.logger.info(f"{self.tag}: Removing build container")
+        client = docker_client()
+        try:
+            container = await in_executor(client.containers.get, self.container_name)
+            await in_executor(container.remove, force=True)
+        except docker.errors.NotFound:
+            pass
+        except docker.errors.DockerException as e:
+            raise CmdFailedError(f"Could not remove build container: {e}")
+        self._started = False
+
+    async def make(
+        self,
+        dev_in: Path,
+        dev_out: Path,
+        dev_name: str,
+        make_target: str,
+        defines: str,
+        share_objects: bool = False,
+    ) -> HandlerRet:
+        """Build a device in the warm container
+
+        Each work directory is keyed by source directory and make target, plus
+        the defines unless share_objects is set. Only share objects across
+        defines if the design's Makefile rebuilds when defines change.
+        """
+        await self.ensure_started()
+
+        src = (Path("/design") / dev_in.resolve().relative_to(self.design)).as_posix()
+        work_id = f"{src}\0{make_target}"
+        if not share_objects:
+            work_id += f"\0{' '.join(defines.split())}"
+        work_key = hashlib.sha256(work_id.encode()).hexdigest()[:16]
+        work_dir = f"/root/work/{work_key}"
+
+        build_id = uuid.uuid4().hex
+        host_stage = self.stage_dir / build_id
+        stage = f"/stage/{build_id}"
+        host_stage.mkdir(parents=True)
+
+        # Only copy sources newer than the work directory copy, so make sees
+        # unchanged files as up to date. Sources deleted since the last sync
+        # are removed, while make's outputs are left alone
+        sources = f"{work_dir}/{SOURCE_LIST}"
+        script = (
+            f"mkdir -p {work_dir}"
+            f" && (cd {shlex.quote(src)} && find . ! -type d | LC_ALL=C sort)"
+            f" > {sources}.new"
+            f" && if [ -f {sources} ]; then"
+            f" LC_ALL=C comm -23 {sources} {sources}.new"
+            f" | (cd {work_dir} && xargs -r -d '\\n' rm -f --); fi"
+            f" && mv {sources}.new {sources}"
+            f" && cp -rpu {shlex.quote(src)}/. {work_dir}/"
+            f" && cd {work_dir}"
+            f" && make {make_target}"
+            f" {defines}"
+            " SECRETS_DIR=/secrets"
+            f" BIN_PATH={stage}/{dev_name}.bin"
+            f" ELF_PATH={stage}/{dev_name}.elf"
+            f" EEPROM_PATH={stage}/{dev_name}.eeprom"
+        )
+
+        lock = self._work_locks.setdefault(work_key, asyncio.Lock())
+        try:
+            async with lock:
+                output = await exec_in_container(
+                    self.container_name,
+                    ["/bin/bash", "-c", script],
+                    logger=self.logger,
+                    stream=True,
+                )
+
+            for built in host_stage.iterdir():
+                shutil.move(str(built), str(dev_out / built.name))
+        finally:
+            shutil.rmtree(host_stage, ignore_errors=True)
+
+        return output
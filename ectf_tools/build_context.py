@@ -0,0 +1,181 @@
+# 2023 eCTF
+# Kyle Scaplen
+#
+# (c) 2023 The MITRE Corporation
+#
+# This source file is part of an example system for MITRE's 2023 Embedded
+# CTF (eCTF). This code is being provided only for educational purposes for the
+# 2023 MITRE eCTF competition, and may not meet MITRE standards for quality.
+# Use this code at your own risk!
+
+import hashlib
+import io
+import logging
+import os
+import re
+import stat
+import tarfile
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import docker
+import docker.errors
+from docker.utils.build import exclude_paths
+
+from ectf_tools.trace import record_span
+
+# Images are labelled with the hash of the context they were built from
+CONTEXT_LABEL = "ectf.context-hash"
+CONTEXT_CHUNK_SIZE = 1024 * 1024
+
+STEP_RE = re.compile(r"^Step (\d+)/(\d+) : ")
+
+
+class BuildContext:
+    """A Docker build context of a directory and a separate Dockerfile
+
+    Holds the same files docker.utils.tar would put in the context, so the
+    context can be hashed and then streamed to the daemon without building
+    the archive first
+    """
+
+    def __init__(self, build_dir: Path, dockerfile: str):
+        self.root = build_dir.resolve()
+        self.dockerfile = dockerfile.encode()
+        # Like docker.utils.tar, hide the Dockerfile from COPY instructions
+        self.extra_files = [
+            (".dockerignore", b".dockerignore\nDockerfile"),
+            ("Dockerfile", self.dockerfile),
+        ]
+        extra_names = {name for name, _ in self.extra_files}
+        self.files = [
+            path
+            for path in sorted(exclude_paths(str(self.root), [], "Dockerfile"))
+            if path not in extra_names
+        ]
+
+    def digest(self) -> str:
+        """Hash the names, modes, link targets and contents of the context"""
+        context_hash = hashlib.sha256()
+        for path in self.files:
+            full_path = self.root / path
+            st = os.lstat(full_path)
+            context_hash.update(f"{path}\0{st.st_mode:o}\0".encode())
+            if stat.S_ISLNK(st.st_mode):
+                context_hash.update(os.readlink(full_path).encode())
+            elif stat.S_ISREG(st.st_mode):
+                with open(full_path, "rb") as f:
+                    for chunk in iter(lambda: f.read(CONTEXT_CHUNK_SIZE), b""):
+                        context_hash.update(chunk)
+            context_hash.update(b"\0")
+        for name, contents in self.extra_files:
+            context_hash.update(name.encode() + b"\0" + contents + b"\0")
+        return context_hash.hexdigest()
+
+    def stream(self) -> Iterator[bytes]:
+        """Generate the context as a tar archive, a piece at a time
+
+        At most one file of the context is held in memory at once
+        """
+        buffer = io.BytesIO()
+        archive = tarfile.open(fileobj=buffer, mode="w|")
+
+        def drain() -> bytes:
+            data = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            return data
+
+        for path in self.files:
+            full_path = self.root / path
+            info = archive.gettarinfo(str(full_path), arcname=path)
+            if info is None:
+                # Sockets cannot be archived
+                continue
+            # Workaround https://bugs.python.org/issue32713
+            if info.mtime < 0 or info.mtime > 8**11 - 1:
+                info.mtime = int(info.mtime)
+
+            if info.isfile():
+                with open(full_path, "rb") as f:
+                    archive.addfile(info, f)
+            else:
+                archive.addfile(info)
+            yield drain()
+
+        for name, contents in self.extra_files:
+            info = tarfile.TarInfo(name)
+            info.size = len(contents)
+            archive.addfile(info, io.BytesIO(contents))
+        archive.close()
+        yield drain()
+
+
+def image_context_digest(client: docker.DockerClient, tag: str) -> Optional[str]:
+    """Get the context hash an image was built from, if it exists"""
+    try:
+        return client.images.get(tag).labels.get(CONTEXT_LABEL)
+    except docker.errors.ImageNotFound:
+        return None
+
+
+class BuildStep:
+    def __init__(self, number: int, total: int, instruction: str):
+        self.number = number
+        self.total = total
+        self.instruction = instruction
+        self.start = time.perf_counter()
+
+
+def follow_build(
+    tag: str, logs: Iterable[Dict[str, Any]], logger: logging.Logger
+) -> Tuple[str, List[Tuple[str, float]]]:
+    """Log a decoded Docker build log as it streams in
+
+    Returns the log text and the (instruction, seconds) of each build step.
+    Raises BuildError if the build fails
+    """
+    build_log = []
+    lines = []
+    steps = []
+    step = None
+
+    def finish_step():
+        end = time.perf_counter()
+        seconds = end - step.start
+        steps.append((step.instruction, round(seconds, 3)))
+        record_span(
+            "docker.build.step",
+            step.start,
+            end,
+            step=step.number,
+            instruction=step.instruction,
+        )
+        logger.info(f"{tag}: Step {step.number}/{step.total} took {seconds:.2f}s")
+
+    for chunk in logs:
+        build_log.append(chunk)
+        if "error" in chunk:
+            if step is not None:
+                finish_step()
+            raise docker.errors.BuildError(chunk["error"], build_log)
+
+        text = chunk.get("stream")
+        if not text:
+            continue
+        lines.append(text)
+        for line in text.splitlines():
+            match = STEP_RE.match(line)
+            if match:
+                if step is not None:
+                    finish_step()
+                instruction = line[match.end() :]
+                step = BuildStep(int(match[1]), int(match[2]), instruction)
+                logger.info(f"{tag}: {line}")
+            elif line.strip():
+                logger.debug(f"{tag}: {line}")
+
+    if step is not None:
+        finish_step()
+    return "".join(lines), steps
@@ -0,0 +1,149 @@
+# 2023 eCTF
+# Kyle Scaplen
+#
+# (c) 2023 The MITRE Corporation
+#
+# This source file is part of an example system for MITRE's 2023 Embedded
+# CTF (eCTF). This code is being provided only for educational purposes for the
+# 2023 MITRE eCTF competition, and may not meet MITRE standards for quality.
+# Use this code at your own risk!
+
+import os
+import struct
+import time
+from pathlib import Path
+from typing import Iterator, List, NamedTuple
+
+from ectf_tools.utils import CmdFailedError
+
+
+"""
+Bridge captures are binary files starting with a header:
+
+    magic (8 B) | session ID (8 B) | session start, Unix ns (u64)
+
+followed by one record per chunk of traffic:
+
+    ns since session start (u64) | direction (u8) | length (u32) | data
+
+all little-endian. Files are rotated by size like logging's
+RotatingFileHandler: capture.bin is the newest, capture.bin.1 the one
+before it, and so on. Every file of one capture session has the same session ID
+"""
+
+CAPTURE_MAGIC = b"ECTFCAP\x01"
+CAPTURE_HEADER = struct.Struct("<8s8sQ")
+CAPTURE_RECORD = struct.Struct("<QBI")
+CAPTURE_BUFFER_SIZE = 64 * 1024
+CAPTURE_MAX_BYTES = 64 * 1024 * 1024
+CAPTURE_BACKUPS = 3
+
+HOST_TO_SERIAL = 0
+SERIAL_TO_HOST = 1
+DIRECTIONS = {"host_to_serial": HOST_TO_SERIAL, "serial_to_host": SERIAL_TO_HOST}
+
+
+class CaptureRecord(NamedTuple):
+    ns: int  # since the session started
+    direction: int
+    data: bytes
+
+
+def backup_path(path: Path, n: int) -> Path:
+    return path.with_name(f"{path.name}.{n}")
+
+
+class CaptureWriter:
+    """Append bridged traffic to a capture file, rotating it by size
+
+    Writes are buffered, so records reach the file when the buffer fills, on
+    rotation, or when the writer is closed
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        max_bytes: int = CAPTURE_MAX_BYTES,
+        backups: int = CAPTURE_BACKUPS,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.session = os.urandom(8)
+        self.start_ns = time.monotonic_ns()
+        self.header = CAPTURE_HEADER.pack(CAPTURE_MAGIC, self.session, time.time_ns())
+
+        # Keep earlier sessions as backups instead of appending to them
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if self.path.exists() and self.path.stat().st_size:
+            self._rotate()
+        self._open()
+
+    def _open(self):
+        self.file = open(self.path, "wb", buffering=CAPTURE_BUFFER_SIZE)
+        self.file.write(self.header)
+        self.file.flush()
+        self.size = len(self.header)
+
+    def _rotate(self):
+        for n in range(self.backups - 1, 0, -1):
+            if backup_path(self.path, n).exists():
+                os.replace(backup_path(self.path, n), backup_path(self.path, n + 1))
+        if self.backups > 0:
+            os.replace(self.path, backup_path(self.path, 1))
+
+    def record(self, direction: int, data: bytes):
+        ns = time.monotonic_ns() - self.start_ns
+        if self.size + CAPTURE_RECORD.size + len(data) > self.max_bytes:
+            self.file.close()
+            self._rotate()
+            self._open()
+
+        self.file.write(CAPTURE_RECORD.pack(ns, direction, len(data)))
+        self.file.write(data)
+        self.size += CAPTURE_RECORD.size + len(data)
+
+    def close(self):
+        self.file.close()
+
+
+def read_header(path: Path) -> bytes:
+    """Get the session ID of a capture file"""
+    try:
+        with open(path, "rb") as f:
+            magic, session, _ = CAPTURE_HEADER.unpack(f.read(CAPTURE_HEADER.size))
+    except (OSError, struct.error) as e:
+        raise CmdFailedError(f"Could not read capture {path}: {e}")
+    if magic != CAPTURE_MAGIC:
+        raise CmdFailedError(f"{path} is not a bridge capture")
+    return session
+
+
+def capture_files(path: Path) -> List[Path]:
+    """Get the files of the newest capture session at path, oldest first"""
+    session = read_header(path)
+    files = [path]
+    n = 1
+    while backup_path(path, n).exists():
+        if read_header(backup_path(path, n)) != session:
+            break
+        files.insert(0, backup_path(path, n))
+        n += 1
+    return files
+
+
+def read_capture(path: Path) -> Iterator[CaptureRecord]:
+    """Iterate over the records of the newest capture session at path"""
+    for capture_file in capture_files(path):
+        with open(capture_file, "rb") as f:
+            f.seek(CAPTURE_HEADER.size)
+            while True:
+                header = f.read(CAPTURE_RECORD.size)
+                if len(header) < CAPTURE_RECORD.size:
+                    # A capture cut off mid-record ends at the last whole one
+                    break
+                ns, direction, length = CAPTURE_RECORD.unpack(header)
+                data = f.read(length)
+                if len(data) < length:
+                    break
+                yield CaptureRecord(ns, direction, data)
@@ -0,0 +1,280 @@
+# 2023 eCTF
+# Kyle Scaplen
+#
+# (c) 2023 The MITRE Corporation
+#
+# This source file is part of an example system for MITRE's 2023 Embedded
+# CTF (eCTF). This code is being provided only for educational purposes for the
+# 2023 MITRE eCTF competition, and may not meet MITRE standards for quality.
+# Use this code at your own risk!
+
+import asyncio
+import collections
+import functools
+import logging
+import threading
+import time
+from contextvars import ContextVar, copy_context
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+import docker
+import docker.errors
+
+from ectf_tools.trace import record_span, span
+from ectf_tools.utils import (
+    CmdFailedError,
+    get_logger,
+    HandlerRet,
+)
+
+
+Command = Union[str, List[str]]
+Volumes = Dict[str, Dict[str, str]]
+LineCallback = Callable[[str, bytes], None]
+
+STREAM_TAIL_LINES = 200
+
+_client: Optional[docker.DockerClient] = None
+_client_lock = threading.Lock()
+
+# Set to a list to collect the phase timings of every container run in the
+# current context, e.g. by the benchmark harness
+container_timings: ContextVar[Optional[List[Dict[str, float]]]] = ContextVar(
+    "container_timings", default=None
+)
+
+# Container phases, named by the marks they start and end at
+CONTAINER_PHASES = (
+    ("create", "begin", "created"),
+    ("start", "created", "started"),
+    ("run", "started", "exited"),
+    ("remove", "exited", "removed"),
+)
+
+
+def docker_client() -> docker.DockerClient:
+    """Get the Docker API client shared by every container operation"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = docker.from_env()
+        return _client
+
+
+def volume(source: str, bind: str, read_only: bool = False) -> Volumes:
+    return {str(source): {"bind": bind, "mode": "ro" if read_only else "rw"}}
+
+
+async def in_executor(func: Callable, *args, **kwargs):
+    # Run in a copy of the current context, so the thread sees its span
+    loop = asyncio.get_running_loop()
+    ctx = copy_context()
+    return await loop.run_in_executor(
+        None, functools.partial(ctx.run, func, *args, **kwargs)
+    )
+
+
+class OutputCollector:
+    """Collect command output, logging it at debug level, or as errors on failure
+
+    In streaming mode, output is split into lines that are logged as they
+    arrive, and only the last tail_lines lines of each stream are kept
+    """
+
+    def __init__(
+        self,
+        logger: logging.Logger,
+        stream: bool = False,
+        on_line: Optional[LineCallback] = None,
+        tail_lines: int = STREAM_TAIL_LINES,
+    ):
+        self.logger = logger
+        self.stream = stream or on_line is not None
+        self.on_line = on_line
+        self.tail_lines = tail_lines
+        maxlen = tail_lines if self.stream else None
+        self.lines = {
+            "stdout": collections.deque(maxlen=maxlen),
+            "stderr": collections.deque(maxlen=maxlen),
+        }
+        self.partial = {"stdout": b"", "stderr": b""}
+
+    def feed(self, stream_name: str, chunk: bytes):
+        if not self.stream:
+            self.lines[stream_name].append(chunk)
+            return
+
+        data = self.partial[stream_name] + chunk
+        *lines, self.partial[stream_name] = data.split(b"\n")
+        for line in lines:
+            self._line(stream_name, line + b"\n")
+
+    def _line(self, stream_name: str, line: bytes):
+        self.lines[stream_name].append(line)
+        text = line.decode(errors="backslashreplace").rstrip("\n")
+        self.logger.debug(f"{stream_name.upper()}: {text}")
+        if self.on_line is not None:
+            self.on_line(stream_name, line)
+
+    def finish(self, exit_code: int) -> HandlerRet:
+        for stream_name, partial in self.partial.items():
+            if partial:
+                self._line(stream_name, partial)
+                self.partial[stream_name] = b""
+
+        stdout_raw = b"".join(self.lines["stdout"])
+        stderr_raw = b"".join(self.lines["stderr"])
+        stdout = stdout_raw.decode(errors="backslashreplace")
+        stderr = stderr_raw.decode(errors="backslashreplace")
+        tail_msg = f" (last {self.tail_lines} lines)" if self.stream else ""
+        stdout_msg = f"STDOUT{tail_msg}:\n{stdout}" if stdout else "NO STDOUT"
+        stderr_msg = f"STDERR{tail_msg}:\n{stderr}" if stderr else "NO STDERR"
+        if exit_code:
+            self.logger.error(stdout_msg)
+            self.logger.error(stderr_msg)
+            raise CmdFailedError(
+                f"Tool build failed with return code {exit_code}", stdout, stderr
+            )
+        if not self.stream:
+            self.logger.debug(stdout_msg)
+            self.logger.debug(stderr_msg)
+        return [(stdout_raw, stderr_raw)]
+
+
+async def pump_output(
+    run: Callable[[Callable[[str, bytes], None]], int], collector: OutputCollector
+) -> HandlerRet:
+    """Run a blocking output producer in a thread, feeding the collector
+
+    run is called with a feed function for (stream name, chunk) pairs and
+    returns the exit code
+    """
+    loop = asyncio.get_running_loop()
+
+    def feed(stream_name: str, chunk: bytes):
+        loop.call_soon_threadsafe(collector.feed, stream_name, chunk)
+
+    exit_code = await in_executor(run, feed)
+    return collector.finish(exit_code)
+
+
+def feed_demuxed(
+    output: Iterable[Tuple[Optional[bytes], Optional[bytes]]],
+    feed: Callable[[str, bytes], None],
+):
+    for stdout_chunk, stderr_chunk in output:
+        if stdout_chunk:
+            feed("stdout", stdout_chunk)
+        if stderr_chunk:
+            feed("stderr", stderr_chunk)
+
+
+async def run_container(
+    tag: str,
+    command: Command,
+    volumes: Volumes = None,
+    workdir: str = None,
+    extra_hosts: Dict[str, str] = None,
+    logger: logging.Logger = None,
+    stream: bool = False,
+    on_line: Optional[LineCallback] = None,
+    tail_lines: int = STREAM_TAIL_LINES,
+) -> HandlerRet:
+    """
+    Run a command in a new container and remove it afterwards
+
+    Returns a 1-length list of (stdout, stderr) and raises CmdFailedError
+    with both streams on a non-zero exit. With stream set (or a line callback
+    given), output is logged as it arrives and only the last tail_lines lines
+    of each stream are returned
+    """
+    logger = logger or get_logger()
+    logger.debug(f"Running command {command!r} in {tag}")
+    client = docker_client()
+    marks = {"begin": time.perf_counter()}
+
+    try:
+        container = await in_executor(
+            client.containers.create,
+            tag,
+            command,
+            volumes=volumes or {},
+            working_dir=workdir,
+            extra_hosts=extra_hosts,
+        )
+    except docker.errors.DockerException as e:
+        raise CmdFailedError(f"Could not create container from {tag}: {e}")
+    marks["created"] = time.perf_counter()
+
+    def run(feed: Callable[[str, bytes], None]) -> int:
+        # Attach before starting so no output is missed
+        output = container.attach(
+            stdout=True, stderr=True, stream=True, logs=True, demux=True
+        )
+        container.start()
+        marks["started"] = time.perf_counter()
+        feed_demuxed(output, feed)
+        exit_code = container.wait()["StatusCode"]
+        marks["exited"] = time.perf_counter()
+        return exit_code
+
+    collector = OutputCollector(logger, stream, on_line, tail_lines)
+    try:
+        return await pump_output(run, collector)
+    except docker.errors.DockerException as e:
+        raise CmdFailedError(f"Container from {tag} failed: {e}")
+    finally:
+        try:
+            await in_executor(container.remove, force=True)
+        except docker.errors.DockerException as e:
+            logger.warning(f"Could not remove container {container.short_id}: {e}")
+        marks["removed"] = time.perf_counter()
+        record_timings(tag, marks)
+
+
+def record_timings(tag: str, marks: Dict[str, float]):
+    for phase, start, end in CONTAINER_PHASES:
+        if start in marks and end in marks:
+            record_span(f"container.{phase}", marks[start], marks[end], image=tag)
+
+    timings = container_timings.get()
+    if timings is None or "exited" not in marks:
+        return
+
+    timings.append(
+        {phase: marks[end] - marks[start] for phase, start, end in CONTAINER_PHASES}
+    )
+
+
+async def exec_in_container(
+    container_name: str,
+    command: Command,
+    workdir: str = None,
+    logger: logging.Logger = None,
+    stream: bool = False,
+    on_line: Optional[LineCallback] = None,
+    tail_lines: int = STREAM_TAIL_LINES,
+) -> HandlerRet:
+    """
+    Run a command in an existing container
+
+    Returns a 1-length list of (stdout, stderr) and raises CmdFailedError
+    with both streams on a non-zero exit. With stream set (or a line callback
+    given), output is logged as it arrives and only the last tail_lines lines
+    of each stream are returned
+    """
+    logger = logger or get_logger()
+    logger.debug(f"Running command {command!r} in {container_name}")
+    api = docker_client().api
+
+    def run(feed: Callable[[str, bytes], None]) -> int:
+        exec_id = api.exec_create(container_name, command, workdir=workdir)["Id"]
+        feed_demuxed(api.exec_start(exec_id, stream=True, demux=True), feed)
+        return api.exec_inspect(exec_id)["ExitCode"]
+
+    collector = OutputCollector(logger, stream, on_line, tail_lines)
+    try:
+        with span("container.exec", container=container_name):
+            return await pump_output(run, collector)
+    except docker.errors.DockerException as e:
+        raise CmdFailedError(f"Command in {container_name} failed: {e}")
@@ -0,0 +1,310 @@
+# 2023 eCTF
+# Kyle Scaplen
+#
+# (c) 2023 The MITRE Corporation
+#
+# This source file is part of an example system for MITRE's 2023 Embedded
+# CTF (eCTF). This code is being provided only for educational purposes for the
+# 2023 MITRE eCTF competition, and may not meet MITRE standards for quality.
+# Use this code at your own risk!
+
+import asyncio
+import contextlib
+import importlib
+import io
+import itertools
+import json
+import logging
+import os
+import sys
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from ectf_tools.utils import CmdFailedError, get_cache_dir, get_logger, HandlerRet
+from ectf_tools.subparsers import SubparserDaemonServe, subparsers
+from ectf_tools.trace import span, tracing
+
+
+"""
+Requests and responses are single lines of JSON. A request is
+{"cmd": ..., "argv": [...], "cwd": ..., "debug": ..., "trace": ...} with the
+command line arguments of the command and where to write its timing spans, and
+the daemon answers with any number of {"log": {"level": ..., "msg": ...}} and
+{"stdout": ...} lines, then {"done": true, "error": ...}
+"""
+
+DAEMON_STREAM_LIMIT = 1024 * 1024
+SERIAL_ARGS = ("dev_serial", "dev1_serial", "dev2_serial")
+
+# Where print() output of the handler serving a request goes
+request_stdout: ContextVar[Optional[Callable[[str], None]]] = ContextVar(
+    "request_stdout", default=None
+)
+
+
+def default_socket_path() -> Path:
+    return get_cache_dir() / "daemon.sock"
+
+
+class RequestStdout(io.TextIOBase):
+    """Send prints from request handlers to their clients
+
+    Prints from outside a request, or from threads that did not inherit the
+    request context, go to the daemon's own stdout
+    """
+
+    def __init__(self, stdout: io.TextIOBase):
+        self.stdout = stdout
+
+    def write(self, text: str) -> int:
+        send = request_stdout.get()
+        if send is None:
+            return self.stdout.write(text)
+        send(text)
+        return len(text)
+
+    def flush(self):
+        self.stdout.flush()
+
+
+class ClientLogHandler(logging.Handler):
+    """Forward log records of a request to its client"""
+
+    def __init__(self, send: Callable[[Dict[str, Any]], None]):
+        super().__init__()
+        self.send = send
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self.send({"log": {"level": record.levelno, "msg": self.format(record)}})
+        except Exception:
+            self.handleError(record)
+
+
+def real_serial(dev_serial: str) -> str:
+    # Ports may be reached through symlinks, e.g. /dev/serial/by-id
+    return f"serial:{os.path.realpath(dev_serial)}"
+
+
+def request_resources(kwargs: Dict[str, Any]) -> List[str]:
+    """Get the serial ports and bridge sockets a command will use"""
+    from ectf_tools.device import load_bridge_map, load_flash_map, load_pair_map
+
+    resources = set()
+    for arg in SERIAL_ARGS:
+        if kwargs.get(arg) is not None:
+            resources.add(real_serial(kwargs[arg]))
+    if kwargs.get("bridge_id") is not None:
+        resources.add(f"bridge:{kwargs['bridge_id']}")
+
+    # Leave invalid maps for the handler to report
+    try:
+        if kwargs.get("flash_map") is not None:
+            resources.update(map(real_serial, load_flash_map(kwargs["flash_map"])))
+        if kwargs.get("bridge_map") is not None:
+            for bridge_id, dev_serial in load_bridge_map(kwargs["bridge_map"]).items():
+                resources.add(f"bridge:{bridge_id}")
+                resources.add(real_serial(dev_serial))
+        if kwargs.get("pair_map") is not None:
+            for pair in load_pair_map(kwargs["pair_map"]):
+                resources.update(map(real_serial, pair))
+    except CmdFailedError:
+        pass
+
+    # A fixed order keeps requests sharing resources from deadlocking
+    return sorted(resources)
+
+
+class Daemon:
+    """Run commands for clients, keeping loaded modules and clients warm
+
+    Requests run concurrently, except that requests using the same serial
+    port or bridge socket run one at a time
+    """
+
+    def __init__(self, socket_path: Path, logger: logging.Logger):
+        self.socket_path = socket_path
+        self.logger = logger
+        self.locks: Dict[str, asyncio.Lock] = {}
+        self.request_ids = itertools.count(1)
+
+    def parse_request(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        cmd = request.get("cmd")
+        if cmd not in subparsers or cmd == "daemon.serve":
+            raise CmdFailedError(f"Unknown command {cmd!r}")
+
+        try:
+            args = subparsers[cmd](underscores_to_dashes=True).parse_args(
+                [str(arg) for arg in request.get("argv", [])]
+            )
+        except SystemExit:
+            raise CmdFailedError(f"Invalid arguments for {cmd}")
+
+        # Relative paths are relative to the client
+        cwd = Path(request.get("cwd", "."))
+        kwargs = args.as_dict()
+        for key, value in kwargs.items():
+            if isinstance(value, Path) and not value.is_absolute():
+                kwargs[key] = cwd / value
+        return kwargs
+
+    async def run_request(
+        self,
+        request: Dict[str, Any],
+        send: Callable[[Dict[str, Any]], None],
+    ):
+        request_id = next(self.request_ids)
+        kwargs = self.parse_request(request)
+        package, func = request["cmd"].split(".")
+        handler = getattr(importlib.import_module(f"ectf_tools.{package}"), func)
+
+        # A logger per request that is not registered with logging, so it is
+        # freed with the request. Records still reach the daemon's log
+        logger = logging.Logger(f"{get_logger().name}.{request_id}")
+        logger.parent = get_logger()
+        logger.setLevel(logging.DEBUG if request.get("debug") else logging.INFO)
+        logger.addHandler(ClientLogHandler(send))
+
+        async with contextlib.AsyncExitStack() as stack:
+            for resource in request_resources(kwargs):
+                lock = self.locks.setdefault(resource, asyncio.Lock())
+                if lock.locked():
+                    logger.info(f"Waiting for {resource}")
+                await stack.enter_async_context(lock)
+
+            self.logger.info(f"Request {request_id}: {request['cmd']}")
+            request_stdout.set(lambda text: send({"stdout": text}))
+            trace = request.get("trace")
+            with tracing(trace and Path(trace)), span(request["cmd"]):
+                await handler(**kwargs, logger=logger)
+
+    async def handle_client(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        loop = asyncio.get_running_loop()
+
+        def send(msg: Dict[str, Any]):
+            # Handlers may log from executor threads
+            data = json.dumps(msg).encode() + b"\n"
+            loop.call_soon_threadsafe(writer.write, data)
+
+        try:
+            line = await reader.readline()
+            request = json.loads(line)
+        except (ValueError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+
+        # Cancel the request if the client goes away, e.g. on Ctrl-C
+        run = asyncio.ensure_future(self.run_request(request, send))
+        disconnect = asyncio.ensure_future(reader.read())
+        await asyncio.wait([run, disconnect], return_when=asyncio.FIRST_COMPLETED)
+
+        error = None
+        if not run.done():
+            self.logger.info(f"Client went away, cancelling {request.get('cmd')}")
+            run.cancel()
+        disconnect.cancel()
+        await asyncio.gather(run, disconnect, return_exceptions=True)
+        if not run.cancelled() and run.exception() is not None:
+            e = run.exception()
+            error = e.args[0] if isinstance(e, CmdFailedError) else repr(e)
+
+        try:
+            send({"done": True, "error": error})
+            await asyncio.sleep(0)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def check_stale_socket(self):
+        if not self.socket_path.exists():
+            return
+        try:
+            _, writer = await asyncio.open_unix_connection(str(self.socket_path))
+        except OSError:
+            self.socket_path.unlink()
+            return
+        writer.close()
+        raise CmdFailedError(f"A daemon is already listening on {self.socket_path}")
+
+    async def run(self):
+        self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+        await self.check_stale_socket()
+        server = await asyncio.start_unix_server(
+            self.handle_client, str(self.socket_path), limit=DAEMON_STREAM_LIMIT
+        )
+        self.logger.info(f"Daemon listening on {self.socket_path}")
+        try:
+            await server.serve_forever()
+        finally:
+            server.close()
+            await server.wait_closed()
+            self.socket_path.unlink()
+
+
+async def serve(
+    socket_path: Optional[Path] = SubparserDaemonServe.socket_path,
+    logger: logging.Logger = None,
+) -> HandlerRet:
+    logger = logger or get_logger()
+    socket_path = socket_path or default_socket_path()
+
+    stdout = sys.stdout
+    sys.stdout = RequestStdout(stdout)
+    try:
+        await Daemon(socket_path, logger).run()
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        logger.info("Shutting down daemon")
+    finally:
+        sys.stdout = stdout
+
+    return b"", b""
+
+
+async def call(
+    cmd: str,
+    argv: List[str],
+    socket_path: Optional[Path] = None,
+    debug: bool = False,
+    trace: Optional[Path] = None,
+    logger: logging.Logger = None,
+):
+    """Run a command in the daemon, relaying its logs and output"""
+    logger = logger or get_logger()
+    socket_path = socket_path or default_socket_path()
+
+    try:
+        reader, writer = await asyncio.open_unix_connection(
+            str(socket_path), limit=DAEMON_STREAM_LIMIT
+        )
+    except OSError as e:
+        raise CmdFailedError(f"Could not connect to daemon on {socket_path}: {e}")
+
+    request = {
+        "cmd": cmd,
+        "argv": argv,
+        "cwd": os.getcwd(),
+        "debug": debug,
+        "trace": trace and str(trace.resolve()),
+    }
+    writer.write(json.dumps(request).encode() + b"\n")
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise CmdFailedError("Daemon closed the connection")
+            msg = json.loads(line)
+            if "log" in msg:
+                logger.log(msg["log"]["level"], msg["log"]["msg"])
+            elif "stdout" in msg:
+                print(msg["stdout"], end="", flush=True)
+            elif msg.get("done"):
+                if msg["error"] is not None:
+                    raise CmdFailedError(msg["error"])
+                return
+    finally:
+        writer.close()
@@ -9,44 +9,85 @@
 # Use this code at your own risk!
 
 import asyncio
+import collections
+import contextlib
+import json
 import logging
+import mmap
+import os
+import re
 import socket
 import select
+import time
 from enum import Enum
 from pathlib import Path
-from rich.progress import Progress
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Awaitable,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
 
 from serial import Serial
-from serial.tools import list_ports
 from serial.serialutil import SerialException
 
-from ectf_tools.utils import CmdFailedError, get_logger, HandlerRet, SOCKET_BASE
-
-
-"""
-Device Image Sizes
-"""
-
-BLOCK_SIZE = 16
-PAGE_SIZE = 1024
-
-FLASH_PAGES = 256
-FLASH_SIZE = FLASH_PAGES * PAGE_SIZE
-EEPROM_PAGES = 2
-EEPROM_SIZE = EEPROM_PAGES * PAGE_SIZE
-
-FW_FLASH_PAGES = 110
-FW_FLASH_SIZE = FW_FLASH_PAGES * PAGE_SIZE
-FW_FLASH_BLOCKS = FW_FLASH_SIZE // BLOCK_SIZE
-
-FW_EEPROM_PAGES = 2
-FW_EEPROM_SIZE = FW_EEPROM_PAGES * PAGE_SIZE
-FW_EEPROM_BLOCKS = FW_EEPROM_SIZE // BLOCK_SIZE
-
-TOTAL_FW_SIZE = FW_FLASH_SIZE + FW_EEPROM_SIZE
-TOTAL_FW_PAGES = FW_FLASH_PAGES + FW_EEPROM_PAGES
-TOTAL_FW_BLOCKS = FW_FLASH_BLOCKS + FW_EEPROM_BLOCKS
+from ectf_tools.utils import (
+    CmdFailedError,
+    get_cache_dir,
+    get_logger,
+    HandlerRet,
+    percentile,
+    SOCKET_BASE,
+)
+from ectf_tools.image import (  # noqa: F401 (layout constants used to live here)
+    BLOCK_SIZE,
+    PAGE_SIZE,
+    FLASH_PAGES,
+    FLASH_SIZE,
+    EEPROM_PAGES,
+    EEPROM_SIZE,
+    FW_FLASH_PAGES,
+    FW_FLASH_SIZE,
+    FW_FLASH_BLOCKS,
+    FW_EEPROM_PAGES,
+    FW_EEPROM_SIZE,
+    FW_EEPROM_BLOCKS,
+    TOTAL_FW_SIZE,
+    TOTAL_FW_PAGES,
+    TOTAL_FW_BLOCKS,
+    FirmwareImage,
+)
+from ectf_tools.capture import (
+    CaptureWriter,
+    DIRECTIONS,
+    HOST_TO_SERIAL,
+    read_capture,
+    SERIAL_TO_HOST,
+)
+from ectf_tools.ports import identify_port, PortWatcher, SerialPortInfo
+from ectf_tools.trace import span
+from ectf_tools.subparsers import (
+    SubparserDevBridge,
+    SubparserDevBridges,
+    SubparserDevLoadHW,
+    SubparserDevLoadHWMany,
+    SubparserDevLoadSecHW,
+    SubparserDevModeChange,
+    SubparserDevModeChangeMany,
+    SubparserDevReplay,
+    SubparserDevWatch,
+)
+
+# rich is only needed by the load commands, so it is imported where used to
+# keep the other commands quick to start
+if TYPE_CHECKING:
+    from rich.progress import Progress, TaskID
 
 
 class BootloaderResponseCode(Enum):
@@ -71,159 +112,574 @@ secure_bl_mode_change_success_codes = list(range(0, 8))
 secure_bl_mode_change_error_codes = list(range(8, 9))
 SECURE_BL_MODE_CHANGE_COMMAND = b"\x00"
 
+# Response classes, looked up by code in the tables below
+RESP_INVALID = 0
+RESP_OK = 1
+RESP_ERROR = 2
+
+
+def code_table(success_codes: List[int], error_codes: List[int]) -> bytes:
+    table = bytearray(256)
+    for code in success_codes:
+        table[code] = RESP_OK
+    for code in error_codes:
+        table[code] = RESP_ERROR
+    return bytes(table)
+
+
+SECURE_BL_CODE_TABLE = code_table(secure_bl_success_codes, secure_bl_error_codes)
+SECURE_BL_MODE_CHANGE_CODE_TABLE = code_table(
+    secure_bl_mode_change_success_codes, secure_bl_mode_change_error_codes
+)
+
+LATENCY_PERCENTILES = (50, 95, 99)
+
+
+def get_serial_port(timeout: Optional[float] = None) -> Optional[str]:
+    """Wait for a serial port to be plugged in, returning its device
+
+    If several are plugged in at once, the first by name is returned
+    """
+    with PortWatcher() as watcher:
+        new_ports = watcher.wait_for_new_ports(timeout)
+    return new_ports[0] if new_ports else None
+
+
+class ResponseReader:
+    """Read bootloader response codes from a serial port
+
+    Each read takes everything the port has buffered, and waits for more only
+    until the deadline of the current phase. The time from each expect() to
+    the response answering it is recorded per phase, for diagnostics.
+    """
+
+    def __init__(self, ser: Serial):
+        self.ser = ser
+        self.selectable = hasattr(ser, "fileno")
+        self.buf = b""
+        self.pos = 0
+        self.phase = "response"
+        self.sent_at: Deque[float] = collections.deque()
+        self.latencies: Dict[str, List[float]] = collections.defaultdict(list)
+
+    def expect(self, phase: str, count: int = 1):
+        """Start timing the next count responses, e.g. after sending blocks"""
+        self.phase = phase
+        now = time.perf_counter()
+        self.sent_at.extend(now for _ in range(count))
+
+    def read(self, deadline: float, what: str) -> int:
+        """Get the next code, raising CmdFailedError at the deadline"""
+        while self.pos == len(self.buf):
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise CmdFailedError(f"Timed out waiting for {what}")
+            self.buf = self._read_waiting(remaining)
+            self.pos = 0
+
+        code = self.buf[self.pos]
+        self.pos += 1
+        if self.sent_at:
+            self.latencies[self.phase].append(
+                time.perf_counter() - self.sent_at.popleft()
+            )
+        return code
+
+    def _read_waiting(self, timeout: float) -> bytes:
+        # Setting ser.timeout reconfigures the port with tcsetattr, so wait
+        # with select instead where the port has a file descriptor
+        if not self.selectable:
+            self.ser.timeout = timeout
+            return self.ser.read(max(1, self.ser.in_waiting))
+
+        waiting = self.ser.in_waiting
+        if not waiting:
+            if not select.select([self.ser], [], [], timeout)[0]:
+                return b""
+            # Readable with nothing waiting means the port went away, which
+            # read reports
+            waiting = max(1, self.ser.in_waiting)
+        return self.ser.read(waiting)
+
+    def read_valid(self, table: bytes, deadline: float, what: str) -> int:
+        """Get the next code the table knows, skipping anything else"""
+        code = self.read(deadline, what)
+        while table[code] == RESP_INVALID:
+            code = self.read(deadline, what)
+        return code
+
+    def latency_summary(self) -> Dict[str, Dict[str, float]]:
+        """Response latencies of each phase, in milliseconds"""
+        summary = {}
+        for phase, latencies in self.latencies.items():
+            stats = {
+                f"p{pct}": percentile(latencies, pct) for pct in LATENCY_PERCENTILES
+            }
+            stats["max"] = max(latencies)
+            summary[phase] = {
+                "count": len(latencies),
+                **{key: round(value * 1000, 3) for key, value in stats.items()},
+            }
+        return summary
+
+
+def verify_resp(
+    reader: ResponseReader,
+    expected: BootloaderResponseCode,
+    deadline: float,
+):
+    resp = reader.read(deadline, f"{expected.name} response")
+    assert resp == expected.value[0]
 
-def get_serial_port():
-    orig_ports = set(list_ports.comports())
-    while True:
-        ports = set(list_ports.comports())
-        new_ports = ports - orig_ports
-
-        if len(new_ports) == 1:
-            new_port = new_ports.pop()
-            return new_port.device
 
-        orig_ports = ports
+def verify_sec_resp(
+    reader: ResponseReader,
+    deadline: float,
+    print_out: bool = True,
+    logger: logging.Logger = None,
+):
+    resp = reader.read_valid(SECURE_BL_CODE_TABLE, deadline, "bootloader response")
 
+    logger = logger or get_logger()
 
-def verify_resp(ser: Serial, expected: BootloaderResponseCode):
-    resp = ser.read(1)
-    while resp == b"":
-        resp = ser.read(1)
+    if SECURE_BL_CODE_TABLE[resp] != RESP_OK:
+        logger.error(f"Bootloader responded with: {resp}")
+        raise ValueError()
+    if print_out:
+        logger.info(f"Success. Bootloader responded with code {resp}")
 
-    assert BootloaderResponseCode(resp) == expected
+    return resp
 
 
-def verify_sec_resp(ser: Serial, print_out: bool = True, logger: logging.Logger = None):
-    resp = ser.read(1)
-    while (resp == b"") or (
-        not ord(resp) in (secure_bl_success_codes + secure_bl_error_codes)
-    ):
-        resp = ser.read(1)
+def verify_mode_change_resp(
+    reader: ResponseReader,
+    dev_num: int,
+    deadline: float,
+    print_out: bool = True,
+    logger: logging.Logger = None,
+):
+    resp = reader.read_valid(
+        SECURE_BL_MODE_CHANGE_CODE_TABLE,
+        deadline,
+        f"bootloader {dev_num} response",
+    )
 
     logger = logger or get_logger()
 
-    if ord(resp) not in secure_bl_success_codes:
-        logger.error(f"Bootloader responded with: {ord(resp)}")
+    if SECURE_BL_MODE_CHANGE_CODE_TABLE[resp] != RESP_OK:
+        logger.error(f"Bootloader {dev_num} responded with: {resp}")
         raise ValueError()
     if print_out:
-        logger.info(f"Success. Bootloader responded with code {ord(resp)}")
+        logger.info(f"Success. Bootloader {dev_num} responded with code {resp}")
 
-    return ord(resp)
+    return resp
 
 
-def verify_mode_change_resp(
-    ser: Serial, dev_num: int, print_out: bool = True, logger: logging.Logger = None
+def flash_record_path(identity: str) -> Path:
+    board_key = re.sub(r"[^A-Za-z0-9_.-]", "_", identity).strip("_")
+    return get_cache_dir() / "flash_records" / f"{board_key}.json"
+
+
+def load_flash_record(identity: str) -> Optional[List[str]]:
+    """Get the page hashes of the image last flashed onto a board"""
+    try:
+        record = json.loads(flash_record_path(identity).read_text())
+    except (OSError, ValueError):
+        return None
+
+    if record.get("page_size") != PAGE_SIZE or record.get("identity") != identity:
+        return None
+    return record.get("pages")
+
+
+def clear_flash_record(identity: str):
+    # The bootloader erases the board as soon as an update starts, so the
+    # record is stale until the new image is installed
+    record_path = flash_record_path(identity)
+    try:
+        record_path.unlink()
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        raise CmdFailedError(f"Could not clear flash record {record_path}: {e}")
+
+
+def save_flash_record(
+    identity: str, dev_serial: str, image_path: Path, fw: FirmwareImage
 ):
-    resp = ser.read(1)
-    while (resp == b"") or (
-        not ord(resp)
-        in (secure_bl_mode_change_success_codes + secure_bl_mode_change_error_codes)
-    ):
-        resp = ser.read(1)
+    record_path = flash_record_path(identity)
+    record = {
+        "identity": identity,
+        "serial": dev_serial,
+        "image": str(image_path.resolve()),
+        "page_size": PAGE_SIZE,
+        "pages": fw.page_hashes(),
+    }
+    try:
+        record_path.parent.mkdir(parents=True, exist_ok=True)
+        record_path.write_text(json.dumps(record))
+    except OSError as e:
+        get_logger().warning(f"Could not save flash record {record_path}: {e}")
+
+
+def changed_pages(fw: FirmwareImage, last_pages: Optional[List[str]]) -> List[int]:
+    """Get the pages of an image that differ from the last flashed image"""
+    pages = fw.page_hashes()
+    if last_pages is None or len(last_pages) != len(pages):
+        return list(range(len(pages)))
+    return [i for i, (new, old) in enumerate(zip(pages, last_pages)) if new != old]
+
+
+def format_pages(pages: List[int]) -> str:
+    # Collapse runs of pages into ranges, e.g. "0-3, 7, 110-111"
+    ranges = []
+    for page in pages:
+        if ranges and ranges[-1][1] == page - 1:
+            ranges[-1][1] = page
+        else:
+            ranges.append([page, page])
+    return ", ".join(f"{a}-{b}" if a != b else f"{a}" for a, b in ranges)
+
+
+class DeviceLogAdapter(logging.LoggerAdapter):
+    """Prefix log messages with the device they refer to"""
+
+    def process(self, msg, kwargs):
+        return f"{self.extra['device']}: {msg}", kwargs
+
+
+def install_hw(
+    fw: FirmwareImage,
+    dev_serial: str,
+    window: int,
+    erase_timeout: float,
+    ack_timeout: float,
+    logger: logging.Logger,
+    progress: "Progress",
+    task: "TaskID",
+) -> Dict[str, Dict[str, float]]:
+    """Install an opened image through the bootloader, reporting to a progress
+    task
+
+    Blocks until the install finishes, so run it in an executor. Returns the
+    response latencies of each phase
+    """
+    identity = identify_port(dev_serial)
+    with span("device.install", device=dev_serial):
+        clear_flash_record(identity)
+        latencies = send_image(
+            fw, dev_serial, window, erase_timeout, ack_timeout, logger, progress, task
+        )
+        # Only reached once the bootloader reported AppInstallOK
+        save_flash_record(identity, dev_serial, fw.path, fw)
+    logger.info("Image Installed")
+    return latencies
+
+
+def send_image(
+    fw: FirmwareImage,
+    dev_serial: str,
+    window: int,
+    erase_timeout: float,
+    ack_timeout: float,
+    logger: logging.Logger,
+    progress: "Progress",
+    task: "TaskID",
+) -> Dict[str, Dict[str, float]]:
+    # Try to connect to the serial port
+    logger.info(f"Connecting to serial port {dev_serial}...")
+    with span("serial.connect"):
+        ser = Serial(dev_serial, 115200, timeout=ack_timeout)
+        ser.reset_input_buffer()
+    logger.info(f"Connection opened on {dev_serial}")
+    reader = ResponseReader(ser)
 
-    logger = logger or get_logger()
+    try:
+        # Wait for bootloader ready
+        logger.info("Requesting update...")
+        ser.write(BootloaderResponseCode.RequestUpdate.value)
+        reader.expect("request")
+        try:
+            with span("bootloader.request"):
+                deadline = time.perf_counter() + erase_timeout
+                verify_resp(reader, BootloaderResponseCode.StartUpdate, deadline)
+        except AssertionError:
+            raise CmdFailedError("Bootloader did not start an update")
 
-    if ord(resp) not in secure_bl_mode_change_success_codes:
-        logger.error(f"Bootloader {dev_num} responded with: {ord(resp)}")
-        raise ValueError()
-    if print_out:
-        logger.info(f"Success. Bootloader {dev_num} responded with code {ord(resp)}")
+        # Wait for Flash erase
+        logger.info("Waiting for Flash Erase...")
+        reader.expect("erase")
+        try:
+            with span("erase.flash"):
+                deadline = time.perf_counter() + erase_timeout
+                verify_resp(
+                    reader, BootloaderResponseCode.UpdateInitFlashEraseOK, deadline
+                )
+        except AssertionError:
+            raise CmdFailedError("Error while erasing Flash")
+
+        # Wait for EEPROM erase
+        logger.info("Waiting for EEPROM Erase...")
+        reader.expect("erase")
+        try:
+            with span("erase.eeprom"):
+                deadline = time.perf_counter() + erase_timeout
+                verify_resp(
+                    reader, BootloaderResponseCode.UpdateInitEEPROMEraseOK, deadline
+                )
+        except AssertionError:
+            raise CmdFailedError("Error while erasing EEPROM")
+
+        # Send data in 16-byte blocks, keeping up to `window` blocks in flight.
+        # ACKs arrive in block order, so the first bad ACK identifies the block
+        logger.info("Sending firmware...")
+        total_blocks = TOTAL_FW_BLOCKS
+        sent_blocks = 0
+        block_count = 0
+        progress.start_task(task)
+        with span("transfer", blocks=total_blocks, window=window):
+            while block_count < total_blocks:
+                if sent_blocks - block_count < window:
+                    send_to = min(block_count + window, total_blocks)
+                    ser.write(fw.blocks(sent_blocks, send_to))
+                    reader.expect("block", send_to - sent_blocks)
+                    sent_blocks = send_to
+
+                try:
+                    deadline = time.perf_counter() + ack_timeout
+                    if block_count < FW_FLASH_BLOCKS:
+                        verify_resp(
+                            reader, BootloaderResponseCode.AppBlockInstallOK, deadline
+                        )
+                    else:
+                        verify_resp(
+                            reader,
+                            BootloaderResponseCode.EEPROMBlockInstallOK,
+                            deadline,
+                        )
+                except AssertionError:
+                    raise CmdFailedError(f"Install failed at block {block_count+1}")
+
+                block_count += 1
+                progress.update(task, advance=BLOCK_SIZE)
+
+        reader.expect("install")
+        try:
+            with span("final_ack"):
+                deadline = time.perf_counter() + erase_timeout
+                verify_resp(reader, BootloaderResponseCode.AppInstallOK, deadline)
+        except AssertionError:
+            raise CmdFailedError("Image Failed to Install")
+    finally:
+        ser.close()
 
-    return ord(resp)
+    latencies = reader.latency_summary()
+    for phase, stats in latencies.items():
+        logger.debug(f"{phase} response latency [ms]: {stats}")
+    return latencies
 
 
 async def load_hw(
-    dev_in: Path, dev_name: str, dev_serial: str, logger: logging.Logger = None,
+    dev_in: Path,
+    dev_name: str,
+    dev_serial: str,
+    window: int = SubparserDevLoadHW.window,
+    delta: bool = SubparserDevLoadHW.delta,
+    dry_run: bool = SubparserDevLoadHW.dry_run,
+    erase_timeout: float = SubparserDevLoadHW.erase_timeout,
+    ack_timeout: float = SubparserDevLoadHW.ack_timeout,
+    logger: logging.Logger = None,
 ) -> HandlerRet:
+    from rich.progress import Progress
+
     # Usage: Turn on the device holding SW2, then start this script
 
     logger = logger or get_logger()
 
+    if window < 1:
+        raise CmdFailedError(f"Invalid window size {window}. Expected at least 1")
+
     # Set up file references
     image_path = dev_in / f"{dev_name}.img"
 
-    # Try to connect to the serial port
-    logger.info(f"Connecting to serial port {dev_serial}...")
-    ser = Serial(dev_serial, 115200, timeout=2)
-    ser.reset_input_buffer()
-    logger.info(f"Connection opened on {dev_serial}")
-
-    # Open firmware
+    # Open firmware, so an invalid image fails before the transfer starts
     logger.info("Reading image file...")
-    if not image_path.exists():
-        ser.close()
-        raise CmdFailedError(f"Image file {image_path} not found")
+    with FirmwareImage.open(image_path) as fw:
+        # Compare against the image last flashed onto the board on this port
+        if delta or dry_run:
+            last_pages = load_flash_record(identify_port(dev_serial))
+            pages = changed_pages(fw, last_pages)
+            saved_bytes = (TOTAL_FW_PAGES - len(pages)) * PAGE_SIZE
+            if last_pages is None:
+                logger.info(f"No record of a previous image flashed on {dev_serial}")
+            elif pages:
+                logger.info(
+                    f"{len(pages)}/{TOTAL_FW_PAGES} pages differ from the last"
+                    f" flashed image: {format_pages(pages)}"
+                )
+            else:
+                logger.info("Image is unchanged since the last flash")
+            logger.info(f"A delta update would skip {saved_bytes} bytes")
+
+            if dry_run:
+                return b"", b""
+
+            if not pages:
+                logger.info("Skipping install")
+                return b"", b""
+
+            # The bootloader erases all of flash when an update starts, so a
+            # changed image has to be sent in full
+            if last_pages is not None:
+                logger.info("Bootloader does not support partial updates")
+
+        loop = asyncio.get_running_loop()
+        with Progress() as progress:
+            task = progress.add_task(
+                "Sending firmware...", total=TOTAL_FW_SIZE, start=False
+            )
+            # Run in a copy of the current context, so the thread sees its span
+            latencies = await loop.run_in_executor(
+                None,
+                copy_context().run,
+                install_hw,
+                fw,
+                dev_serial,
+                window,
+                erase_timeout,
+                ack_timeout,
+                logger,
+                progress,
+                task,
+            )
+
+    return json.dumps(latencies).encode(), b""
+
+
+def load_flash_map(flash_map: Path) -> Dict[str, Path]:
+    """Load a JSON object mapping serial ports to image files, relative to the
+    map's directory"""
+    try:
+        raw_map = json.loads(flash_map.read_text())
+    except (OSError, ValueError) as e:
+        raise CmdFailedError(f"Could not read flash map {flash_map}: {e}")
+
+    if not isinstance(raw_map, dict) or not raw_map:
+        raise CmdFailedError(f"Flash map {flash_map} must be a non-empty object")
+
+    # Images are relative to the map, like board maps
+    return {
+        str(dev_serial): flash_map.parent / image
+        for dev_serial, image in raw_map.items()
+    }
+
+
+async def load_hw_many(
+    flash_map: Path,
+    window: int = SubparserDevLoadHWMany.window,
+    jobs: int = SubparserDevLoadHWMany.jobs,
+    erase_timeout: float = SubparserDevLoadHWMany.erase_timeout,
+    ack_timeout: float = SubparserDevLoadHWMany.ack_timeout,
+    logger: logging.Logger = None,
+) -> HandlerRet:
+    from rich.progress import Progress
 
-    fw_data = image_path.read_bytes()
-    fw_size = len(fw_data)
-    if fw_size != TOTAL_FW_SIZE:
-        ser.close()
-        raise CmdFailedError(
-            f"Invalid image size 0x{fw_size:X}. Expected 0x{TOTAL_FW_SIZE:X}"
-        )
+    # Usage: Turn on every device holding SW2, then start this script
 
-    # Wait for bootloader ready
-    logger.info("Requesting update...")
-    ser.write(BootloaderResponseCode.RequestUpdate.value)
-    try:
-        verify_resp(ser, BootloaderResponseCode.StartUpdate)
-    except AssertionError:
-        ser.close()
-        raise CmdFailedError("Bootloader did not start an update")
+    logger = logger or get_logger()
 
-    # Wait for Flash erase
-    logger.info("Waiting for Flash Erase...")
-    try:
-        verify_resp(ser, BootloaderResponseCode.UpdateInitFlashEraseOK)
-    except AssertionError:
-        ser.close()
-        raise CmdFailedError("Error while erasing Flash")
+    if window < 1:
+        raise CmdFailedError(f"Invalid window size {window}. Expected at least 1")
 
-    # Wait for EEPROM erase
-    logger.info("Waiting for EEPROM Erase...")
-    try:
-        verify_resp(ser, BootloaderResponseCode.UpdateInitEEPROMEraseOK)
-    except AssertionError:
-        ser.close()
-        raise CmdFailedError("Error while erasing EEPROM")
-
-    # Send data in 16-byte blocks
-    logger.info("Sending firmware...")
-    total_bytes = len(fw_data)
-    block_count = 0
-    i = 0
-    with Progress() as progress:
-        task = progress.add_task("Sending firmware...", total=total_bytes)
-        while i < total_bytes:
-            block_bytes = fw_data[i : i + BLOCK_SIZE]  # noqa
-            ser.write(block_bytes)
+    devices = load_flash_map(flash_map)
+    jobs = jobs if jobs > 0 else len(devices)
+
+    loop = asyncio.get_running_loop()
+    results = {}
 
+    async def flash(dev_serial: str, fw: FirmwareImage, progress: "Progress"):
+        task = progress.add_task(dev_serial, total=TOTAL_FW_SIZE, start=False)
+        dev_logger = DeviceLogAdapter(logger, {"device": dev_serial})
+        start = time.perf_counter()
+        latencies = None
+        try:
+            latencies = await loop.run_in_executor(
+                executor,
+                copy_context().run,
+                install_hw,
+                fw,
+                dev_serial,
+                window,
+                erase_timeout,
+                ack_timeout,
+                dev_logger,
+                progress,
+                task,
+            )
+            error = None
+        except Exception as e:
+            # Isolate failures so the rest of the fleet still gets flashed
+            error = str(e) or repr(e)
+            dev_logger.error(f"Install failed: {error}")
+            progress.update(task, description=f"{dev_serial} [red]failed")
+        results[dev_serial] = {
+            "image": str(fw.path),
+            "seconds": round(time.perf_counter() - start, 3),
+            "error": error,
+            "latency_ms": latencies,
+        }
+
+    with contextlib.ExitStack() as images:
+        # Open every image before flashing anything, so invalid ones fail early
+        fws = {}
+        invalid = []
+        for dev_serial, image_path in devices.items():
             try:
-                if block_count < FW_FLASH_BLOCKS:
-                    verify_resp(ser, BootloaderResponseCode.AppBlockInstallOK)
-                else:
-                    verify_resp(ser, BootloaderResponseCode.EEPROMBlockInstallOK)
-            except AssertionError:
-                ser.close()
-                raise CmdFailedError(f"Install failed at block {block_count+1}")
-
-            i += BLOCK_SIZE
-            block_count += 1
-            progress.update(task, advance=len(block_bytes))
+                fws[dev_serial] = images.enter_context(FirmwareImage.open(image_path))
+            except CmdFailedError as e:
+                invalid.append(f"{dev_serial}: {e}")
+        if invalid:
+            raise CmdFailedError("\n".join(invalid))
+
+        logger.info(f"Flashing {len(devices)} devices, {jobs} at a time")
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=jobs) as executor, Progress() as progress:
+            await asyncio.gather(
+                *(flash(dev_serial, fw, progress) for dev_serial, fw in fws.items())
+            )
+        wall_time = time.perf_counter() - start
+
+    device_time = sum(result["seconds"] for result in results.values())
+    failed = sorted(port for port, result in results.items() if result["error"])
+    for dev_serial, result in results.items():
+        status = f"failed ({result['error']})" if result["error"] else "ok"
+        logger.info(f"{dev_serial}: {status} in {result['seconds']:.2f}s")
+    logger.info(
+        f"Flashed {len(results) - len(failed)}/{len(results)} devices in"
+        f" {wall_time:.2f}s wall-clock ({device_time:.2f}s total device time)"
+    )
 
-    try:
-        verify_resp(ser, BootloaderResponseCode.AppInstallOK)
-    except AssertionError:
-        ser.close()
-        raise CmdFailedError("Image Failed to Install")
+    summary = {
+        "wall_seconds": round(wall_time, 3),
+        "device_seconds": round(device_time, 3),
+        "devices": results,
+    }
+    if failed:
+        raise CmdFailedError(f"Install failed on {', '.join(failed)}", summary)
 
-    logger.info("Image Installed")
-    return b"", b""
+    return json.dumps(summary).encode(), b""
 
 
 async def load_sec_hw(
-    dev_in: Path, dev_name: str, dev_serial: str, logger: logging.Logger = None,
+    dev_in: Path,
+    dev_name: str,
+    dev_serial: str,
+    erase_timeout: float = SubparserDevLoadSecHW.erase_timeout,
+    ack_timeout: float = SubparserDevLoadSecHW.ack_timeout,
+    logger: logging.Logger = None,
 ) -> HandlerRet:
+    from rich.progress import Progress
+
     # Usage: Turn on the device holding SW2, then start this script
 
     logger = logger or get_logger()
@@ -233,137 +689,365 @@ async def load_sec_hw(
 
     # Try to connect to the serial port
     logger.info(f"Connecting to serial port {dev_serial}...")
-    ser = Serial(dev_serial, 115200, timeout=2)
-    ser.reset_input_buffer()
+    with span("serial.connect"):
+        ser = Serial(dev_serial, 115200, timeout=ack_timeout)
+        ser.reset_input_buffer()
     logger.info(f"Connection opened on {dev_serial}")
+    reader = ResponseReader(ser)
+    fw_map = None
+    fw_data = memoryview(b"")
 
-    # Open firmware
-    logger.info("Reading image file...")
-    if not image_path.exists():
+    try:
+        # Open firmware. Secure images vary in size, so the file is mapped
+        # here rather than opened as a FirmwareImage
+        logger.info("Reading image file...")
+        if not image_path.exists():
+            raise CmdFailedError(f"Image file {image_path} not found")
+
+        with open(image_path, "rb") as f:
+            if os.fstat(f.fileno()).st_size:
+                fw_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                fw_data = memoryview(fw_map)
+
+        # Wait for bootloader ready
+        logger.info("Requesting update...")
+        ser.write(SECURE_BL_UPDATE_COMMAND)
+        reader.expect("request")
+
+        resp = -1
+        with span("bootloader.request"):
+            deadline = time.perf_counter() + erase_timeout
+            while resp != secure_bl_success_codes[2]:
+                try:
+                    resp = verify_sec_resp(reader, deadline, logger=logger)
+                except ValueError:
+                    raise CmdFailedError("Load HW Failed")
+
+        # Send data in 16-byte blocks
+        logger.info("Update started")
+        total_bytes = len(fw_data)
+        block_count = 0
+        i = 0
+
+        with Progress() as progress, span("transfer", blocks=total_bytes // BLOCK_SIZE):
+            task = progress.add_task("Sending firmware...", total=total_bytes)
+            while i < total_bytes:
+                with fw_data[i : i + BLOCK_SIZE] as block_bytes:
+                    block_size = len(block_bytes)
+                    ser.write(block_bytes)
+                reader.expect("block")
+                try:
+                    deadline = time.perf_counter() + ack_timeout
+                    verify_sec_resp(reader, deadline, print_out=False, logger=logger)
+                except ValueError:
+                    raise CmdFailedError(f"Install failed at block {block_count+1}")
+
+                i += BLOCK_SIZE
+                block_count += 1
+                progress.update(task, advance=block_size)
+
+        logger.info("Listening for update status...")
+        reader.expect("install")
+        resp = -1
+        with span("final_ack"):
+            deadline = time.perf_counter() + erase_timeout
+            while resp != secure_bl_success_codes[-1]:
+                try:
+                    resp = verify_sec_resp(reader, deadline, logger=logger)
+                except ValueError:
+                    raise CmdFailedError("Image Failed to Install")
+    finally:
         ser.close()
-        raise CmdFailedError(f"Image file {image_path} not found")
+        fw_data.release()
+        if fw_map is not None:
+            fw_map.close()
 
-    fw_data = image_path.read_bytes()
+    latencies = reader.latency_summary()
+    for phase, stats in latencies.items():
+        logger.debug(f"{phase} response latency [ms]: {stats}")
+    logger.info("Image Installed")
+    return json.dumps(latencies).encode(), b""
 
-    # Wait for bootloader ready
-    logger.info("Requesting update...")
-    ser.write(SECURE_BL_UPDATE_COMMAND)
 
-    resp = -1
-    while resp != secure_bl_success_codes[2]:
-        try:
-            resp = verify_sec_resp(ser, logger=logger)
-        except ValueError:
-            ser.close()
-            raise CmdFailedError("Load HW Failed")
-
-    # Send data in 16-byte blocks
-    logger.info("Update started")
-    total_bytes = len(fw_data)
-    block_count = 0
-    i = 0
-
-    with Progress() as progress:
-        task = progress.add_task("Sending firmware...", total=total_bytes)
-        while i < total_bytes:
-            block_bytes = fw_data[i : i + BLOCK_SIZE]
-            ser.write(block_bytes)
-            try:
-                verify_sec_resp(ser, print_out=False, logger=logger)
-            except ValueError:
-                ser.close()
-                raise CmdFailedError(f"Install failed at block {block_count+1}")
-
-            i += BLOCK_SIZE
-            block_count += 1
-            progress.update(task, advance=len(block_bytes))
-
-    logger.info("Listening for update status...")
-    resp = -1
-    while resp != secure_bl_success_codes[-1]:
+MODE_CHANGE_FRAME_SIZE = 32
+MODE_CHANGE_EXCHANGE_ROUNDS = 2
+
+
+class ModeChangeLink:
+    """One bootloader taking part in a mode change
+
+    Serial data is read into a buffer, so a read that hits its deadline or is
+    cancelled does not lose bytes. Each step is bounded by step_timeout and
+    timed.
+    """
+
+    def __init__(
+        self,
+        dev_num: int,
+        dev_serial: str,
+        step_timeout: float,
+        logger: logging.Logger,
+    ):
+        self.dev_num = dev_num
+        self.dev_serial = dev_serial
+        self.step_timeout = step_timeout
+        self.logger = logger
+        self.port = Port(dev_serial)
+        self.buf = bytearray()
+        self.steps: List[Dict[str, Any]] = []
+
+    def open(self):
+        if not self.port.active():
+            raise CmdFailedError(f"Could not open serial port {self.dev_serial}")
+
+    def close(self):
+        self.port.close(log_level=logging.DEBUG)
+
+    async def _fill(self):
+        msg = await self.port.read_async()
+        if msg is None:
+            raise CmdFailedError(f"Lost connection to bootloader {self.dev_num}")
+        self.buf += msg
+
+    async def _read_status(self) -> int:
+        while True:
+            while not self.buf:
+                await self._fill()
+            code = self.buf.pop(0)
+
+            # Skip anything that is not a mode change code
+            resp_class = SECURE_BL_MODE_CHANGE_CODE_TABLE[code]
+            if resp_class == RESP_OK:
+                self.logger.debug(
+                    f"Success. Bootloader {self.dev_num} responded with code {code}"
+                )
+                return code
+            if resp_class == RESP_ERROR:
+                raise CmdFailedError(
+                    f"Bootloader {self.dev_num} responded with: {code}"
+                )
+
+    async def _read_frame(self) -> bytes:
+        while len(self.buf) < MODE_CHANGE_FRAME_SIZE:
+            await self._fill()
+        frame = bytes(self.buf[:MODE_CHANGE_FRAME_SIZE])
+        del self.buf[:MODE_CHANGE_FRAME_SIZE]
+        await self._read_status()
+        return frame
+
+    async def _send(self, data: bytes):
+        if not await self.port.send_async(data):
+            raise CmdFailedError(f"Lost connection to bootloader {self.dev_num}")
+
+    async def step(self, what: str, coro: Awaitable):
+        start = time.perf_counter()
         try:
-            resp = verify_sec_resp(ser, logger=logger)
-        except AssertionError:
-            ser.close()
-            raise CmdFailedError("Image Failed to Install")
+            with span("mode_change.step", device=self.dev_num, step=what):
+                ret = await asyncio.wait_for(coro, self.step_timeout)
+        except asyncio.TimeoutError:
+            raise CmdFailedError(
+                f"Bootloader {self.dev_num} timed out after {self.step_timeout}s"
+                f" waiting for {what}"
+            )
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self.steps.append(
+            {"device": self.dev_num, "step": what, "ms": round(elapsed_ms, 3)}
+        )
+        self.logger.debug(f"Bootloader {self.dev_num}: {what} in {elapsed_ms:.1f} ms")
+        return ret
 
-    logger.info("Image Installed")
-    return b"", b""
+    async def request(self):
+        await self._send(SECURE_BL_MODE_CHANGE_COMMAND)
+        await self.step("mode change request", self._read_status())
+
+    async def read_frame(self, what: str) -> bytes:
+        return await self.step(what, self._read_frame())
+
+    async def forward(self, frame: bytes, what: str):
+        """Send a frame from the other bootloader and wait for the ACK"""
+        await self._send(frame)
+        await self.step(f"ACK of {what}", self._read_status())
+
+
+async def first_error(*coros: Awaitable):
+    """Run coroutines concurrently, cancelling the rest once one fails"""
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def exchange_frames(link1: ModeChangeLink, link2: ModeChangeLink, what: str):
+    # Relay frames both ways at once. Each bootloader sends its frame before
+    # taking the other's, so a frame is only forwarded to a bootloader once
+    # its own frame has arrived
+    frame_read = {link1: asyncio.Event(), link2: asyncio.Event()}
+
+    async def relay(src: ModeChangeLink, dst: ModeChangeLink):
+        frame = await src.read_frame(what)
+        frame_read[src].set()
+        await dst.step(f"{what} to be sent", frame_read[dst].wait())
+        await dst.forward(frame, f"{what} from bootloader {src.dev_num}")
+
+    await first_error(relay(link1, link2), relay(link2, link1))
+
+
+async def final_exchange(link1: ModeChangeLink, link2: ModeChangeLink, what: str):
+    # Either bootloader may go first in the final round. The first one to
+    # send a frame leads, and the other answers once it has taken the frame
+    reads = {
+        asyncio.ensure_future(link.read_frame(what)): link for link in (link1, link2)
+    }
+    try:
+        done, _ = await asyncio.wait(reads, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in reads:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*reads, return_exceptions=True)
+
+    frames = {reads[task]: task.result() for task in done}
+    if len(frames) == 2:
+        # Both sent a frame, so finish like the earlier rounds
+        await first_error(
+            link2.forward(frames[link1], f"{what} from bootloader 1"),
+            link1.forward(frames[link2], f"{what} from bootloader 2"),
+        )
+        return
+
+    leader, frame = next(iter(frames.items()))
+    follower = link2 if leader is link1 else link1
+    await follower.forward(frame, f"{what} from bootloader {leader.dev_num}")
+    reply = await follower.read_frame(f"{what} reply")
+    await leader.forward(reply, f"{what} reply from bootloader {follower.dev_num}")
+
+
+async def change_mode(
+    dev1_serial: str,
+    dev2_serial: str,
+    step_timeout: float,
+    logger: logging.Logger,
+) -> Dict[str, Any]:
+    """Run a mode change between two bootloaders, returning step timings"""
+    link1 = ModeChangeLink(1, dev1_serial, step_timeout, logger)
+    link2 = ModeChangeLink(2, dev2_serial, step_timeout, logger)
+    start = time.perf_counter()
+    try:
+        with span("serial.connect", devices=[dev1_serial, dev2_serial]):
+            link1.open()
+            link2.open()
+        logger.info(f"Connected to bootloaders on {dev1_serial} and {dev2_serial}")
+
+        # Wait for bootloader ready
+        logger.info("Requesting mode change")
+        await first_error(link1.request(), link2.request())
+
+        for i in range(1, MODE_CHANGE_EXCHANGE_ROUNDS + 1):
+            await exchange_frames(link1, link2, f"frame {i}")
+        await final_exchange(link1, link2, f"frame {MODE_CHANGE_EXCHANGE_ROUNDS + 1}")
+    finally:
+        link1.close()
+        link2.close()
+
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    logger.info(f"Mode Change Complete in {elapsed_ms:.1f} ms")
+    return {
+        "devices": [dev1_serial, dev2_serial],
+        "ms": round(elapsed_ms, 3),
+        "steps": sorted(link1.steps + link2.steps, key=lambda s: s["device"]),
+    }
 
 
 async def mode_change(
-    dev1_serial: str, dev2_serial: str, logger: logging.Logger = None
-):
-    logger = logger or logging.getLogger()
-
-    # Open serial ports
-    ser1 = Serial(dev1_serial, 115200, timeout=2)
-    ser1.reset_input_buffer()
-
-    ser2 = Serial(dev2_serial, 115200, timeout=2)
-    ser2.reset_input_buffer()
-
-    logger.info(f"Connected to bootloaders on {dev1_serial} and {dev2_serial}")
-
-    # Wait for bootloader ready
-    logger.info("Requesting mode change")
-    ser1.write(SECURE_BL_MODE_CHANGE_COMMAND)
-    ser2.write(SECURE_BL_MODE_CHANGE_COMMAND)
-    verify_mode_change_resp(ser1, 1, logger=logger)
-    verify_mode_change_resp(ser2, 2, logger=logger)
-
-    # Receive data
-    d1 = ser1.read(32)
-    verify_mode_change_resp(ser1, 1, logger=logger)
-    d2 = ser2.read(32)
-    verify_mode_change_resp(ser2, 2, logger=logger)
-
-    # Forward data
-    ser1.write(d2)
-    verify_mode_change_resp(ser1, 1, logger=logger)
-    ser2.write(d1)
-    verify_mode_change_resp(ser2, 2, logger=logger)
-
-    # Receive data
-    d1 = ser1.read(32)
-    verify_mode_change_resp(ser1, 1, logger=logger)
-    d2 = ser2.read(32)
-    verify_mode_change_resp(ser2, 2, logger=logger)
-
-    # Forward data
-    ser1.write(d2)
-    verify_mode_change_resp(ser1, 1, logger=logger)
-    ser2.write(d1)
-    verify_mode_change_resp(ser2, 2, logger=logger)
-
-    # Try receiving d2 first
-    d2 = ser2.read(32)
-    if len(d2) == 32:
-        # Continue, forward d2 to d1
-        verify_mode_change_resp(ser2, 2, logger=logger)
-        ser1.write(d2)
-        verify_mode_change_resp(ser1, 1, logger=logger)
-
-        # Receive from d1
-        d1 = ser1.read(32)
-        verify_mode_change_resp(ser1, 1, logger=logger)
-        ser2.write(d1)
-        verify_mode_change_resp(ser2, 2, logger=logger)
-    else:
-        # Need to receive d1 first
-        d1 = ser1.read(32)
-        verify_mode_change_resp(ser1, 1, logger=logger)
-        ser2.write(d1)
-        verify_mode_change_resp(ser2, 2, logger=logger)
-
-        # Receive from d2
-        d2 = ser2.read(32)
-        verify_mode_change_resp(ser2, 2, logger=logger)
-        ser1.write(d2)
-        verify_mode_change_resp(ser1, 1, logger=logger)
-
-    logger.info("Mode Change Complete")
-    return b"", b""
+    dev1_serial: str,
+    dev2_serial: str,
+    step_timeout: float = SubparserDevModeChange.step_timeout,
+    logger: logging.Logger = None,
+) -> HandlerRet:
+    logger = logger or get_logger()
+    timings = await change_mode(dev1_serial, dev2_serial, step_timeout, logger)
+    return json.dumps(timings).encode(), b""
+
+
+def load_pair_map(pair_map: Path) -> List[Tuple[str, str]]:
+    """Load a JSON list of [first serial port, second serial port] pairs"""
+    try:
+        raw_pairs = json.loads(pair_map.read_text())
+    except (OSError, ValueError) as e:
+        raise CmdFailedError(f"Could not read pair map {pair_map}: {e}")
+
+    if not isinstance(raw_pairs, list) or not raw_pairs:
+        raise CmdFailedError(f"Pair map {pair_map} must be a non-empty list")
+
+    pairs = []
+    for i, pair in enumerate(raw_pairs):
+        if not isinstance(pair, list) or len(pair) != 2:
+            raise CmdFailedError(f"{pair_map}[{i}] must be a list of two ports")
+        pairs.append((str(pair[0]), str(pair[1])))
+
+    serials = [dev_serial for pair in pairs for dev_serial in pair]
+    duplicates = sorted({s for s in serials if serials.count(s) > 1})
+    if duplicates:
+        raise CmdFailedError(f"Serial ports paired more than once: {duplicates}")
+
+    return pairs
+
+
+async def mode_change_many(
+    pair_map: Path,
+    step_timeout: float = SubparserDevModeChangeMany.step_timeout,
+    logger: logging.Logger = None,
+) -> HandlerRet:
+    logger = logger or get_logger()
+    pairs = load_pair_map(pair_map)
+    logger.info(f"Changing mode on {len(pairs)} bootloader pairs")
+
+    async def run_pair(dev1_serial: str, dev2_serial: str) -> Dict[str, Any]:
+        pair_logger = DeviceLogAdapter(
+            logger, {"device": f"{dev1_serial}+{dev2_serial}"}
+        )
+        try:
+            with span("mode_change.pair", devices=[dev1_serial, dev2_serial]):
+                result = await change_mode(
+                    dev1_serial, dev2_serial, step_timeout, pair_logger
+                )
+            result["error"] = None
+        except CmdFailedError as e:
+            # Isolate failures so the other pairs still finish
+            pair_logger.error(f"Mode change failed: {e.args[0]}")
+            result = {"devices": [dev1_serial, dev2_serial], "error": e.args[0]}
+        return result
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(run_pair(*pair) for pair in pairs))
+    wall_time = time.perf_counter() - start
+
+    failed = [result for result in results if result["error"]]
+    logger.info(
+        f"Changed mode on {len(results) - len(failed)}/{len(results)} pairs"
+        f" in {wall_time * 1000:.1f} ms"
+    )
+
+    summary = {"wall_ms": round(wall_time * 1000, 3), "pairs": results}
+    if failed:
+        failed_pairs = ", ".join("+".join(result["devices"]) for result in failed)
+        raise CmdFailedError(f"Mode change failed on {failed_pairs}", summary)
+
+    return json.dumps(summary).encode(), b""
+
+
+"""
+Serial-to-Socket Bridge
+"""
+
+BRIDGE_CHUNK_SIZE = 4096
+BRIDGE_RECONNECT_INTERVAL = 0.1
+SERIAL_POLL_INTERVAL = 0.01
 
 
 class Port:
@@ -371,6 +1055,7 @@ class Port:
         self.device_serial = device_serial
         self.baudrate = baudrate
         self.ser = None
+        self._waiters = set()
 
         # Set up logger
         self.logger = logging.getLogger(f"{device_serial}_log")
@@ -380,7 +1065,7 @@ class Port:
         # If not connected, try to connect to serial device
         if not self.ser:
             try:
-                ser = Serial(self.device_serial, baudrate=self.baudrate, timeout=0.1)
+                ser = Serial(self.device_serial, baudrate=self.baudrate, timeout=0)
                 ser.reset_input_buffer()
                 self.ser = ser
                 self.logger.info(f"Connection opened on {self.device_serial}")
@@ -393,7 +1078,7 @@ class Port:
             return None
 
         try:
-            msg = self.ser.read()
+            msg = self.ser.read(max(self.ser.in_waiting, 1))
             if msg != b"":
                 return msg
             return None
@@ -412,9 +1097,115 @@ class Port:
             self.close()
             return False
 
-    def close(self):
-        self.logger.warning(f"Connection closed on {self.device_serial}")
-        self.ser = None
+    async def _wait_fd(self, fd: int, writable: bool = False):
+        # Park on the event loop until the serial fd is ready. close() resolves
+        # the future with False after unregistering the fd itself, so the
+        # registration is only removed here if readiness (or cancellation)
+        # woke us up
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+
+        def ready():
+            if not fut.done():
+                fut.set_result(True)
+
+        add, remove = (
+            (loop.add_writer, loop.remove_writer)
+            if writable
+            else (loop.add_reader, loop.remove_reader)
+        )
+        add(fd, ready)
+        self._waiters.add(fut)
+        try:
+            await fut
+        finally:
+            self._waiters.discard(fut)
+            if fut.cancelled() or fut.result():
+                remove(fd)
+
+    async def read_async(self) -> Optional[bytes]:
+        """Wait for serial data and return everything available
+
+        Returns None if the port is not connected or was disconnected
+        """
+        if not self.active():
+            return None
+
+        ser = self.ser
+        try:
+            fd = getattr(ser, "fd", None)
+            if fd is None:
+                # No selectable handle on this platform, poll the driver buffer
+                while not ser.in_waiting:
+                    await asyncio.sleep(SERIAL_POLL_INTERVAL)
+                return ser.read(ser.in_waiting)
+
+            while True:
+                await self._wait_fd(fd)
+                if self.ser is not ser:
+                    return None
+                try:
+                    msg = os.read(fd, BRIDGE_CHUNK_SIZE)
+                except BlockingIOError:
+                    continue
+
+                # Readable with no data means the device went away
+                if not msg:
+                    raise SerialException("Device disconnected")
+                return msg
+        except (SerialException, OSError):
+            if self.ser is ser:
+                self.close()
+            return None
+
+    async def send_async(self, msg: bytes) -> bool:
+        """Write a message to the device without blocking the event loop"""
+        if not self.active():
+            return False
+
+        ser = self.ser
+        try:
+            fd = getattr(ser, "fd", None)
+            if fd is None:
+                ser.write(msg)
+                return True
+
+            view = memoryview(msg)
+            while view:
+                try:
+                    view = view[os.write(fd, view) :]  # noqa
+                except BlockingIOError:
+                    await self._wait_fd(fd, writable=True)
+                    if self.ser is not ser:
+                        return False
+            return True
+        except (SerialException, OSError):
+            if self.ser is ser:
+                self.close()
+            return False
+
+    def close(self, log_level: int = logging.WARNING):
+        if self.ser is None:
+            return
+
+        self.logger.log(log_level, f"Connection closed on {self.device_serial}")
+        ser, self.ser = self.ser, None
+
+        # Unregister the fd before closing it so a reconnect that reuses the
+        # fd number does not inherit stale loop callbacks
+        fd = getattr(ser, "fd", None)
+        if fd is not None and self._waiters:
+            loop = asyncio.get_running_loop()
+            loop.remove_reader(fd)
+            loop.remove_writer(fd)
+        for fut in self._waiters:
+            if not fut.done():
+                fut.set_result(False)
+
+        try:
+            ser.close()
+        except (SerialException, OSError):
+            pass
 
 
 class Sock:
@@ -426,6 +1217,7 @@ class Sock:
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.bind(("0.0.0.0", int(bridge_id)))
         self.sock.listen(q_len)
+        self.sock.setblocking(False)
         self.csock = None
 
         # Set up logger
@@ -451,7 +1243,7 @@ class Sock:
 
         try:
             if self.sock_ready(self.csock):
-                data = self.csock.recv(4096)
+                data = self.csock.recv(BRIDGE_CHUNK_SIZE)
 
                 # Connection closed
                 if not data:
@@ -477,31 +1269,174 @@ class Sock:
             self.close()
             return False
 
-    def close(self):
-        self.logger.warning(f"Conection closed on {self.bridge_id}")
-        self.csock = None
+    async def accept_async(self):
+        """Wait for a host tool to connect if there is no client yet"""
+        if self.csock:
+            return
 
+        loop = asyncio.get_running_loop()
+        self.csock, _ = await loop.sock_accept(self.sock)
+        self.logger.info(f"Connection opened on {self.bridge_id}")
 
-def poll_bridge(host_sock: Sock, serial_port: Port):
-    if host_sock.active():
-        msg = host_sock.read_msg()
+    async def read_async(self) -> Optional[bytes]:
+        """Wait for data from the connected client
 
-        # Send message to device
-        if serial_port.active():
-            if msg is not None:
-                serial_port.send_msg(msg)
+        Returns None once the client disconnects
+        """
+        if not self.csock:
+            return None
 
-    if serial_port.active():
-        msg = serial_port.read_msg()
+        loop = asyncio.get_running_loop()
+        try:
+            data = await loop.sock_recv(self.csock, BRIDGE_CHUNK_SIZE)
+        except OSError:
+            # Cleanly handle forced closed connection
+            data = b""
+
+        # Connection closed
+        if not data:
+            self.close()
+            return None
+        return data
+
+    async def send_async(self, msg: bytes) -> bool:
+        """Send data to the connected client, dropping it if there is none"""
+        if not self.csock:
+            return False
+
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.sock_sendall(self.csock, msg)
+            return True
+        except OSError:
+            # Leave closing to the reader, which is woken up by the shutdown
+            try:
+                self.csock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            return False
+
+    def close(self):
+        if self.csock is None:
+            return
+
+        self.logger.warning(f"Conection closed on {self.bridge_id}")
+        csock, self.csock = self.csock, None
+        csock.close()
+
+    def shutdown(self):
+        self.close()
+        self.sock.close()
+
+
+class BridgeStats:
+    """Traffic counters for one direction of a bridge"""
+
+    def __init__(self):
+        self.bytes = 0
+        self.chunks = 0
+        self.dropped = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, size: int, latency: float, sent: bool):
+        if not sent:
+            self.dropped += size
+            return
+
+        self.bytes += size
+        self.chunks += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def as_dict(self) -> Dict[str, float]:
+        mean_latency = self.total_latency / self.chunks if self.chunks else 0.0
+        return {
+            "bytes": self.bytes,
+            "chunks": self.chunks,
+            "dropped_bytes": self.dropped,
+            "mean_latency_ms": round(mean_latency * 1000, 3),
+            "max_latency_ms": round(self.max_latency * 1000, 3),
+        }
+
+
+class Bridge:
+    """Event-driven bridge between a host socket and a serial port
+
+    Traffic is forwarded in bulk in both directions as soon as the event loop
+    reports either side readable. Data arriving while the other side is not
+    connected is dropped, and both sides reconnect on their own. With a
+    capture writer, every chunk read from either side is recorded.
+    """
+
+    def __init__(
+        self,
+        host_sock: Sock,
+        serial_port: Port,
+        capture: Optional[CaptureWriter] = None,
+    ):
+        self.host_sock = host_sock
+        self.serial_port = serial_port
+        self.capture = capture
+        self.host_to_serial_stats = BridgeStats()
+        self.serial_to_host_stats = BridgeStats()
 
-        # Send message to host
-        if host_sock.active():
+    async def host_to_serial(self):
+        while True:
+            await self.host_sock.accept_async()
+            msg = await self.host_sock.read_async()
             if msg is not None:
-                host_sock.send_msg(msg)
+                if self.capture is not None:
+                    self.capture.record(HOST_TO_SERIAL, msg)
+                start = time.perf_counter()
+                sent = await self.serial_port.send_async(msg)
+                self.host_to_serial_stats.record(
+                    len(msg), time.perf_counter() - start, sent
+                )
+
+    async def serial_to_host(self):
+        while True:
+            if not self.serial_port.active():
+                await asyncio.sleep(BRIDGE_RECONNECT_INTERVAL)
+                continue
+
+            msg = await self.serial_port.read_async()
+            if msg is not None:
+                if self.capture is not None:
+                    self.capture.record(SERIAL_TO_HOST, msg)
+                start = time.perf_counter()
+                sent = await self.host_sock.send_async(msg)
+                self.serial_to_host_stats.record(
+                    len(msg), time.perf_counter() - start, sent
+                )
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        return {
+            "host_to_serial": self.host_to_serial_stats.as_dict(),
+            "serial_to_host": self.serial_to_host_stats.as_dict(),
+        }
+
+    async def run(self):
+        tasks = [
+            asyncio.ensure_future(self.host_to_serial()),
+            asyncio.ensure_future(self.serial_to_host()),
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.host_sock.close()
+            self.serial_port.close()
 
 
 async def bridge(
-    bridge_id: int, dev_serial: str, logger: logging.Logger = None
+    bridge_id: int,
+    dev_serial: str,
+    capture: Optional[Path] = SubparserDevBridge.capture,
+    capture_max_mb: float = SubparserDevBridge.capture_max_mb,
+    logger: logging.Logger = None,
 ) -> HandlerRet:
 
     logger = logger or get_logger()
@@ -513,15 +1448,448 @@ async def bridge(
     bridge_id += SOCKET_BASE
     host_sock = Sock(bridge_id)
     serial_port = Port(dev_serial)
+    capture_writer = open_capture(capture, capture_max_mb, logger)
 
     try:
-        while True:
-            poll_bridge(host_sock, serial_port)
-            await asyncio.sleep(0)
-    except KeyboardInterrupt:
+        await Bridge(host_sock, serial_port, capture_writer).run()
+    except (KeyboardInterrupt, asyncio.CancelledError):
         logger.info("Shutting down bridge")
-        host_sock.close()
-        serial_port.close()
+    finally:
+        host_sock.shutdown()
+        if capture_writer is not None:
+            capture_writer.close()
 
     logger.info("Bridge shut-down")
     return b"", b""
+
+
+def open_capture(
+    capture: Optional[Path], capture_max_mb: float, logger: logging.Logger
+) -> Optional[CaptureWriter]:
+    if capture is None:
+        return None
+    logger.info(f"Capturing bridged traffic to {capture}")
+    return CaptureWriter(capture, int(capture_max_mb * 1024 * 1024))
+
+
+def load_bridge_map(bridge_map: Path) -> Dict[int, str]:
+    """Load a JSON object mapping bridge IDs to serial ports"""
+    try:
+        raw_map = json.loads(bridge_map.read_text())
+    except (OSError, ValueError) as e:
+        raise CmdFailedError(f"Could not read bridge map {bridge_map}: {e}")
+
+    if not isinstance(raw_map, dict) or not raw_map:
+        raise CmdFailedError(f"Bridge map {bridge_map} must be a non-empty object")
+
+    mapping = {}
+    for bridge_id, dev_serial in raw_map.items():
+        try:
+            mapping[int(bridge_id)] = str(dev_serial)
+        except ValueError:
+            raise CmdFailedError(f"Invalid bridge ID {bridge_id!r} in {bridge_map}")
+
+    serials = list(mapping.values())
+    duplicates = sorted({s for s in serials if serials.count(s) > 1})
+    if duplicates:
+        raise CmdFailedError(f"Serial ports mapped more than once: {duplicates}")
+
+    return mapping
+
+
+async def supervise_bridge(bridge_id: int, dev_bridge: Bridge, logger: logging.Logger):
+    # Keep one failing bridge from taking down the rest
+    while True:
+        try:
+            await dev_bridge.run()
+        except Exception as e:
+            logger.error(f"Bridge {bridge_id} failed ({e!r}), restarting")
+            await asyncio.sleep(BRIDGE_RECONNECT_INTERVAL)
+
+
+async def log_bridge_stats(
+    dev_bridges: Dict[int, Bridge], interval: float, logger: logging.Logger
+):
+    while True:
+        await asyncio.sleep(interval)
+        for bridge_id, dev_bridge in dev_bridges.items():
+            h2s = dev_bridge.host_to_serial_stats
+            s2h = dev_bridge.serial_to_host_stats
+            logger.info(
+                f"Bridge {bridge_id}: host->serial {h2s.bytes} B,"
+                f" serial->host {s2h.bytes} B,"
+                f" dropped {h2s.dropped + s2h.dropped} B"
+            )
+
+
+async def bridges(
+    bridge_map: Path,
+    stats_interval: float = SubparserDevBridges.stats_interval,
+    capture_dir: Optional[Path] = SubparserDevBridges.capture_dir,
+    capture_max_mb: float = SubparserDevBridges.capture_max_mb,
+    logger: logging.Logger = None,
+) -> HandlerRet:
+    logger = logger or get_logger()
+    mapping = load_bridge_map(bridge_map)
+
+    # Open interfaces
+    host_socks = []
+    captures = []
+    dev_bridges = {}
+    try:
+        for bridge_id, dev_serial in mapping.items():
+            logger.info(
+                f"Starting bridge between host socket {bridge_id}"
+                f" and serial {dev_serial}"
+            )
+            host_sock = Sock(bridge_id + SOCKET_BASE)
+            host_socks.append(host_sock)
+            capture = None
+            if capture_dir is not None:
+                capture = open_capture(
+                    capture_dir / f"bridge_{bridge_id}.cap", capture_max_mb, logger
+                )
+                captures.append(capture)
+            dev_bridges[bridge_id] = Bridge(host_sock, Port(dev_serial), capture)
+    except OSError as e:
+        for host_sock in host_socks:
+            host_sock.shutdown()
+        for capture in captures:
+            capture.close()
+        raise CmdFailedError(f"Could not open bridge socket: {e}")
+
+    tasks = [
+        asyncio.ensure_future(supervise_bridge(bridge_id, dev_bridge, logger))
+        for bridge_id, dev_bridge in dev_bridges.items()
+    ]
+    if stats_interval > 0:
+        tasks.append(
+            asyncio.ensure_future(log_bridge_stats(dev_bridges, stats_interval, logger))
+        )
+
+    try:
+        await asyncio.gather(*tasks)
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        logger.info(f"Shutting down {len(dev_bridges)} bridges")
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for host_sock in host_socks:
+            host_sock.shutdown()
+        for capture in captures:
+            capture.close()
+
+    stats = {
+        bridge_id: dev_bridge.stats() for bridge_id, dev_bridge in dev_bridges.items()
+    }
+    for bridge_id, bridge_stats in stats.items():
+        logger.info(f"Bridge {bridge_id} traffic: {bridge_stats}")
+
+    logger.info("Bridges shut-down")
+    return json.dumps(stats).encode(), b""
+
+
+class ReplayLink:
+    """The side of a bridge that a capture is replayed against
+
+    Traffic the host sent is replayed to a serial port, or to a running
+    bridge by connecting to its socket like a host tool. Traffic the device
+    sent is replayed to a serial port, or to a host tool by listening on a
+    bridge socket like a bridge
+    """
+
+    def __init__(
+        self, dev_serial: Optional[str], bridge_id: Optional[int], direction: int
+    ):
+        self.dev_serial = dev_serial
+        self.bridge_id = bridge_id
+        self.direction = direction
+        self.port: Optional[Port] = None
+        self.sock: Optional[Sock] = None
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def open(self, logger: logging.Logger):
+        if self.dev_serial is not None:
+            self.port = Port(self.dev_serial, log_level=logging.DEBUG)
+            if not self.port.active():
+                raise CmdFailedError(f"Could not open serial port {self.dev_serial}")
+        elif self.direction == HOST_TO_SERIAL:
+            port = self.bridge_id + SOCKET_BASE
+            try:
+                self.reader, self.writer = await asyncio.open_connection(
+                    "localhost", port
+                )
+            except OSError as e:
+                raise CmdFailedError(f"Could not connect to bridge on {port}: {e}")
+        else:
+            try:
+                self.sock = Sock(self.bridge_id + SOCKET_BASE)
+            except OSError as e:
+                raise CmdFailedError(f"Could not open bridge socket: {e}")
+            logger.info("Waiting for a host tool to connect")
+            await self.sock.accept_async()
+
+    async def send(self, data: bytes) -> bool:
+        if self.port is not None:
+            return await self.port.send_async(data)
+        if self.sock is not None:
+            return await self.sock.send_async(data)
+        try:
+            self.writer.write(data)
+            await self.writer.drain()
+            return True
+        except ConnectionError:
+            return False
+
+    async def read(self) -> Optional[bytes]:
+        if self.port is not None:
+            return await self.port.read_async()
+        if self.sock is not None:
+            return await self.sock.read_async()
+        return await self.reader.read(BRIDGE_CHUNK_SIZE) or None
+
+    def close(self):
+        if self.port is not None:
+            self.port.close(log_level=logging.DEBUG)
+        if self.sock is not None:
+            self.sock.shutdown()
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def replay(
+    capture: Path,
+    dev_serial: Optional[str] = SubparserDevReplay.dev_serial,
+    bridge_id: Optional[int] = SubparserDevReplay.bridge_id,
+    direction: str = SubparserDevReplay.direction,
+    speed: float = SubparserDevReplay.speed,
+    settle: float = SubparserDevReplay.settle,
+    logger: logging.Logger = None,
+) -> HandlerRet:
+    logger = logger or get_logger()
+
+    if (dev_serial is None) == (bridge_id is None):
+        raise CmdFailedError("Replay to exactly one of --dev-serial or --bridge-id")
+    if direction not in DIRECTIONS:
+        raise CmdFailedError(
+            f"Invalid direction {direction!r}. Expected one of {', '.join(DIRECTIONS)}"
+        )
+    send_direction = DIRECTIONS[direction]
+
+    # Replay one direction, and expect what the other side answered
+    records = [r for r in read_capture(capture) if r.data]
+    chunks = [r for r in records if r.direction == send_direction]
+    expected = b"".join(r.data for r in records if r.direction != send_direction)
+    if not chunks:
+        raise CmdFailedError(f"No {direction} traffic in {capture}")
+    logger.info(
+        f"Replaying {len(chunks)} {direction} chunks"
+        f" ({sum(len(r.data) for r in chunks)} B) from {capture}"
+        + (f" at {speed}x speed" if speed > 0 else " as fast as possible")
+    )
+
+    link = ReplayLink(dev_serial, bridge_id, send_direction)
+    received = bytearray()
+
+    async def receive():
+        while True:
+            msg = await link.read()
+            if msg is None:
+                return
+            received.extend(msg)
+
+    await link.open(logger)
+    receiver = asyncio.ensure_future(receive())
+    try:
+        start = time.perf_counter()
+        sent_bytes = 0
+        for chunk in chunks:
+            if speed > 0:
+                due = (chunk.ns - chunks[0].ns) / 1e9 / speed
+                delay = due - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            if not await link.send(chunk.data):
+                raise CmdFailedError(f"Lost connection after sending {sent_bytes} B")
+            sent_bytes += len(chunk.data)
+        send_time = time.perf_counter() - start
+
+        # Wait for the answers until they stop coming
+        seen = -1
+        while len(received) < len(expected) and len(received) != seen:
+            seen = len(received)
+            await asyncio.sleep(settle)
+    finally:
+        receiver.cancel()
+        await asyncio.gather(receiver, return_exceptions=True)
+        link.close()
+
+    mismatch = next(
+        (i for i, (a, b) in enumerate(zip(received, expected)) if a != b),
+        None if len(received) == len(expected) else min(len(received), len(expected)),
+    )
+    summary = {
+        "chunks": len(chunks),
+        "sent_bytes": sent_bytes,
+        "send_seconds": round(send_time, 3),
+        "send_bytes_per_second": round(sent_bytes / send_time, 1) if send_time else 0,
+        "received_bytes": len(received),
+        "expected_bytes": len(expected),
+        "first_mismatch": mismatch,
+    }
+    logger.info(
+        f"Sent {sent_bytes} B in {send_time:.3f}s, received"
+        f" {len(received)}/{len(expected)} B of the recorded answers"
+    )
+    if mismatch is not None:
+        logger.warning(f"Answers differ from the capture from byte {mismatch}")
+    return json.dumps(summary).encode(), b""
+
+
+BOARD_ACTIONS = ("load_hw", "bridge")
+
+
+def load_board_map(board_map: Path) -> Dict[str, Dict[str, Any]]:
+    """Load a JSON object mapping port identities to actions to run on them
+
+    e.g. {"0E23A5B1": {"action": "load_hw", "dev_in": "car", "dev_name": "car"},
+          "0E23A5B2": {"action": "bridge", "bridge_id": 1}}
+    """
+    try:
+        raw_map = json.loads(board_map.read_text())
+    except (OSError, ValueError) as e:
+        raise CmdFailedError(f"Could not read board map {board_map}: {e}")
+
+    if not isinstance(raw_map, dict):
+        raise CmdFailedError(f"Board map {board_map} must be an object")
+
+    boards = {}
+    for identity, board in raw_map.items():
+        action = board.get("action") if isinstance(board, dict) else None
+        try:
+            if action == "load_hw":
+                boards[identity] = {
+                    "action": action,
+                    "dev_in": board_map.parent / board["dev_in"],
+                    "dev_name": str(board["dev_name"]),
+                }
+            elif action == "bridge":
+                boards[identity] = {
+                    "action": action,
+                    "bridge_id": int(board["bridge_id"]),
+                }
+            else:
+                raise CmdFailedError(
+                    f"Board {identity} in {board_map} needs an action,"
+                    f" one of {', '.join(BOARD_ACTIONS)}"
+                )
+        except (KeyError, TypeError, ValueError) as e:
+            raise CmdFailedError(
+                f"Invalid {action} board {identity} in {board_map}: {e!r}"
+            )
+
+    bridge_ids = [b["bridge_id"] for b in boards.values() if "bridge_id" in b]
+    duplicates = sorted({i for i in bridge_ids if bridge_ids.count(i) > 1})
+    if duplicates:
+        raise CmdFailedError(f"Bridge IDs mapped more than once: {duplicates}")
+
+    return boards
+
+
+async def run_board(
+    port: SerialPortInfo,
+    board: Dict[str, Any],
+    logger: logging.Logger,
+    progress: Optional["Progress"],
+):
+    """Run the action of a board that was plugged in, until it is removed"""
+    dev_logger = DeviceLogAdapter(logger, {"device": port.device})
+    if board["action"] == "load_hw":
+        image_path = board["dev_in"] / f"{board['dev_name']}.img"
+        try:
+            fw = FirmwareImage.open(image_path)
+        except CmdFailedError as e:
+            dev_logger.error(f"Install failed: {e}")
+            return
+        task = progress.add_task(port.device, total=TOTAL_FW_SIZE, start=False)
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(
+                None,
+                copy_context().run,
+                install_hw,
+                fw,
+                port.device,
+                SubparserDevLoadHW.window,
+                SubparserDevLoadHW.erase_timeout,
+                SubparserDevLoadHW.ack_timeout,
+                dev_logger,
+                progress,
+                task,
+            )
+        except Exception as e:
+            dev_logger.error(f"Install failed: {str(e) or repr(e)}")
+        finally:
+            progress.remove_task(task)
+            fw.close()
+        return
+
+    bridge_id = board["bridge_id"]
+    dev_logger.info(f"Starting bridge on host socket {bridge_id}")
+    try:
+        host_sock = Sock(bridge_id + SOCKET_BASE)
+    except OSError as e:
+        dev_logger.error(f"Could not open bridge socket: {e}")
+        return
+    try:
+        await supervise_bridge(bridge_id, Bridge(host_sock, Port(port.device)), logger)
+    finally:
+        host_sock.shutdown()
+        dev_logger.info(f"Bridge {bridge_id} shut-down")
+
+
+async def watch(
+    board_map: Optional[Path] = SubparserDevWatch.board_map,
+    poll_interval: float = SubparserDevWatch.poll_interval,
+    logger: logging.Logger = None,
+) -> HandlerRet:
+    from rich.progress import Progress
+
+    logger = logger or get_logger()
+    boards = load_board_map(board_map) if board_map is not None else {}
+
+    # Actions running on each port, cancelled when the port goes away
+    running: Dict[str, asyncio.Future] = {}
+
+    def plugged_in(port: SerialPortInfo, progress: "Progress"):
+        logger.info(f"Found {port.device} ({port.identity}): {port.description}")
+        board = boards.get(port.identity)
+        if board is not None:
+            running[port.device] = asyncio.ensure_future(
+                run_board(port, board, logger, progress)
+            )
+
+    with PortWatcher(poll_interval, logger) as watcher, Progress() as progress:
+        try:
+            # Boards already plugged in count as just plugged in
+            for port in watcher.ports.values():
+                plugged_in(port, progress)
+
+            async for added, removed in watcher.changes():
+                for port in removed:
+                    logger.info(f"Removed {port.device} ({port.identity})")
+                    action = running.pop(port.device, None)
+                    if action is not None:
+                        action.cancel()
+                for port in added:
+                    plugged_in(port, progress)
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            logger.info("Stopping port watcher")
+        finally:
+            for action in running.values():
+                action.cancel()
+            await asyncio.gather(*running.values(), return_exceptions=True)
+
+    return b"", b""
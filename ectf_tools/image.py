@@ -0,0 +1,336 @@
+# 2023 eCTF
+# Kyle Scaplen
+#
+# (c) 2023 The MITRE Corporation
+#
+# This source file is part of an example system for MITRE's 2023 Embedded
+# CTF (eCTF). This code is being provided only for educational purposes for the
+# 2023 MITRE eCTF competition, and may not meet MITRE standards for quality.
+# Use this code at your own risk!
+
+import hashlib
+import mmap
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import (
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from ectf_tools.utils import CmdFailedError
+
+"""
+Device Image Sizes
+"""
+
+BLOCK_SIZE = 16
+PAGE_SIZE = 1024
+
+FLASH_PAGES = 256
+FLASH_SIZE = FLASH_PAGES * PAGE_SIZE
+EEPROM_PAGES = 2
+EEPROM_SIZE = EEPROM_PAGES * PAGE_SIZE
+
+FW_FLASH_PAGES = 110
+FW_FLASH_SIZE = FW_FLASH_PAGES * PAGE_SIZE
+FW_FLASH_BLOCKS = FW_FLASH_SIZE // BLOCK_SIZE
+
+FW_EEPROM_PAGES = 2
+FW_EEPROM_SIZE = FW_EEPROM_PAGES * PAGE_SIZE
+FW_EEPROM_BLOCKS = FW_EEPROM_SIZE // BLOCK_SIZE
+
+TOTAL_FW_SIZE = FW_FLASH_SIZE + FW_EEPROM_SIZE
+TOTAL_FW_PAGES = FW_FLASH_PAGES + FW_EEPROM_PAGES
+TOTAL_FW_BLOCKS = FW_FLASH_BLOCKS + FW_EEPROM_BLOCKS
+
+SECRET_SIZE = 64
+SECRET_PAD = b"."
+SECRET_OVERLAY_CACHE_SIZE = 64
+
+# Erased flash, sliced to pad regions without allocating
+ERASED = memoryview(b"\xff" * TOTAL_FW_SIZE)
+
+
+class SecretSlot(NamedTuple):
+    name: str
+    label: str  # for error messages
+    size: int = SECRET_SIZE
+
+
+class SecretSlotTable:
+    """Layout of the secrets at the end of EEPROM
+
+    Slots are packed back to back in order so that the last one ends at the
+    end of EEPROM. The layout is validated once. Each set of secrets is
+    compiled into an overlay of the whole secret region, which is cached so
+    that devices sharing secrets, e.g. the cars of a fleet, reuse it.
+    """
+
+    def __init__(
+        self,
+        slots: Iterable[SecretSlot],
+        cache_size: int = SECRET_OVERLAY_CACHE_SIZE,
+    ):
+        self.slots = tuple(slots)
+        names = [slot.name for slot in self.slots]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if not self.slots or duplicates:
+            raise CmdFailedError(f"Invalid secret slots {names}")
+        empty = [slot.name for slot in self.slots if slot.size <= 0]
+        if empty:
+            raise CmdFailedError(f"Secret slots {empty} must have a positive size")
+
+        self.size = sum(slot.size for slot in self.slots)
+        if self.size > FW_EEPROM_SIZE:
+            raise CmdFailedError(
+                f"Secret slots need {self.size} B, more than the {FW_EEPROM_SIZE} B"
+                " of EEPROM"
+            )
+        self.offset = TOTAL_FW_SIZE - self.size
+        self.offsets: Dict[str, int] = {}
+        offset = 0
+        for slot in self.slots:
+            self.offsets[slot.name] = offset
+            offset += slot.size
+
+        self.cache_size = cache_size
+        self._overlays: "OrderedDict[Tuple[bytes, ...], bytes]" = OrderedDict()
+
+    @property
+    def names(self) -> Tuple[str, ...]:
+        return tuple(slot.name for slot in self.slots)
+
+    def view(self, data: memoryview, name: str) -> memoryview:
+        """Get the slot named name of a full device image"""
+        try:
+            offset = self.offset + self.offsets[name]
+        except KeyError:
+            raise CmdFailedError(f"Unknown secret slot {name!r}")
+        return data[offset : offset + self.slots[self.names.index(name)].size]
+
+    def overlay(self, secrets: Mapping[str, Union[str, bytes]]) -> bytes:
+        """Compile secrets by slot name into the contents of the secret region
+
+        Secrets are padded to their slot size. Every unknown, missing or
+        oversized secret is reported in one error.
+        """
+        encoded = {
+            name: secret.encode() if isinstance(secret, str) else bytes(secret)
+            for name, secret in secrets.items()
+        }
+        key = tuple(encoded.get(name, b"") for name in self.names)
+        overlay = self._overlays.get(key)
+        if overlay is not None and encoded.keys() == self.offsets.keys():
+            self._overlays.move_to_end(key)
+            return overlay
+
+        errors = []
+        unknown = sorted(set(encoded) - set(self.offsets))
+        if unknown:
+            errors.append(f"unknown slots {unknown}")
+        missing = [name for name in self.names if name not in encoded]
+        if missing:
+            errors.append(f"missing slots {missing}")
+        errors += [
+            f"{slot.label} too long ({len(encoded[slot.name])} > {slot.size})"
+            for slot in self.slots
+            if len(encoded.get(slot.name, b"")) > slot.size
+        ]
+        if errors:
+            raise CmdFailedError(f"Invalid secrets: {'; '.join(errors)}")
+
+        # Each secret fills its slot, padded with "."
+        region = bytearray(SECRET_PAD * self.size)
+        for slot in self.slots:
+            offset = self.offsets[slot.name]
+            region[offset : offset + len(encoded[slot.name])] = encoded[slot.name]
+        overlay = bytes(region)
+
+        self._overlays[key] = overlay
+        if len(self._overlays) > self.cache_size:
+            self._overlays.popitem(last=False)
+        return overlay
+
+
+# The secrets the car firmware reads from the end of EEPROM
+SECRET_SLOTS = SecretSlotTable(
+    (
+        SecretSlot("feature3", "Feature 3 secret"),
+        SecretSlot("feature2", "Feature 2 secret"),
+        SecretSlot("feature1", "Feature 1 secret"),
+        SecretSlot("unlock", "Unlock secret"),
+    )
+)
+
+
+class FirmwareImage:
+    """A packaged device image with zero-copy views of its regions
+
+    The size is validated once when the image is created. Images opened from
+    a file are memory-mapped, so only the parts that are used get read. Views
+    must not be used after the image is closed.
+    """
+
+    def __init__(
+        self, data: Union[bytes, bytearray, memoryview, mmap.mmap], path: Path = None
+    ):
+        self.path = path
+        self._mmap = data if isinstance(data, mmap.mmap) else None
+        self.data = memoryview(data)
+        self.flash = self.data[:FW_FLASH_SIZE]
+        self.eeprom = self.data[FW_FLASH_SIZE:]
+        if len(self.data) != TOTAL_FW_SIZE:
+            size = len(self.data)
+            self.close()
+            raise CmdFailedError(
+                f"Invalid image size 0x{size:X}. Expected 0x{TOTAL_FW_SIZE:X}"
+            )
+
+    @classmethod
+    def open(cls, image_path: Path) -> "FirmwareImage":
+        if not image_path.exists():
+            raise CmdFailedError(f"Image file {image_path} not found")
+
+        with open(image_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size != TOTAL_FW_SIZE:
+                raise CmdFailedError(
+                    f"Invalid image size 0x{size:X}. Expected 0x{TOTAL_FW_SIZE:X}"
+                )
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(data, image_path)
+
+    def __enter__(self) -> "FirmwareImage":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self) -> int:
+        return TOTAL_FW_SIZE
+
+    def close(self):
+        for view in (self.flash, self.eeprom, self.data):
+            view.release()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Views are still held elsewhere, let them keep the map alive
+                pass
+            self._mmap = None
+
+    def secret(self, slot: str, slots: SecretSlotTable = SECRET_SLOTS) -> memoryview:
+        """Get an EEPROM secret slot"""
+        return slots.view(self.data, slot)
+
+    def secrets(self, slots: SecretSlotTable = SECRET_SLOTS) -> Dict[str, memoryview]:
+        return {slot: self.secret(slot, slots) for slot in slots.names}
+
+    def page(self, i: int) -> memoryview:
+        return self.data[i * PAGE_SIZE : (i + 1) * PAGE_SIZE]
+
+    def pages(self) -> Iterator[memoryview]:
+        return (self.page(i) for i in range(TOTAL_FW_PAGES))
+
+    def block(self, i: int) -> memoryview:
+        return self.data[i * BLOCK_SIZE : (i + 1) * BLOCK_SIZE]
+
+    def blocks(self, start: int = 0, end: int = TOTAL_FW_BLOCKS) -> memoryview:
+        """Get a contiguous view of blocks start to end, e.g. for one write"""
+        return self.data[start * BLOCK_SIZE : end * BLOCK_SIZE]
+
+    def page_hashes(self) -> List[str]:
+        return [
+            hashlib.blake2b(page, digest_size=16).hexdigest() for page in self.pages()
+        ]
+
+
+class PackageJob(NamedTuple):
+    bin_path: Path
+    eeprom_path: Path
+    image_path: Path
+    secrets: Optional[bytes] = None  # secret region overlay to apply, if any
+
+
+class ImageBuilder:
+    """Assembles device images in one preallocated buffer
+
+    Build outputs are read straight into the flash and EEPROM regions of the
+    buffer and the finished image is written out from it, so packaging does
+    not copy the image around. Reuse one builder to package many devices.
+    """
+
+    def __init__(self, slots: SecretSlotTable = SECRET_SLOTS):
+        self.buf = bytearray(TOTAL_FW_SIZE)
+        self.view = memoryview(self.buf)
+        self.flash = self.view[:FW_FLASH_SIZE]
+        self.eeprom = self.view[FW_FLASH_SIZE:]
+        self.secret_region = self.view[slots.offset :]
+
+    @staticmethod
+    def _load(region: memoryview, path: Path, what: str):
+        # Read the file into the region and pad the rest as erased
+        with open(path, "rb", buffering=0) as f:
+            size = 0
+            while size < len(region):
+                n = f.readinto(region[size:])
+                if not n:
+                    break
+                size += n
+            if f.read(1):
+                raise CmdFailedError(f"{what} {path} is larger than {len(region)} B")
+        region[size:] = ERASED[: len(region) - size]
+
+    def set_secrets(self, overlay: bytes):
+        """Overwrite the secret region with an overlay from SecretSlotTable"""
+        if len(overlay) != len(self.secret_region):
+            raise CmdFailedError(
+                f"Secret overlay is {len(overlay)} B."
+                f" Expected {len(self.secret_region)} B"
+            )
+        self.secret_region[:] = overlay
+
+    def build(
+        self, bin_path: Path, eeprom_path: Path, secrets: Optional[bytes] = None
+    ) -> FirmwareImage:
+        """Assemble an image, returning a view that the next build overwrites"""
+        self._load(self.flash, bin_path, "Firmware binary")
+        self._load(self.eeprom, eeprom_path, "EEPROM file")
+        if secrets is not None:
+            self.set_secrets(secrets)
+        return FirmwareImage(self.view)
+
+    def write(self, image_path: Path):
+        with open(image_path, "wb", buffering=0) as f:
+            written = 0
+            while written < len(self.view):
+                written += f.write(self.view[written:])
+
+    def package(self, job: PackageJob):
+        self.build(job.bin_path, job.eeprom_path, job.secrets)
+        self.write(job.image_path)
+
+
+def package_many(
+    jobs: Iterable[PackageJob], builder: Optional[ImageBuilder] = None
+) -> List[Path]:
+    """Package many devices, reusing one image buffer
+
+    Devices sharing a secret overlay, like the cars of a fleet built with the
+    default secrets, reuse the same cached overlay bytes
+    """
+    builder = builder or ImageBuilder()
+    image_paths = []
+    for job in jobs:
+        builder.package(job)
+        image_paths.append(job.image_path)
+    return image_paths
@@ -0,0 +1,132 @@
+# 2023 eCTF
+# Kyle Scaplen
+#
+# (c) 2023 The MITRE Corporation
+#
+# This source file is part of an example system for MITRE's 2023 Embedded
+# CTF (eCTF). This code is being provided only for educational purposes for the
+# 2023 MITRE eCTF competition, and may not meet MITRE standards for quality.
+# Use this code at your own risk!
+
+# Only use the standard library here, since this is loaded before everything
+# else when profiling startup
+import importlib.abc
+import sys
+import time
+from typing import List, NamedTuple, Optional
+
+
+class ImportTime(NamedTuple):
+    module: str
+    depth: int
+    self_time: float
+    cumulative: float
+
+
+class _TimedLoader(importlib.abc.Loader):
+    def __init__(self, loader, profiler: "ImportProfiler"):
+        self.loader = loader
+        self.profiler = profiler
+
+    def __getattr__(self, name):
+        # e.g. get_code, which runpy uses to run __main__
+        return getattr(self.loader, name)
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        # Hand the module its real loader back before running it, so nothing
+        # that inspects loaders sees this wrapper
+        module.__loader__ = self.loader
+        if module.__spec__ is not None:
+            module.__spec__.loader = self.loader
+        self.profiler.enter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            self.profiler.exit(module.__name__)
+
+
+class ImportProfiler(importlib.abc.MetaPathFinder):
+    """Time how long each newly imported module takes to load
+
+    Times are recorded like python -X importtime: the time spent running the
+    module itself, and cumulatively including the modules it imported.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.times: List[ImportTime] = []
+        self._stack: List[List[float]] = []
+        self._finding = False
+
+    def install(self):
+        sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def find_spec(self, fullname, path, target=None):
+        if self._finding:
+            return None
+
+        # Find the module with the other finders, then wrap its loader
+        self._finding = True
+        try:
+            spec = None
+            for finder in sys.meta_path:
+                if finder is self or not hasattr(finder, "find_spec"):
+                    continue
+                spec = finder.find_spec(fullname, path, target)
+                if spec is not None:
+                    break
+        finally:
+            self._finding = False
+
+        if spec is None or not hasattr(spec.loader, "exec_module"):
+            return spec
+        spec.loader = _TimedLoader(spec.loader, self)
+        return spec
+
+    def enter(self):
+        # [start time, time spent in nested imports]
+        self._stack.append([time.perf_counter(), 0.0])
+
+    def exit(self, module: str):
+        start, nested = self._stack.pop()
+        cumulative = time.perf_counter() - start
+        if self._stack:
+            self._stack[-1][1] += cumulative
+        self.times.append(
+            ImportTime(module, len(self._stack), cumulative - nested, cumulative)
+        )
+
+    def report(self, min_time: float = 0.001) -> List[str]:
+        """Format the import times like python -X importtime, nested imports
+        first, leaving out modules that took less than min_time seconds"""
+        total_imports = sum(t.cumulative for t in self.times if t.depth == 0)
+        elapsed = time.perf_counter() - self.start
+        lines = [
+            f"Startup took {elapsed * 1000:.1f} ms,"
+            f" {total_imports * 1000:.1f} ms importing {len(self.times)} modules",
+            f"{'self [ms]':>10} | {'cumulative [ms]':>15} | module",
+        ]
+        for t in self.times:
+            if t.cumulative >= min_time:
+                lines.append(
+                    f"{t.self_time * 1000:>10.1f} | {t.cumulative * 1000:>15.1f} |"
+                    f" {'  ' * t.depth}{t.module}"
+                )
+        return lines
+
+
+profiler: Optional[ImportProfiler] = None
+
+
+def start_profiling():
+    global profiler
+    if profiler is None:
+        profiler = ImportProfiler()
+        profiler.install()
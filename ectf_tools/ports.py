@@ -0,0 +1,197 @@
+# 2023 eCTF
+# Kyle Scaplen
+#
+# (c) 2023 The MITRE Corporation
+#
+# This source file is part of an example system for MITRE's 2023 Embedded
+# CTF (eCTF). This code is being provided only for educational purposes for the
+# 2023 MITRE eCTF competition, and may not meet MITRE standards for quality.
+# Use this code at your own risk!
+
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from serial.tools import list_ports
+from serial.tools.list_ports_common import ListPortInfo
+
+from ectf_tools.utils import get_logger
+
+
+PORT_POLL_INTERVAL = 1.0
+# udev creates device nodes before it has set their permissions and links
+PORT_SETTLE_DELAY = 0.2
+
+# inotify(7) events for nodes appearing, disappearing or changing permissions
+IN_ATTRIB = 0x004
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_EVENT_HEADER = struct.Struct("iIII")
+
+
+class SerialPortInfo(NamedTuple):
+    device: str
+    identity: str  # stable across replugs, e.g. the USB serial number
+    description: str
+
+
+def port_identity(port: ListPortInfo) -> str:
+    """Identify a port by its USB serial number if it has one
+
+    Device paths like /dev/ttyACM0 are handed out in plug-in order, so they
+    only identify ports without a serial number
+    """
+    if port.serial_number:
+        return port.serial_number
+    if port.vid is not None and port.location:
+        return f"{port.vid:04x}:{port.pid:04x}@{port.location}"
+    return port.device
+
+
+def scan_ports() -> Dict[str, SerialPortInfo]:
+    return {
+        port.device: SerialPortInfo(port.device, port_identity(port), port.description)
+        for port in list_ports.comports()
+    }
+
+
+def identify_port(device: str) -> str:
+    """Get the identity of the board on a port
+
+    Ports that cannot be found, e.g. ptys, are identified by their real path
+    """
+    real_device = os.path.realpath(device)
+    for info in scan_ports().values():
+        if os.path.realpath(info.device) == real_device:
+            return info.identity
+    return real_device
+
+
+class Inotify:
+    """Minimal inotify(7) binding, for waiting on /dev without polling"""
+
+    def __init__(self, path: str, mask: int):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, path.encode(), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"Could not watch {path}")
+
+    def drain(self) -> int:
+        """Discard queued events, returning how many there were"""
+        events = 0
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                *_, name_len = IN_EVENT_HEADER.unpack_from(data, offset)
+                offset += IN_EVENT_HEADER.size + name_len
+                events += 1
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PortWatcher:
+    """Report serial ports as they are plugged in and removed
+
+    On Linux, the port list is only rescanned when /dev changes. Elsewhere,
+    or if inotify is unavailable, it is rescanned every poll_interval seconds
+    """
+
+    def __init__(
+        self, poll_interval: float = PORT_POLL_INTERVAL, logger: logging.Logger = None
+    ):
+        self.poll_interval = poll_interval
+        self.logger = logger or get_logger()
+        self.ports = scan_ports()
+        self.inotify: Optional[Inotify] = None
+        if sys.platform.startswith("linux"):
+            try:
+                self.inotify = Inotify("/dev", IN_CREATE | IN_DELETE | IN_ATTRIB)
+            except (OSError, AttributeError) as e:
+                self.logger.debug(f"Polling for serial ports, no inotify: {e}")
+
+    def __enter__(self) -> "PortWatcher":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+    def rescan(self) -> Tuple[List[SerialPortInfo], List[SerialPortInfo]]:
+        """Get the ports (added, removed) since the last scan"""
+        ports = scan_ports()
+        added = [info for dev, info in ports.items() if self.ports.get(dev) != info]
+        removed = [info for dev, info in self.ports.items() if ports.get(dev) != info]
+        self.ports = ports
+        return added, removed
+
+    def wait(self, timeout: Optional[float]):
+        """Block until /dev changes or timeout seconds pass"""
+        if self.inotify is None:
+            time.sleep(timeout)
+            return
+        if select.select([self.inotify.fd], [], [], timeout)[0]:
+            time.sleep(PORT_SETTLE_DELAY)
+            self.inotify.drain()
+
+    async def wait_async(self):
+        """Wait until /dev changes, or for poll_interval without inotify"""
+        if self.inotify is None:
+            await asyncio.sleep(self.poll_interval)
+            return
+
+        loop = asyncio.get_running_loop()
+        changed = loop.create_future()
+        loop.add_reader(self.inotify.fd, changed.set_result, None)
+        try:
+            await changed
+        finally:
+            loop.remove_reader(self.inotify.fd)
+        await asyncio.sleep(PORT_SETTLE_DELAY)
+        self.inotify.drain()
+
+    async def changes(self):
+        """Yield (added, removed) ports whenever the set of ports changes"""
+        while True:
+            await self.wait_async()
+            added, removed = self.rescan()
+            if added or removed:
+                yield added, removed
+
+    def wait_for_new_ports(self, timeout: Optional[float] = None) -> List[str]:
+        """Block until ports are plugged in, returning their devices
+
+        Ports plugged in together are all returned. Returns an empty list if
+        none appear within timeout seconds
+        """
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            wait = None if self.inotify is not None else self.poll_interval
+            if deadline is not None:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return []
+                wait = remaining if wait is None else min(wait, remaining)
+            self.wait(wait)
+            added, _ = self.rescan()
+            if added:
+                return sorted(info.device for info in added)
@@ -8,11 +8,35 @@
 # 2023 MITRE eCTF competition, and may not meet MITRE standards for quality.
 # Use this code at your own risk!
 
+import asyncio
+import contextlib
+import csv
+import io
+import json
 import logging
+import time
 from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional
 
-from ectf_tools.utils import run_shell, get_logger, SOCKET_BASE
+import docker.errors
+
+from ectf_tools.utils import (
+    CmdFailedError,
+    get_logger,
+    HandlerRet,
+    percentile,
+    SOCKET_BASE,
+)
+from ectf_tools.containers import (
+    docker_client,
+    exec_in_container,
+    in_executor,
+    run_container,
+    volume,
+)
 from ectf_tools.subparsers import (
+    SubparserPackageMany,
+    SubparserRunBatch,
     SubparserUnlockTool,
     SubparserPairTool,
     SubparserEnableTool,
@@ -20,6 +44,50 @@ from ectf_tools.subparsers import (
 )
 
 
+# Lets host tools reach bridges running on the host
+TOOL_HOSTS = {"ectf-net": "host-gateway"}
+
+
+def unlock_command(car_bridge: int) -> List[str]:
+    return ["./unlock_tool", "--car-bridge", str(car_bridge + SOCKET_BASE)]
+
+
+def pair_command(
+    unpaired_fob_bridge: int, paired_fob_bridge: int, pair_pin: str
+) -> List[str]:
+    return [
+        "./pair_tool",
+        "--unpaired-fob-bridge",
+        str(unpaired_fob_bridge + SOCKET_BASE),
+        "--paired-fob-bridge",
+        str(paired_fob_bridge + SOCKET_BASE),
+        "--pair-pin",
+        str(pair_pin),
+    ]
+
+
+def package_command(package_name: str, car_id: str, feature_number: int) -> List[str]:
+    return [
+        "./package_tool",
+        "--package-name",
+        package_name,
+        "--car-id",
+        str(car_id),
+        "--feature-number",
+        str(feature_number),
+    ]
+
+
+def enable_command(fob_bridge: int, package_name: str) -> List[str]:
+    return [
+        "./enable_tool",
+        "--fob-bridge",
+        str(fob_bridge + SOCKET_BASE),
+        "--package-name",
+        package_name,
+    ]
+
+
 async def unlock(
     name: str,
     car_bridge: int,
@@ -30,20 +98,19 @@ async def unlock(
     logger = logger or get_logger()
     logger.info(f"{tag} Running unlock tool")
 
-    car_bridge += SOCKET_BASE
-
-    ret = await run_shell(
-        "docker run"
-        " --rm"
-        " --add-host ectf-net:host-gateway"
-        f" -v {image}.{name}.tools.vol:/tools_out:ro"
-        " --workdir=/tools_out"
-        f" {tag} ./unlock_tool --car-bridge {car_bridge}",
-        logger,
+    ret = await run_container(
+        tag,
+        unlock_command(car_bridge),
+        volumes=volume(f"{image}.{name}.tools.vol", "/tools_out", read_only=True),
+        workdir="/tools_out",
+        extra_hosts=TOOL_HOSTS,
+        logger=logger,
     )
 
     stdout, stderr = ret[0]
-    print(stdout.decode(errors="backslashreplace"))
+    # Quiet callers, like the benchmark, still get the output returned
+    if logger.isEnabledFor(logging.INFO):
+        print(stdout.decode(errors="backslashreplace"))
 
     logger.info(f"{tag}: Unlock tool run")
     return stdout, stderr
@@ -61,18 +128,13 @@ async def pair(
     logger = logger or get_logger()
     logger.info(f"{tag} Running pair tool")
 
-    unpaired_fob_bridge += SOCKET_BASE
-    paired_fob_bridge += SOCKET_BASE
-
-    ret = await run_shell(
-        "docker run"
-        " --rm"
-        " --add-host ectf-net:host-gateway"
-        f" -v {image}.{name}.tools.vol:/tools_out:ro"
-        " --workdir=/tools_out"
-        f" {tag} ./pair_tool --unpaired-fob-bridge {unpaired_fob_bridge} "
-        f"--paired-fob-bridge {paired_fob_bridge} --pair-pin {pair_pin} ",
-        logger,
+    ret = await run_container(
+        tag,
+        pair_command(unpaired_fob_bridge, paired_fob_bridge, pair_pin),
+        volumes=volume(f"{image}.{name}.tools.vol", "/tools_out", read_only=True),
+        workdir="/tools_out",
+        extra_hosts=TOOL_HOSTS,
+        logger=logger,
     )
 
     stdout, stderr = ret[0]
@@ -97,17 +159,17 @@ async def package(
 
     package_out = package_out.resolve()
 
-    ret = await run_shell(
-        "docker run"
-        " --rm"
-        " --add-host ectf-net:host-gateway"
-        f" -v {image}.{name}.{deployment}.secrets.vol:/secrets"
-        f" -v {image}.{name}.tools.vol:/tools_out:ro"
-        " --workdir=/tools_out"
-        f" -v {str(package_out)}:/package_dir"
-        f" {tag} ./package_tool --package-name {package_name}"
-        f" --car-id {car_id} --feature-number {feature_number}",
-        logger,
+    ret = await run_container(
+        tag,
+        package_command(package_name, car_id, feature_number),
+        volumes={
+            **volume(f"{image}.{name}.{deployment}.secrets.vol", "/secrets"),
+            **volume(f"{image}.{name}.tools.vol", "/tools_out", read_only=True),
+            **volume(package_out, "/package_dir"),
+        },
+        workdir="/tools_out",
+        extra_hosts=TOOL_HOSTS,
+        logger=logger,
     )
 
     stdout, stderr = ret[0]
@@ -130,21 +192,396 @@ async def enable(
 
     package_in = package_in.resolve()
 
-    fob_bridge += SOCKET_BASE
-
-    ret = await run_shell(
-        "docker run"
-        " --rm"
-        " --add-host ectf-net:host-gateway"
-        f" -v {image}.{name}.tools.vol:/tools_out:ro"
-        " --workdir=/tools_out"
-        f" -v {str(package_in)}:/package_dir"
-        f" {tag} ./enable_tool --fob-bridge {fob_bridge}"
-        f" --package-name {package_name}",
-        logger,
+    ret = await run_container(
+        tag,
+        enable_command(fob_bridge, package_name),
+        volumes={
+            **volume(f"{image}.{name}.tools.vol", "/tools_out", read_only=True),
+            **volume(package_in, "/package_dir"),
+        },
+        workdir="/tools_out",
+        extra_hosts=TOOL_HOSTS,
+        logger=logger,
     )
 
     stdout, stderr = ret[0]
 
     logger.info(f"{tag}: Enable tool run")
     return stdout, stderr
+
+
+class BatchOp(NamedTuple):
+    op: str
+    command: List[str]
+    bridges: List[int]  # bridges the tool talks to, which it must not share
+    packages: List[str]  # packages the tool writes or reads, in batch order
+
+
+def load_batch(ops: Path, deployment: Optional[str], package_dir: Optional[Path]):
+    """Load a JSON list of host tool runs, each with the arguments of its
+    run.* command, e.g. [{"op": "unlock", "car_bridge": 1, "repeat": 100}]"""
+    try:
+        raw_ops = json.loads(ops.read_text())
+    except (OSError, ValueError) as e:
+        raise CmdFailedError(f"Could not read operations {ops}: {e}")
+    if not isinstance(raw_ops, list) or not raw_ops:
+        raise CmdFailedError(f"Operations {ops} must be a non-empty list")
+
+    batch = []
+    for i, raw_op in enumerate(raw_ops):
+        if not isinstance(raw_op, dict):
+            raise CmdFailedError(f"Operation {i} in {ops} must be an object")
+        args = dict(raw_op)
+        op = args.pop("op", None)
+        try:
+            repeat = int(args.pop("repeat", 1))
+            if repeat < 1:
+                raise ValueError(f"repeat must be at least 1, not {repeat}")
+            if op == "unlock":
+                car_bridge = int(args["car_bridge"])
+                batch_op = BatchOp(op, unlock_command(car_bridge), [car_bridge], [])
+            elif op == "pair":
+                bridges = [
+                    int(args["unpaired_fob_bridge"]),
+                    int(args["paired_fob_bridge"]),
+                ]
+                batch_op = BatchOp(
+                    op, pair_command(*bridges, str(args["pair_pin"])), bridges, []
+                )
+            elif op == "package":
+                package_name = str(args["package_name"])
+                batch_op = BatchOp(
+                    op,
+                    package_command(
+                        package_name, str(args["car_id"]), int(args["feature_number"])
+                    ),
+                    [],
+                    [package_name],
+                )
+            elif op == "enable":
+                fob_bridge = int(args["fob_bridge"])
+                package_name = str(args["package_name"])
+                batch_op = BatchOp(
+                    op,
+                    enable_command(fob_bridge, package_name),
+                    [fob_bridge],
+                    [package_name],
+                )
+            else:
+                raise CmdFailedError(
+                    f"Operation {i} in {ops} has unknown op {op!r}."
+                    " Expected unlock, pair, package or enable"
+                )
+        except (KeyError, TypeError, ValueError) as e:
+            raise CmdFailedError(f"Invalid {op} operation {i} in {ops}: {e!r}")
+
+        if op == "package" and (deployment is None or package_dir is None):
+            raise CmdFailedError(
+                "Package operations need --deployment and --package-dir"
+            )
+        if op == "enable" and package_dir is None:
+            raise CmdFailedError("Enable operations need --package-dir")
+        batch.extend([batch_op] * repeat)
+
+    return batch
+
+
+class ToolSession:
+    """One container that many host tool runs are exec'd into
+
+    The container mounts everything any run.* command would, so the tools
+    find their inputs in the usual places
+    """
+
+    def __init__(
+        self,
+        image: str,
+        name: str,
+        deployment: Optional[str],
+        package_dir: Optional[Path],
+        logger: logging.Logger,
+    ):
+        self.tag = f"{image}:{name}"
+        self.volumes = volume(f"{image}.{name}.tools.vol", "/tools_out", read_only=True)
+        if deployment is not None:
+            self.volumes.update(
+                volume(f"{image}.{name}.{deployment}.secrets.vol", "/secrets")
+            )
+        if package_dir is not None:
+            self.volumes.update(volume(package_dir.resolve(), "/package_dir"))
+        self.logger = logger
+        self.container = None
+
+    async def start(self):
+        self.logger.info(f"{self.tag}: Starting tool container")
+        try:
+            self.container = await in_executor(
+                docker_client().containers.run,
+                self.tag,
+                ["sleep", "infinity"],
+                detach=True,
+                volumes=self.volumes,
+                working_dir="/tools_out",
+                extra_hosts=TOOL_HOSTS,
+            )
+        except docker.errors.DockerException as e:
+            raise CmdFailedError(f"Could not start tool container: {e}")
+
+    async def run(self, command: List[str], logger: logging.Logger) -> HandlerRet:
+        return await exec_in_container(
+            self.container.id, command, workdir="/tools_out", logger=logger
+        )
+
+    async def stop(self):
+        if self.container is None:
+            return
+        try:
+            await in_executor(self.container.remove, force=True)
+        except docker.errors.DockerException as e:
+            self.logger.warning(f"Could not remove tool container: {e}")
+        self.container = None
+
+
+async def run_ops(
+    tag: str,
+    session: ToolSession,
+    batch_ops: List[BatchOp],
+    jobs: int,
+    logger: logging.Logger,
+) -> List[Dict[str, Any]]:
+    """Run host tools in a session, up to jobs at once, returning the output,
+    error and duration of each
+
+    Tools using the same package run in batch order, e.g. an enable after the
+    package run that writes its package
+    """
+    slots = asyncio.Semaphore(jobs)
+    bridge_locks: Dict[int, asyncio.Lock] = {}
+    results: List[Dict[str, Any]] = [{} for _ in batch_ops]
+
+    # Each tool waits for the last earlier tool using any of its packages
+    done = [asyncio.Event() for _ in batch_ops]
+    last_users: Dict[str, int] = {}
+    waits_for: List[List[int]] = []
+    for i, batch_op in enumerate(batch_ops):
+        waits_for.append(
+            sorted({last_users[p] for p in batch_op.packages if p in last_users})
+        )
+        last_users.update((package, i) for package in batch_op.packages)
+
+    async def run_op(i: int, batch_op: BatchOp):
+        try:
+            # Wait before taking a slot, so waiting tools never starve
+            # the ones they wait for
+            for j in waits_for[i]:
+                await done[j].wait()
+            await run_ready_op(i, batch_op)
+        finally:
+            done[i].set()
+
+    async def run_ready_op(i: int, batch_op: BatchOp):
+        async with slots, contextlib.AsyncExitStack() as stack:
+            # Tools talking to the same device take turns
+            for bridge_id in sorted(set(batch_op.bridges)):
+                lock = bridge_locks.setdefault(bridge_id, asyncio.Lock())
+                await stack.enter_async_context(lock)
+
+            start = time.perf_counter()
+            error = None
+            try:
+                ret = await session.run(batch_op.command, logger)
+                stdout, stderr = (
+                    stream.decode(errors="backslashreplace") for stream in ret[0]
+                )
+            except CmdFailedError as e:
+                # Keep going, so one failure does not hide the rest
+                error = e.args[0]
+                stdout, stderr = e.args[1:3] if len(e.args) == 3 else ("", "")
+            seconds = time.perf_counter() - start
+
+        status = f"failed ({error})" if error else "ok"
+        logger.info(f"{tag} {i}: {batch_op.op} {status} in {seconds:.2f}s")
+        results[i] = {
+            "op": batch_op.op,
+            "seconds": round(seconds, 3),
+            "error": error,
+            "stdout": stdout,
+            "stderr": stderr,
+        }
+
+    await asyncio.gather(*(run_op(i, op) for i, op in enumerate(batch_ops)))
+    return results
+
+
+async def batch(
+    name: str,
+    ops: Path,
+    deployment: Optional[str] = SubparserRunBatch.deployment,
+    package_dir: Optional[Path] = SubparserRunBatch.package_dir,
+    jobs: int = SubparserRunBatch.jobs,
+    output: Optional[Path] = SubparserRunBatch.output,
+    image: str = SubparserRunBatch.image,
+    logger: logging.Logger = None,
+) -> HandlerRet:
+    tag = f"{image}:{name}"
+    logger = logger or get_logger()
+    if jobs < 1:
+        raise CmdFailedError(f"Invalid number of jobs {jobs}. Expected at least 1")
+
+    batch_ops = load_batch(ops, deployment, package_dir)
+    logger.info(f"{tag} Running {len(batch_ops)} host tools, {jobs} at a time")
+
+    session = ToolSession(image, name, deployment, package_dir, logger)
+    start = time.perf_counter()
+    try:
+        await session.start()
+        started = time.perf_counter()
+        results = await run_ops(tag, session, batch_ops, jobs, logger)
+    finally:
+        await session.stop()
+    total = time.perf_counter() - start
+
+    failed = sum(1 for result in results if result["error"])
+    summary = {
+        "container_start_seconds": round(started - start, 3),
+        "total_seconds": round(total, 3),
+        "failed": failed,
+        "ops": results,
+    }
+    logger.info(
+        f"{tag} Ran {len(results) - failed}/{len(results)} host tools in {total:.2f}s"
+    )
+    if output is not None:
+        output.write_text(json.dumps(summary, indent=2))
+        logger.info(f"Wrote batch results to {output}")
+    if failed:
+        raise CmdFailedError(f"{failed} host tool runs failed")
+
+    return json.dumps(summary).encode(), b""
+
+
+class PackageRequest(NamedTuple):
+    car_id: str
+    feature_number: int
+    package_name: str
+
+
+def load_package_requests(requests: Path) -> List[PackageRequest]:
+    """Load package requests from a CSV file with a car_id, feature_number,
+    package_name header, or a JSON list of objects with those keys"""
+    try:
+        text = requests.read_text()
+        if requests.suffix.lower() == ".csv":
+            rows = list(csv.DictReader(io.StringIO(text)))
+        else:
+            rows = json.loads(text)
+    except (OSError, ValueError, csv.Error) as e:
+        raise CmdFailedError(f"Could not read package requests {requests}: {e}")
+    if not isinstance(rows, list) or not rows:
+        raise CmdFailedError(f"Package requests {requests} must be a non-empty list")
+
+    package_requests = []
+    for i, row in enumerate(rows):
+        try:
+            package_requests.append(
+                PackageRequest(
+                    str(row["car_id"]).strip(),
+                    int(row["feature_number"]),
+                    str(row["package_name"]).strip(),
+                )
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            raise CmdFailedError(f"Invalid package request {i} in {requests}: {e!r}")
+    return package_requests
+
+
+def dedup_package_requests(
+    package_requests: List[PackageRequest],
+) -> List[PackageRequest]:
+    """Drop repeated requests, failing if one package name is requested with
+    different contents"""
+    unique: Dict[str, PackageRequest] = {}
+    conflicts = set()
+    for request in package_requests:
+        first = unique.setdefault(request.package_name, request)
+        if first != request:
+            conflicts.add(request.package_name)
+    if conflicts:
+        raise CmdFailedError(
+            f"Packages requested with different contents: {sorted(conflicts)}"
+        )
+    return list(unique.values())
+
+
+async def package_many(
+    name: str,
+    deployment: str,
+    requests: Path,
+    package_out: Path,
+    jobs: int = SubparserPackageMany.jobs,
+    output: Optional[Path] = SubparserPackageMany.output,
+    image: str = SubparserPackageMany.image,
+    logger: logging.Logger = None,
+) -> HandlerRet:
+    tag = f"{image}:{name}"
+    logger = logger or get_logger()
+    if jobs < 1:
+        raise CmdFailedError(f"Invalid number of jobs {jobs}. Expected at least 1")
+
+    package_requests = load_package_requests(requests)
+    unique_requests = dedup_package_requests(package_requests)
+    duplicates = len(package_requests) - len(unique_requests)
+    if duplicates:
+        logger.info(f"{tag} Skipping {duplicates} duplicate package requests")
+    logger.info(f"{tag} Packaging {len(unique_requests)} features, {jobs} at a time")
+
+    package_out.mkdir(parents=True, exist_ok=True)
+    batch_ops = [
+        BatchOp(
+            "package",
+            package_command(r.package_name, r.car_id, r.feature_number),
+            [],
+            [r.package_name],
+        )
+        for r in unique_requests
+    ]
+    session = ToolSession(image, name, deployment, package_out, logger)
+    start = time.perf_counter()
+    try:
+        await session.start()
+        started = time.perf_counter()
+        results = await run_ops(tag, session, batch_ops, jobs, logger)
+    finally:
+        await session.stop()
+    total = time.perf_counter() - start
+
+    packages = [
+        {**request._asdict(), "seconds": result["seconds"], "error": result["error"]}
+        for request, result in zip(unique_requests, results)
+    ]
+    latencies = [package["seconds"] for package in packages]
+    failed = [package["package_name"] for package in packages if package["error"]]
+    summary = {
+        "packages": packages,
+        "duplicates": duplicates,
+        "failed": failed,
+        "container_start_seconds": round(started - start, 3),
+        "total_seconds": round(total, 3),
+        "latency_seconds": {
+            **{f"p{pct}": round(percentile(latencies, pct), 3) for pct in (50, 95)},
+            "max": max(latencies),
+        },
+    }
+    logger.info(
+        f"{tag} Packaged {len(packages) - len(failed)}/{len(packages)} features"
+        f" in {total:.2f}s (per package p50"
+        f" {summary['latency_seconds']['p50']:.2f}s,"
+        f" max {summary['latency_seconds']['max']:.2f}s)"
+    )
+    if output is not None:
+        output.write_text(json.dumps(summary, indent=2))
+        logger.info(f"Wrote package results to {output}")
+    if failed:
+        raise CmdFailedError(f"Packaging failed for {', '.join(failed)}")
+
+    return json.dumps(summary).encode(), b""
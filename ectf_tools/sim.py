@@ -0,0 +1,301 @@
+# 2023 eCTF
+# Kyle Scaplen
+#
+# (c) 2023 The MITRE Corporation
+#
+# This source file is part of an example system for MITRE's 2023 Embedded
+# CTF (eCTF). This code is being provided only for educational purposes for the
+# 2023 MITRE eCTF competition, and may not meet MITRE standards for quality.
+# Use this code at your own risk!
+
+import asyncio
+import logging
+import os
+import pty
+import signal
+import time
+import tty
+from pathlib import Path
+from typing import Optional
+
+from ectf_tools.image import BLOCK_SIZE, FW_FLASH_BLOCKS, TOTAL_FW_SIZE
+from ectf_tools.device import (
+    BootloaderResponseCode,
+    SECURE_BL_UPDATE_COMMAND,
+    secure_bl_success_codes,
+    secure_bl_error_codes,
+)
+from ectf_tools.utils import CmdFailedError, get_logger, HandlerRet
+from ectf_tools.subparsers import SubparserSimBootloader
+
+SIM_MODES = ("insecure", "secure")
+
+# Secure bootloader codes sent by the simulator. load_sec_hw starts sending
+# blocks after the third success code and stops at the last one
+SECURE_SIM_START_CODES = secure_bl_success_codes[:3]
+SECURE_SIM_BLOCK_OK = secure_bl_success_codes[3]
+SECURE_SIM_INSTALL_OK = secure_bl_success_codes[-1]
+SECURE_SIM_BLOCK_ERROR = secure_bl_error_codes[0]
+
+
+class SimulatedBootloader:
+    """Bootloader update protocol served over a pseudo-terminal
+
+    The host side of the pty behaves like the device's serial port, so
+    device.load_hw and device.load_sec_hw can flash it unchanged. Each
+    received image is written to image_out. uart_delay is charged per byte
+    in both directions to model the serial line rate, and ack_delay before
+    each block ACK to model the bootloader writing flash.
+    """
+
+    def __init__(
+        self,
+        image_out: Path,
+        secure: bool = False,
+        uart_delay: float = 0.0,
+        ack_delay: float = 0.0,
+        image_size: int = TOTAL_FW_SIZE,
+        fail_block: int = 0,
+        logger: logging.Logger = None,
+    ):
+        self.image_out = image_out
+        self.secure = secure
+        self.uart_delay = uart_delay
+        self.ack_delay = ack_delay
+        self.image_size = image_size
+        self.fail_block = fail_block
+        self.logger = logger or get_logger()
+        self.master_fd: Optional[int] = None
+        self.slave_fd: Optional[int] = None
+        self.updates = 0
+        self._buf = bytearray()
+        self._arrival = 0.0
+        self._rx_clock = 0.0
+        self._tx_clock = 0.0
+
+    def open(self) -> str:
+        """Open the pty and return the path of the device side"""
+        self.master_fd, self.slave_fd = pty.openpty()
+        tty.setraw(self.master_fd)
+        tty.setraw(self.slave_fd)
+        os.set_blocking(self.master_fd, False)
+        return os.ttyname(self.slave_fd)
+
+    def close(self):
+        # Keeping the slave end open lets hosts reconnect between updates
+        for fd in (self.master_fd, self.slave_fd):
+            if fd is not None:
+                os.close(fd)
+        self.master_fd = self.slave_fd = None
+
+    async def _wait_fd(self, writable: bool = False):
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        fd = self.master_fd
+
+        def ready():
+            if not fut.done():
+                fut.set_result(None)
+
+        add, remove = (
+            (loop.add_writer, loop.remove_writer)
+            if writable
+            else (loop.add_reader, loop.remove_reader)
+        )
+        add(fd, ready)
+        try:
+            await fut
+        finally:
+            remove(fd)
+
+    async def _sleep_until(self, deadline: float):
+        delay = deadline - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def read_exact(self, n: int) -> bytes:
+        while len(self._buf) < n:
+            await self._wait_fd()
+            try:
+                self._buf += os.read(self.master_fd, 4096)
+                self._arrival = time.perf_counter()
+            except BlockingIOError:
+                continue
+        data = bytes(self._buf[:n])
+        del self._buf[:n]
+
+        # Each direction of the UART keeps a clock of when its last byte
+        # finished crossing the line. Clocks only restart when a line went
+        # idle, so sleep overshoot does not accumulate while it is busy
+        if self.uart_delay:
+            self._rx_clock = max(self._rx_clock, self._arrival) + n * self.uart_delay
+            await self._sleep_until(self._rx_clock)
+        return data
+
+    async def send(self, data: bytes, delay: float = 0.0):
+        """Send data once the last received byte and delay have elapsed"""
+        ready_at = max(self._rx_clock, self._arrival) + delay
+        self._tx_clock = max(self._tx_clock, ready_at) + len(data) * self.uart_delay
+        await self._sleep_until(self._tx_clock)
+
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[os.write(self.master_fd, view) :]  # noqa
+            except BlockingIOError:
+                await self._wait_fd(writable=True)
+
+    async def send_code(self, code: int, delay: float = 0.0):
+        await self.send(bytes([code]), delay)
+
+    def save_image(self, image: bytes):
+        tmp_path = self.image_out.with_name(self.image_out.name + ".tmp")
+        tmp_path.write_bytes(image)
+        tmp_path.replace(self.image_out)
+
+    async def serve_update(self):
+        """Wait for an update request and receive one image"""
+        request = (
+            SECURE_BL_UPDATE_COMMAND
+            if self.secure
+            else BootloaderResponseCode.RequestUpdate.value
+        )
+        while await self.read_exact(1) != request:
+            pass
+
+        self.logger.info("Update requested")
+        start = time.perf_counter()
+        if self.secure:
+            for code in SECURE_SIM_START_CODES:
+                await self.send_code(code)
+        else:
+            await self.send(BootloaderResponseCode.StartUpdate.value)
+            await self.send(BootloaderResponseCode.UpdateInitFlashEraseOK.value)
+            await self.send(BootloaderResponseCode.UpdateInitEEPROMEraseOK.value)
+
+        image = bytearray()
+        total_blocks = -(-self.image_size // BLOCK_SIZE)
+        for block in range(1, total_blocks + 1):
+            image += await self.read_exact(
+                min(BLOCK_SIZE, self.image_size - len(image))
+            )
+
+            in_flash = block <= FW_FLASH_BLOCKS
+            if block == self.fail_block:
+                self.logger.warning(f"Failing install at block {block}")
+                if self.secure:
+                    await self.send_code(SECURE_SIM_BLOCK_ERROR, self.ack_delay)
+                elif in_flash:
+                    await self.send(
+                        BootloaderResponseCode.AppBlockInstallError.value,
+                        self.ack_delay,
+                    )
+                else:
+                    await self.send(
+                        BootloaderResponseCode.EEPROMBlockInstallError.value,
+                        self.ack_delay,
+                    )
+                return
+
+            if self.secure:
+                await self.send_code(SECURE_SIM_BLOCK_OK, self.ack_delay)
+            elif in_flash:
+                await self.send(
+                    BootloaderResponseCode.AppBlockInstallOK.value, self.ack_delay
+                )
+            else:
+                await self.send(
+                    BootloaderResponseCode.EEPROMBlockInstallOK.value, self.ack_delay
+                )
+
+        if self.secure:
+            await self.send_code(SECURE_SIM_INSTALL_OK)
+        else:
+            await self.send(BootloaderResponseCode.AppInstallOK.value)
+
+        elapsed = time.perf_counter() - start
+        self.save_image(bytes(image))
+        self.updates += 1
+        self.logger.info(
+            f"Received {len(image)} bytes in {elapsed:.2f}s"
+            f" ({len(image) / elapsed / 1024:.1f} KiB/s), wrote {self.image_out}"
+        )
+
+    async def run(self):
+        while True:
+            await self.serve_update()
+            self._buf.clear()
+
+
+def replace_link(link: Path, target: str, logger: logging.Logger):
+    """Point a symlink at target, replacing one left behind by a killed simulator"""
+    if link.exists() and not link.is_symlink():
+        raise CmdFailedError(f"{link} exists and is not a symlink")
+    if link.is_symlink():
+        logger.info(f"Replacing existing link {link} -> {os.readlink(link)}")
+
+    # Swap the new link in atomically
+    tmp_link = link.with_name(f".{link.name}.{os.getpid()}")
+    if tmp_link.is_symlink():
+        tmp_link.unlink()
+    tmp_link.symlink_to(target)
+    os.replace(tmp_link, link)
+
+
+async def bootloader(
+    image_out: Path,
+    mode: str = SubparserSimBootloader.mode,
+    uart_delay: float = SubparserSimBootloader.uart_delay,
+    ack_delay: float = SubparserSimBootloader.ack_delay,
+    image_size: int = SubparserSimBootloader.image_size,
+    fail_block: int = SubparserSimBootloader.fail_block,
+    link: Optional[Path] = SubparserSimBootloader.link,
+    logger: logging.Logger = None,
+) -> HandlerRet:
+    logger = logger or get_logger()
+
+    if mode not in SIM_MODES:
+        raise CmdFailedError(f"Unknown mode {mode!r}. Expected one of {SIM_MODES}")
+    if mode == "insecure" and image_size != TOTAL_FW_SIZE:
+        raise CmdFailedError(f"The insecure bootloader only takes {TOTAL_FW_SIZE} B")
+    if image_size <= 0:
+        raise CmdFailedError("Image size must be positive")
+
+    sim = SimulatedBootloader(
+        image_out,
+        secure=mode == "secure",
+        uart_delay=uart_delay,
+        ack_delay=ack_delay,
+        image_size=image_size,
+        fail_block=fail_block,
+        logger=logger,
+    )
+    pty_path = sim.open()
+    dev_serial = pty_path
+    if link is not None:
+        try:
+            replace_link(link, pty_path, logger)
+        except OSError as e:
+            sim.close()
+            raise CmdFailedError(f"Could not link {link} to {pty_path}: {e}")
+        dev_serial = str(link)
+    logger.info(f"Simulated {mode} bootloader listening on {dev_serial}")
+
+    # Shut down cleanly when killed too, so the link is removed
+    loop = asyncio.get_running_loop()
+    serve = asyncio.ensure_future(sim.run())
+    loop.add_signal_handler(signal.SIGTERM, serve.cancel)
+    try:
+        await serve
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        logger.info("Shutting down simulated bootloader")
+    finally:
+        loop.remove_signal_handler(signal.SIGTERM)
+        serve.cancel()
+        sim.close()
+        # Leave the link alone if another simulator has taken it over
+        if link is not None and link.is_symlink() and os.readlink(link) == pty_path:
+            link.unlink()
+
+    logger.info(f"Simulated bootloader received {sim.updates} images")
+    return b"", b""
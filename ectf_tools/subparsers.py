@@ -9,7 +9,7 @@
 # Use this code at your own risk!
 
 from pathlib import Path
-from typing import Dict, Type
+from typing import Dict, Optional, Type
 
 from tap import Tap
 
@@ -36,6 +36,7 @@ class SubparserBuildEnv(BuildParser, cmd="build.env"):
         "docker_env"
     )  # path to the docker env within the design repo
     dockerfile: str = "build_image.Dockerfile"  # name of the dockerfile
+    rebuild: bool = False  # build even if the image context is unchanged
 
 
 class SubparserBuildTools(BuildParser, cmd="build.tools"):
@@ -59,6 +60,10 @@ class BuildDevParser(BuildParser):
     """Build a device"""
 
     deployment: str  # name of the deployment
+    build_cache: bool = False  # reuse outputs of identical earlier builds
+    cache_size: int = 1024  # maximum size of the build cache in MiB
+    warm: bool = False  # build in a long-lived container reused across builds
+    share_objects: bool = False  # reuse objects across builds with other defines
 
 
 class SubparserBuildCarFobPair(BuildDevParser, cmd="build.car_fob_pair"):
@@ -92,6 +97,19 @@ class SubparserBuildFob(BuildDevParser, cmd="build.fob"):
     fob_in: Path = Path("fob")  # path to the fob directory in the design repo
 
 
+class SubparserBuildFleet(BuildDevParser, cmd="build.fleet"):
+    """Build every car, paired fob and unpaired fob in a manifest"""
+
+    manifest: Path  # JSON manifest of cars and unpaired fobs to build
+    jobs: int = 0  # maximum device builds to run at once (0 for CPU count)
+
+
+class SubparserBuildStopWarm(BuildParser, cmd="build.stop_warm"):
+    """Remove the long-lived build container of a deployment"""
+
+    deployment: str  # name of the deployment
+
+
 class DockerRunParser(eCTFTap):
     name: str  # tag name of the Docker image
     image: str = "ectf"  # name of the Docker image
@@ -129,12 +147,47 @@ class SubparserPackageTool(DockerRunParser, cmd="run.package"):
     feature_number: int
 
 
+class SubparserPackageMany(DockerRunParser, cmd="run.package_many"):
+    """Run the package tool for many features concurrently"""
+
+    deployment: str  # name of the deployment
+    requests: Path  # CSV or JSON list of car_id, feature_number, package_name
+    package_out: Path  # directory to write every package to
+    jobs: int = 4  # maximum packages to make at once
+    output: Optional[Path] = None  # file to write per-package timings to
+
+
+class SubparserRunBatch(DockerRunParser, cmd="run.batch"):
+    """Run many host tools in one container"""
+
+    ops: Path  # JSON list of tool runs, e.g. [{"op": "unlock", "car_bridge": 1}]
+    deployment: Optional[str] = None  # name of the deployment, for package runs
+    package_dir: Optional[Path] = None  # package directory for package and enable
+    jobs: int = 1  # maximum tools to run at once
+    output: Optional[Path] = None  # file to write per-run output and timings to
+
+
 class SubparserDevLoadHW(eCTFTap, cmd="device.load_hw"):
     """Load a firmware onto the device"""
 
     dev_in: Path  # path to the device build directory
     dev_name: str  # name of the device
     dev_serial: str  # specify the serial port
+    window: int = 1  # number of blocks to send ahead of their ACKs
+    delta: bool = False  # skip the install if the image is unchanged since last flash
+    dry_run: bool = False  # only report pages that differ from the last flash
+    erase_timeout: float = 10  # seconds to wait for each erase or install step
+    ack_timeout: float = 2  # seconds to wait for each block ACK
+
+
+class SubparserDevLoadHWMany(eCTFTap, cmd="device.load_hw_many"):
+    """Load firmwares onto many devices concurrently"""
+
+    flash_map: Path  # JSON file mapping serial ports to image files
+    window: int = 1  # number of blocks to send ahead of their ACKs
+    jobs: int = 0  # maximum devices to flash at once (0 for all)
+    erase_timeout: float = 10  # seconds to wait for each erase or install step
+    ack_timeout: float = 2  # seconds to wait for each block ACK
 
 
 class SubparserDevLoadSecHW(eCTFTap, cmd="device.load_sec_hw"):
@@ -143,6 +196,8 @@ class SubparserDevLoadSecHW(eCTFTap, cmd="device.load_sec_hw"):
     dev_in: Path  # path to the device build directory
     dev_name: str  # name of the device
     dev_serial: str  # specify the serial port
+    erase_timeout: float = 10  # seconds to wait for each erase or install step
+    ack_timeout: float = 2  # seconds to wait for each block ACK
 
 
 class SubparserDevModeChange(eCTFTap, cmd="device.mode_change"):
@@ -150,6 +205,14 @@ class SubparserDevModeChange(eCTFTap, cmd="device.mode_change"):
 
     dev1_serial: str  # serial port of the first device
     dev2_serial: str  # serial port of the second device
+    step_timeout: float = 2  # seconds to wait for each message from a device
+
+
+class SubparserDevModeChangeMany(eCTFTap, cmd="device.mode_change_many"):
+    """Change the mode of many pairs of secure bootloaders at once"""
+
+    pair_map: Path  # JSON list of [first serial port, second serial port] pairs
+    step_timeout: float = 2  # seconds to wait for each message from a device
 
 
 class SubparserDevBridge(eCTFTap, cmd="device.bridge"):
@@ -157,3 +220,61 @@ class SubparserDevBridge(eCTFTap, cmd="device.bridge"):
 
     bridge_id: int  # Bridge ID to set up
     dev_serial: str  # serial port to open
+    capture: Optional[Path] = None  # record bridged traffic to this file
+    capture_max_mb: float = 64  # size to rotate capture files at
+
+
+class SubparserDevBridges(eCTFTap, cmd="device.bridges"):
+    """Start serial-to-socket bridges for many devices in one process"""
+
+    bridge_map: Path  # JSON file mapping bridge IDs to serial ports
+    stats_interval: float = 0  # seconds between traffic logs (0 to disable)
+    capture_dir: Optional[Path] = None  # record traffic to bridge_<ID>.cap files here
+    capture_max_mb: float = 64  # size to rotate capture files at
+
+
+class SubparserDevReplay(eCTFTap, cmd="device.replay"):
+    """Replay traffic captured by a bridge"""
+
+    capture: Path  # capture file written by device.bridge or device.bridges
+    dev_serial: Optional[str] = None  # serial port or pty to replay to
+    bridge_id: Optional[int] = None  # bridge to replay to
+    direction: str = "host_to_serial"  # traffic to replay, or serial_to_host
+    speed: float = 1  # speed relative to the capture (0 for as fast as possible)
+    settle: float = 1  # seconds to wait for more answers after the last arrives
+
+
+class SubparserDevWatch(eCTFTap, cmd="device.watch"):
+    """Watch for serial ports being plugged in, acting on known boards"""
+
+    board_map: Optional[Path] = None  # JSON file of actions for boards by identity
+    poll_interval: float = 1  # seconds between port scans without inotify
+
+
+class SubparserBench(DockerRunParser, cmd="bench.run"):
+    """Measure the latency and throughput of a host tool flow"""
+
+    flow: str  # host tool to run: unlock, pair, enable or package
+    flow_args: str = "{}"  # JSON object of arguments for the host tool
+    iterations: int = 10  # number of measured runs
+    warmup: int = 1  # number of unmeasured runs before measuring
+    bridge_map: Optional[Path] = None  # JSON file of bridges to host and measure
+    output: Optional[Path] = None  # file to write the JSON report to
+
+
+class SubparserSimBootloader(eCTFTap, cmd="sim.bootloader"):
+    """Serve a simulated bootloader on a pseudo-terminal"""
+
+    image_out: Path  # file to write each received image to
+    mode: str = "insecure"  # bootloader protocol: insecure or secure
+    uart_delay: float = 0  # seconds per byte sent or received (~8.7e-5 at 115200)
+    ack_delay: float = 0  # seconds to wait before acknowledging each block
+    image_size: int = 114688  # bytes per image (secure mode only)
+    fail_block: int = 0  # reject this block number to test failures (0 for none)
+    link: Optional[Path] = None  # symlink to create to the simulated serial port
+
+
+class SubparserDaemonServe(eCTFTap, cmd="daemon.serve"):
+    """Run commands sent with --daemon in one long-lived process"""
+
+    socket_path: Optional[Path] = None  # Unix socket to listen on
@@ -0,0 +1,150 @@
+# 2023 eCTF
+# Kyle Scaplen
+#
+# (c) 2023 The MITRE Corporation
+#
+# This source file is part of an example system for MITRE's 2023 Embedded
+# CTF (eCTF). This code is being provided only for educational purposes for the
+# 2023 MITRE eCTF competition, and may not meet MITRE standards for quality.
+# Use this code at your own risk!
+
+import contextlib
+import json
+import os
+import threading
+import time
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional
+
+
+"""
+Spans time a handler and the phases inside it. Each finished span is handed to
+the exporter of the current context as a dict in the shape of an OpenTelemetry
+span:
+
+{"name": ..., "trace_id": ..., "span_id": ..., "parent_span_id": ...,
+ "start_time_unix_nano": ..., "end_time_unix_nano": ..., "duration_ms": ...,
+ "attributes": {...}, "status": "ok" | "error", "error": ...}
+
+Without an exporter, spans cost next to nothing
+"""
+
+# Offset from perf_counter to the Unix epoch, so spans get wall clock times
+# while their durations come from the monotonic clock
+_EPOCH_OFFSET_NS = time.time_ns() - time.perf_counter_ns()
+
+
+class JsonLinesExporter:
+    """Append spans to a file, one JSON object per line
+
+    Spans may finish in executor threads, so writes are serialized
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(path, "a", buffering=1)
+        self._lock = threading.Lock()
+
+    def export(self, span: Dict[str, Any]):
+        line = json.dumps(span) + "\n"
+        with self._lock:
+            self._file.write(line)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+# Anything with export(span dict), e.g. one forwarding to an OpenTelemetry SDK
+span_exporter: ContextVar[Optional[JsonLinesExporter]] = ContextVar(
+    "span_exporter", default=None
+)
+
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start_ns", "attributes")
+
+    def __init__(self, name: str, parent: Optional["Span"], attributes: Dict):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.start_ns = time.perf_counter_ns()
+        self.attributes = attributes
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def export(self, end_ns: int, error: Optional[BaseException] = None):
+        exporter = span_exporter.get()
+        if exporter is None:
+            return
+        exporter.export(
+            {
+                "name": self.name,
+                "trace_id": self.trace_id,
+                "span_id": self.span_id,
+                "parent_span_id": self.parent_id,
+                "start_time_unix_nano": self.start_ns + _EPOCH_OFFSET_NS,
+                "end_time_unix_nano": end_ns + _EPOCH_OFFSET_NS,
+                "duration_ms": round((end_ns - self.start_ns) / 1e6, 3),
+                "attributes": self.attributes,
+                "status": "ok" if error is None else "error",
+                "error": None if error is None else str(error) or repr(error),
+            }
+        )
+
+
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes) -> Iterator[Optional[Span]]:
+    """Time the body as a child of the current span
+
+    Yields None when spans are not being exported
+    """
+    if span_exporter.get() is None:
+        yield None
+        return
+
+    s = Span(name, current_span.get(), attributes)
+    token = current_span.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.export(time.perf_counter_ns(), e)
+        raise
+    else:
+        s.export(time.perf_counter_ns())
+    finally:
+        current_span.reset(token)
+
+
+def record_span(name: str, start: float, end: float, **attributes):
+    """Export a phase timed with time.perf_counter() as a child of the current
+    span, for phases that are only known to be over afterwards"""
+    if span_exporter.get() is None:
+        return
+
+    s = Span(name, current_span.get(), attributes)
+    s.start_ns = int(start * 1e9)
+    s.export(int(end * 1e9))
+
+
+@contextlib.contextmanager
+def tracing(path: Optional[Path]) -> Iterator[None]:
+    """Export the spans of the body to a JSON-lines file, if one is given"""
+    if path is None:
+        yield
+        return
+
+    exporter = JsonLinesExporter(path)
+    token = span_exporter.set(exporter)
+    try:
+        yield
+    finally:
+        span_exporter.reset(token)
+        exporter.close()